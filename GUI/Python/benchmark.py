@@ -0,0 +1,349 @@
+import os, sys, json, time, base64, shutil, platform, argparse, tempfile, subprocess, tracemalloc
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from Python.profiling import peak_rss_mb
+
+# Benchmark suite for the analysis pipeline. Run from the GUI directory:
+# python -m Python.benchmark --wavelengths 20 --scans 25 --points 100 --windows 3 [--profile] [--stages integrate,main,raw_data] [--modes grid,cumsum,native] [--output results.json] [--compare old_results.json]
+# A directory of synthetic mzml files is generated (one file per wavelength), then each stage is run headlessly in a fresh process so that its peak memory
+# isn't mixed up with the other stages. Throughput (files/s, scans/s, points/s) and peak memory of each stage are printed and written to a .json file,
+# which can be given to --compare on a later run to see the speedup (or regression) of each stage.
+# With --startup, the time it takes to start the GUI and the command line tools is measured instead (see STARTUP_TARGETS).
+
+BENCHMARK_STAGES = ['integrate', 'main', 'raw_data']
+BENCHMARK_FORMAT_VERSION = 1
+
+#Startup benchmarks - each is run in a fresh interpreter (from the GUI directory) with python -X importtime
+#gui_window - import the GUI and show its window (the window is made offscreen if there is no display)
+#gui_import, headless_import, analysis_import - import only
+STARTUP_TARGETS = {'gui_window': 'import sys\nfrom PyQt5.QtWidgets import QApplication\napp = QApplication(sys.argv)\nimport UVPD_GUI\ngui = UVPD_GUI.GUI()\napp.processEvents()\nsys.stdout.flush()\nos._exit(0)',
+                   'gui_import': 'import UVPD_GUI',
+                   'headless_import': 'import Python.headless',
+                   'analysis_import': 'import Python.main, Python.workflows'}
+
+'''Synthetic data'''
+
+def synthetic_spectrum(rng, points, parent_mz, fragment_mzs, fragment_fraction, profile=False):
+    '''One synthetic scan: a parent ion peak and fragment ion peaks on top of noise. Usage is:
+    numpy random generator, number of points, parent m/z, list of fragment m/z, fraction of the ions that are fragmented, and whether to make a profile spectrum.
+    Centroid-like scans have their m/z values on the 0.01 Da lattice (like the QTRAP data) with the points spread between the peaks and the noise;
+    profile-like scans are evenly spaced between m/z 50 and parent m/z + 10. Returns the m/z and intensity arrays.
+    '''
+    peak_mzs = np.concatenate([[parent_mz], fragment_mzs])
+    peak_heights = np.concatenate([[1e6 * (1 - fragment_fraction)], np.full(len(fragment_mzs), 1e6 * fragment_fraction / max(len(fragment_mzs), 1))])
+    peak_width = 0.15
+
+    if profile:
+        mz = np.linspace(50., parent_mz + 10., points)
+    else:
+        #up to 2/3 of the points sit on the peaks, the rest are noise at random positions
+        points_per_peak = max(min(points * 2 // 3 // len(peak_mzs), 60), 1)
+        offsets = np.arange(points_per_peak) - points_per_peak // 2
+        lattice = np.round(peak_mzs * 100)[:, np.newaxis] + offsets
+        noise = rng.integers(5000, int((parent_mz + 10.) * 100), size=points)
+        lattice = np.unique(np.concatenate([lattice.ravel(), noise]))
+        lattice = np.sort(rng.choice(lattice, size=min(points, len(lattice)), replace=False))
+        mz = np.round(lattice / 100, 2)
+
+    intensity = np.sum(peak_heights[:, np.newaxis] * np.exp(-0.5 * ((mz - peak_mzs[:, np.newaxis]) / peak_width)**2), axis=0)
+    intensity *= rng.normal(1., 0.1, size=len(mz)).clip(0) #shot-to-shot noise
+    intensity += rng.exponential(50., size=len(mz)) #baseline noise
+    return mz, intensity
+
+def encode_array(values):
+    '''Base64 encoded 64-bit float array (no compression), as msconvert writes them with --64.'''
+    return base64.b64encode(np.asarray(values, dtype='<f8').tobytes()).decode('ascii')
+
+def write_synthetic_mzml(path, num_scans, points, parent_mz, fragment_mzs, fragment_fraction, profile=False, seed=0):
+    '''Writes an mzml file with num_scans synthetic scans (see synthetic_spectrum). Returns the total number of points written.'''
+    rng = np.random.default_rng(seed)
+    total_points = 0
+    spectrum_type = 'MS:1000128" name="profile spectrum' if profile else 'MS:1000127" name="centroid spectrum'
+
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('<?xml version="1.0" encoding="utf-8"?>\n<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n'
+                   '  <cvList count="1">\n    <cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" URI="https://raw.githubusercontent.com/HUPO-PSI/psi-ms-CV/master/psi-ms.obo"/>\n  </cvList>\n'
+                   f'  <run id="{os.path.splitext(os.path.basename(path))[0]}">\n    <spectrumList count="{num_scans}">\n')
+
+        for scan in range(num_scans):
+            mz, intensity = synthetic_spectrum(rng, points, parent_mz, fragment_mzs, fragment_fraction, profile)
+            total_points += len(mz)
+            file.write(f'      <spectrum index="{scan}" id="scan={scan + 1}" defaultArrayLength="{len(mz)}">\n'
+                       f'        <cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="1"/>\n'
+                       f'        <cvParam cvRef="MS" accession="{spectrum_type}" value=""/>\n'
+                       '        <binaryDataArrayList count="2">\n')
+            for accession, name, values in (('MS:1000514', 'm/z array', mz), ('MS:1000515', 'intensity array', intensity)):
+                encoded = encode_array(values)
+                file.write(f'          <binaryDataArray encodedLength="{len(encoded)}">\n'
+                           '            <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>\n'
+                           '            <cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>\n'
+                           f'            <cvParam cvRef="MS" accession="{accession}" name="{name}" value=""/>\n'
+                           f'            <binary>{encoded}</binary>\n'
+                           '          </binaryDataArray>\n')
+            file.write('        </binaryDataArrayList>\n      </spectrum>\n')
+
+        file.write('    </spectrumList>\n  </run>\n</mzML>\n')
+    return total_points
+
+def fragment_windows(parent_mz, num_windows):
+    '''Evenly spaced fragment ion m/z values between m/z 55 and parent m/z - 20, and a +/- 0.5 window around each.'''
+    fragment_mzs = np.round(np.linspace(55., parent_mz - 20., num_windows), 2) if num_windows > 1 else np.round([55.], 2)[:num_windows]
+    return fragment_mzs, [[mz - 0.5, mz + 0.5] for mz in fragment_mzs]
+
+def generate_dataset(directory, num_wavelengths=20, num_scans=25, points=100, parent_mz=240.24, num_windows=3, profile=False, seed=0):
+    '''Writes a synthetic data set: directory/mzml_directory with one mzml file per wavelength (400 nm in 2 nm steps), and directory/powerdata.csv. Usage is:
+    directory to write to, number of wavelengths (files), scans per file, points per scan, parent m/z, number of fragment windows, centroid or profile scans, and the random seed.
+    Returns a dict describing the data set (including the number of scans and points written, and the base peak and fragment ion ranges to use).
+    '''
+    mzml_directory = os.path.join(directory, 'mzml_directory')
+    os.makedirs(mzml_directory, exist_ok=True)
+    fragment_mzs, fragment_ion_ranges = fragment_windows(parent_mz, num_windows)
+    wavelengths = 400 + 2 * np.arange(num_wavelengths)
+
+    total_points = 0
+    for k, wavelength in enumerate(wavelengths):
+        fragment_fraction = 0.05 + 0.3 * np.sin(np.pi * k / max(num_wavelengths - 1, 1))**2 #some kind of action spectrum
+        total_points += write_synthetic_mzml(os.path.join(mzml_directory, f'Synthetic_Laser_On-{wavelength}.mzML'), num_scans, points, parent_mz, fragment_mzs, fragment_fraction, profile, seed + k)
+
+    #main() matches the rows of the power data file to the mzml files by position, in the order they are listed
+    power_data_file_name = os.path.join(directory, 'powerdata.csv')
+    from Python.workflows import list_mzml_files
+    with open(power_data_file_name, 'w') as file:
+        for mzml_file in list_mzml_files(mzml_directory):
+            file.write(f'{mzml_file.split("-")[-1].split(".")[0]},3.0,0.3\n')
+
+    return {'mzml_directory': mzml_directory, 'power_data_file_name': power_data_file_name, 'files': int(num_wavelengths), 'scans': int(num_wavelengths * num_scans), 'points': int(total_points),
+            'base_peak_range': [parent_mz - 1.5, parent_mz + 1.5], 'fragment_ion_ranges': [[float(lower), float(upper)] for lower, upper in fragment_ion_ranges], 'parent_mz': float(parent_mz)}
+
+'''Running the stages'''
+
+def run_stage(stage, dataset, integration_mode='grid', workers=1, trace_memory=False):
+    '''Runs one pipeline stage on a synthetic data set and measures it. Meant to be run in a fresh process (see benchmark). Usage is:
+    stage (one of BENCHMARK_STAGES), data set dict from generate_dataset, the integration mode, number of worker processes for main(), and whether to trace Python memory allocations.
+    Returns a dict with the run time and throughput of the stage, and its peak memory (of this process only - worker processes started by main() are not included).
+    '''
+    from Python.workflows import integrate_spectra_multi, extract_RawData, list_mzml_files
+    from Python.main import main
+
+    messages = [] #pipeline output isn't shown, only the measurements
+    mzml_directory = dataset['mzml_directory']
+    integration_bounds_list = [dataset['base_peak_range']] + dataset['fragment_ion_ranges']
+    start_rss = peak_rss_mb()
+
+    if trace_memory:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+
+    try:
+        if stage == 'integrate':
+            for mzml_file in list_mzml_files(mzml_directory):
+                integrate_spectra_multi(mzml_directory, mzml_file, integration_bounds_list, dataset['parent_mz'], update_output=messages.append, integration_mode=integration_mode)
+        elif stage == 'main':
+            if main(mzml_directory, dataset['base_peak_range'], dataset['fragment_ion_ranges'], dataset['power_data_file_name'], update_output=messages.append, integration_mode=integration_mode, workers=workers) is None:
+                raise Exception(''.join(messages))
+        elif stage == 'raw_data':
+            if not extract_RawData(mzml_directory, dataset['parent_mz'], os.path.join(os.path.dirname(mzml_directory), f'Raw_data_{os.getpid()}.csv'), update_output=messages.append):
+                raise Exception(''.join(messages))
+        else:
+            raise ValueError(f'Unknown benchmark stage "{stage}". Please use one of: {", ".join(BENCHMARK_STAGES)}')
+    finally:
+        sys.stdout = sys.__stdout__ #the pipeline redirects sys.stdout
+
+    seconds = time.perf_counter() - start_time
+    peak_traced_mb = None
+    if trace_memory:
+        peak_traced_mb = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+
+    return {'stage': stage, 'integration_mode': integration_mode if stage != 'raw_data' else None, 'workers': workers if stage == 'main' else 1, 'seconds': seconds,
+            'files_per_second': dataset['files'] / seconds, 'scans_per_second': dataset['scans'] / seconds, 'points_per_second': dataset['points'] / seconds,
+            'start_rss_mb': start_rss, 'peak_rss_mb': peak_rss_mb(), 'peak_traced_mb': peak_traced_mb}
+
+def result_name(result):
+    '''Name of a benchmark result, used to match results between runs.'''
+    if result['stage'] == 'raw_data':
+        return 'raw_data'
+    return f'{result["stage"]}[{result["integration_mode"]}' + (f', {result["workers"]} workers]' if result['stage'] == 'main' else ']')
+
+def benchmark(dataset, stages=BENCHMARK_STAGES, integration_modes=('grid',), workers=1, repeat=1, trace_memory=False, update_output=print):
+    '''Runs each stage (once per integration mode, repeat times) in a fresh process. Returns the list of results, keeping the fastest of the repeats.'''
+    results = []
+    for stage in stages:
+        for integration_mode in (integration_modes if stage != 'raw_data' else [None]):
+            runs = []
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    runs.append(executor.submit(run_stage, stage, dataset, integration_mode or 'grid', workers, trace_memory).result())
+
+            result = min(runs, key=lambda run: run['seconds'])
+            result['repeats'] = [run['seconds'] for run in runs]
+            results.append(result)
+            update_output(format_result(result))
+    return results
+
+'''Startup time'''
+
+def parse_importtime(text):
+    '''Parses the -X importtime report of a python process. Returns the total import time in seconds, and a dict of package -> seconds spent importing it and its submodules.'''
+    packages = {}
+    for line in text.splitlines():
+        #import time:  self [us] | cumulative | imported package
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        package = fields[2].strip().split('.')[0]
+        packages[package] = packages.get(package, 0.) + int(fields[0].split(':')[1]) / 1e6 #self time, so nothing is counted twice
+    return sum(packages.values()), packages
+
+def measure_startup(target, repeat=1):
+    '''Measures one of STARTUP_TARGETS in a fresh interpreter, repeat times (the fastest run is kept).
+    Returns a dict with the wall time of the process, the time spent importing and the import time of the slowest packages.
+    '''
+    gui_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ)
+    if target == 'gui_window' and sys.platform.startswith('linux') and not environment.get('DISPLAY') and not environment.get('WAYLAND_DISPLAY'):
+        environment.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    runs = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import os\n{STARTUP_TARGETS[target]}'], cwd=gui_directory, env=environment, capture_output=True, text=True)
+        seconds = time.perf_counter() - start_time
+        if process.returncode != 0:
+            raise Exception(f'{target} failed:\n{process.stderr[-2000:]}')
+        import_seconds, packages = parse_importtime(process.stderr)
+        runs.append({'seconds': seconds, 'import_seconds': import_seconds, 'packages': dict(sorted(packages.items(), key=lambda item: -item[1])[:8])})
+
+    result = min(runs, key=lambda run: run['seconds'])
+    result.update({'stage': 'startup', 'target': target, 'repeats': [run['seconds'] for run in runs]})
+    return result
+
+def format_startup_result(result, previous=None):
+    '''One line summary of a startup result, with the slowest imports (and the speedup against a previous result, if given).'''
+    text = f'{result["target"]:<18} {result["seconds"]:7.3f} s  imports {result["import_seconds"]:7.3f} s  slowest: ' + ', '.join(f'{package} {seconds:.3f} s' for package, seconds in list(result['packages'].items())[:5])
+    if previous is not None:
+        text += f'  {previous["seconds"] / result["seconds"]:6.2f}x vs previous'
+    return text
+
+def format_result(result, previous=None):
+    '''One line summary of a result (and the speedup against a previous result, if given).'''
+    text = f'{result_name(result):<28} {result["seconds"]:9.3f} s {result["files_per_second"]:9.2f} files/s {result["scans_per_second"]:10.1f} scans/s {result["points_per_second"]:12.0f} points/s'
+    if result['peak_rss_mb'] is not None:
+        text += f'  peak RSS {result["peak_rss_mb"]:8.1f} MB'
+    if result['peak_traced_mb'] is not None:
+        text += f'  peak traced {result["peak_traced_mb"]:8.1f} MB'
+    if previous is not None:
+        text += f'  {previous["seconds"] / result["seconds"]:6.2f}x vs previous'
+    return text
+
+def environment():
+    '''Machine and library versions, so results from different machines aren't compared by accident.'''
+    import pyteomics
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pyteomics': getattr(pyteomics, '__version__', None),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count()}
+
+def compare(results, dataset, previous_file, update_output=print):
+    '''Prints each result next to the result with the same name in a previous results file.'''
+    with open(previous_file) as file:
+        previous_run = json.load(file)
+    previous = {result_name(result): result for result in previous_run['results']}
+
+    update_output(f'\nCompared to {previous_file}:\n')
+    if previous_run['dataset'] != {key: dataset[key] for key in ('files', 'scans', 'points')}:
+        update_output(f'Warning: the previous run used a different data set ({previous_run["dataset"]}), so the times are not directly comparable.\n')
+    for result in results:
+        update_output(format_result(result, previous.get(result_name(result))))
+
+def compare_startup(results, previous_file, update_output=print):
+    '''Prints each startup result next to the result of the same target in a previous results file.'''
+    with open(previous_file) as file:
+        previous = {result['target']: result for result in json.load(file).get('startup', [])}
+
+    update_output(f'\nCompared to {previous_file}:\n')
+    for result in results:
+        update_output(format_startup_result(result, previous.get(result['target'])))
+
+def run_startup_benchmark(args):
+    '''Runs the startup benchmarks (--startup) for parsed command line arguments. Returns the exit code.'''
+    print(f'Startup time (fastest of {args.repeat}, python -X importtime):')
+    results = []
+    for target in STARTUP_TARGETS:
+        try:
+            results.append(measure_startup(target, args.repeat))
+            print(format_startup_result(results[-1]))
+        except Exception as e:
+            print(f'{target:<18} could not be measured: {e}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump({'format_version': BENCHMARK_FORMAT_VERSION, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'environment': environment(), 'startup': results, 'results': []}, file, indent=1)
+        print(f'\nResults written to {args.output}')
+
+    if args.compare is not None:
+        compare_startup(results, args.compare)
+    return 0 if len(results) == len(STARTUP_TARGETS) else 1
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m Python.benchmark', description='Benchmarks the UVPD analysis pipeline on synthetic mzML data.')
+    parser.add_argument('--wavelengths', default=20, type=int, help='number of mzml files (default: 20)')
+    parser.add_argument('--scans', default=25, type=int, help='scans per mzml file (default: 25)')
+    parser.add_argument('--points', default=100, type=int, help='points per scan (default: 100)')
+    parser.add_argument('--profile', action='store_true', help='profile-like scans (evenly spaced points) instead of centroid-like scans on the 0.01 Da lattice')
+    parser.add_argument('--parent-mz', default=240.24, type=float, help='m/z of the parent ion (default: 240.24)')
+    parser.add_argument('--windows', default=3, type=int, help='number of fragment ion windows (default: 3)')
+    parser.add_argument('--seed', default=0, type=int, help='random seed of the synthetic data (default: 0)')
+    parser.add_argument('--stages', default=','.join(BENCHMARK_STAGES), help=f'comma separated stages to run (default: {",".join(BENCHMARK_STAGES)})')
+    parser.add_argument('--modes', default='grid', help='comma separated integration modes for the integrate and main stages (default: grid)')
+    parser.add_argument('--workers', default=1, type=int, help='worker processes for the main stage (default: 1)')
+    parser.add_argument('--repeat', default=1, type=int, help='run each stage this many times and keep the fastest (default: 1)')
+    parser.add_argument('--trace-memory', action='store_true', help='also report the peak of Python memory allocations (tracemalloc - slows the stages down)')
+    parser.add_argument('--data-dir', default=None, help='directory for the synthetic data (default: a temporary directory that is removed afterwards)')
+    parser.add_argument('--output', default=None, help='.json file to write the results to')
+    parser.add_argument('--compare', default=None, help='.json results file of an earlier run to compare against')
+    parser.add_argument('--startup', action='store_true', help='measure how long the GUI takes to show its window and the modules take to import (in fresh interpreters) instead of the pipeline stages')
+    return parser
+
+def cli(argv=None):
+    args = build_parser().parse_args(argv)
+    from Python.workflows import INTEGRATION_MODES
+
+    if args.startup:
+        return run_startup_benchmark(args)
+
+    if args.windows < 1 or args.wavelengths < 1 or args.scans < 1 or args.points < 2:
+        print('At least one fragment window, wavelength and scan, and two points per scan are needed.')
+        return 2
+
+    stages = args.stages.replace(' ','').split(',')
+    modes = args.modes.replace(' ','').split(',')
+    for name, values, allowed in (('stage', stages, BENCHMARK_STAGES), ('integration mode', modes, INTEGRATION_MODES)):
+        for value in values:
+            if value not in allowed:
+                print(f'Unknown {name} "{value}". Please use one of: {", ".join(allowed)}')
+                return 2
+
+    data_directory = args.data_dir or tempfile.mkdtemp(prefix='uvpd_benchmark_')
+    try:
+        start_time = time.perf_counter()
+        dataset = generate_dataset(data_directory, args.wavelengths, args.scans, args.points, args.parent_mz, args.windows, args.profile, args.seed)
+        print(f'Generated {dataset["files"]} files, {dataset["scans"]} scans and {dataset["points"]} points in {time.perf_counter() - start_time:.1f} s ({"profile" if args.profile else "centroid"} scans, {args.windows} fragment windows)\n')
+
+        results = benchmark(dataset, stages, modes, args.workers, args.repeat, args.trace_memory)
+
+        if args.output is not None:
+            config = {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'data_dir')}
+            with open(args.output, 'w') as file:
+                json.dump({'format_version': BENCHMARK_FORMAT_VERSION, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'environment': environment(), 'config': config,
+                           'dataset': {key: dataset[key] for key in ('files', 'scans', 'points')}, 'results': results}, file, indent=1)
+            print(f'\nResults written to {args.output}')
+
+        if args.compare is not None:
+            compare(results, dataset, args.compare)
+
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_directory, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,88 @@
+import warnings
+import numpy as np
+
+# Bootstrap confidence intervals of the photofragmentation efficiency. The stdev columns of the PE table come from first order error propagation (PE_calc_array), which
+# treats the parent and fragment integrations as independent and adds a fixed +/- 2 nm wavelength term. With main(bootstrap_resamples=N), the integral of every window in
+# every scan is kept (integrate_spectra_multi(return_scans=True)) and the scans of each mzml file are resampled with replacement N times. The average integrations of each
+# resample give a PE for every channel - the parent and fragment integrals of a scan stay together, so any correlation between them is kept. The laser power is drawn from
+# a normal distribution with its stdev (there are no per-scan power readings) and the wavelength is taken as exact. The percentile interval of the resampled PE values is
+# written as two extra columns per channel (see bootstrap_column_names). Note that this is the uncertainty of the PE of the average integrations, so the interval is
+# much narrower than +/- the stdev columns, which propagate the scan to scan spread.
+# A resample is drawn as the number of times each scan is picked, and all the resamples of a batch are averaged with one matrix product (resamples x scans times
+# scans x windows), so thousands of resamples take about as long as a handful of matrix products rather than a Python loop over resamples.
+
+BOOTSTRAP_RESAMPLES = 2000          #default number of resamples when the bootstrap is switched on
+BOOTSTRAP_CONFIDENCE = 0.95
+BOOTSTRAP_BATCH_ELEMENTS = 2**22    #resamples x scans drawn at once - bounds the memory (32 MB of counts) whatever the number of scans
+
+def bootstrap_column_names(fragment_ion_ranges, confidence=BOOTSTRAP_CONFIDENCE):
+    '''Names of the confidence interval columns that follow the columns of PE_column_names, labelled with the central m/z of each fragment ion range.'''
+    level = f'{100*confidence:g}%'
+    column_names = [f'Total PE {level} CI low', f'Total PE {level} CI high']
+    for frag_ion_range in fragment_ion_ranges:
+        frag_mz = np.round(np.average(frag_ion_range),0)
+        column_names.extend([f'PE mz {frag_mz} {level} CI low', f'PE mz {frag_mz} {level} CI high'])
+    return column_names
+
+def new_seed():
+    '''Random seed for a run that wasn't given one - reported with the results, so the same intervals can be calculated again.'''
+    return int(np.random.SeedSequence().entropy % 2**63)
+
+def resample_means(scan_integrals, num_resamples, rng, batch_elements=BOOTSTRAP_BATCH_ELEMENTS):
+    '''Average integrations of bootstrap resamples of the scans of one mzml file. Usage is:
+    integrals of each window in each scan (scans x windows), the number of resamples, a numpy Generator, and how many resamples x scans to draw at once.
+    Returns the average of each window in each resample (resamples x windows). Every resample picks as many scans as there are, with replacement.
+    '''
+    scan_integrals = np.asarray(scan_integrals, dtype=float)
+    num_scans, num_windows = scan_integrals.shape
+    means = np.full((num_resamples, num_windows), np.nan)
+    if num_scans == 0:
+        return means
+
+    batch_size = max(batch_elements // num_scans, 1)
+    for start in range(0, num_resamples, batch_size):
+        stop = min(start + batch_size, num_resamples)
+
+        #how often each scan is picked in each resample - one bincount over the whole batch, with the scans of resample k at k*num_scans to (k+1)*num_scans
+        picks = rng.integers(0, num_scans, size=(stop - start, num_scans))
+        picks += np.arange(stop - start)[:, None] * num_scans
+        counts = np.bincount(picks.ravel(), minlength=(stop - start) * num_scans).reshape(stop - start, num_scans)
+
+        means[start:stop] = counts.astype(np.float64) @ scan_integrals / num_scans #a float matrix product is faster than an integer one, even with the conversion
+    return means
+
+def bootstrap_PE(wavelengths, laser_power, power_stdev, scan_integrals_list, normalize, num_resamples=BOOTSTRAP_RESAMPLES, confidence=BOOTSTRAP_CONFIDENCE, seed=None):
+    '''Bootstrap confidence intervals of the photofragmentation efficiency of every wavelength and channel. Usage is:
+    wavelengths, laser power and its stdev (one per wavelength), the integrals of each mzml file (scans x windows, base peak first, in the order of the wavelengths),
+    whether PE is normalized to laser power (as PE_calc_array) or not (as PE_calc_noNorm_array), the number of resamples, the confidence level, and the seed of the random numbers
+    (the same seed gives the same intervals).
+    Returns the lower and upper end of the interval of each channel (total PE first, then each fragment ion), interleaved as in bootstrap_column_names (wavelengths x channels*2).
+    Resamples that divide by zero are left out, and cells where all of them do are nan.
+    '''
+    rng = np.random.default_rng(seed)
+    tail = 100 * (1 - confidence) / 2
+    PE_CI = []
+
+    for W, P, dP, scan_integrals in zip(wavelengths, laser_power, power_stdev, scan_integrals_list):
+        means = resample_means(scan_integrals, num_resamples, rng)
+
+        #same channels as calculate_PE_matrix: the total of all fragment ions, then each fragment ion
+        Par = means[:, :1]
+        Frag = np.column_stack([np.sum(means[:, 1:], axis=1), means[:, 1:]])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if normalize:
+                P_resampled = rng.normal(P, dP, size=(num_resamples, 1))
+                P_resampled[P_resampled <= 0] = np.nan
+                efficiency = -(W / P_resampled) * np.log(Par / (Frag + Par))
+            else:
+                efficiency = -1 * np.log(Par / (Frag + Par))
+        efficiency[~np.isfinite(efficiency)] = np.nan
+
+        #nanpercentile warns about channels where every resample divided by zero - those are nan, like in the PE table
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, upper = np.nanpercentile(efficiency, [tail, 100 - tail], axis=0)
+        PE_CI.append(np.column_stack([lower, upper]).ravel())
+
+    return np.array(PE_CI).reshape(len(PE_CI), -1)
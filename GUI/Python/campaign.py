@@ -0,0 +1,338 @@
+import os, re, sys, csv, glob, time, argparse, threading, traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from Python.workflows import convert_wiff_to_mzml, verify_mzml_compression, INTEGRATION_MODES, MZML_COMPRESSIONS
+from Python.main import main
+from Python.headless import update_output as print_output, parse_base_peak_range, parse_fragment_ion_ranges, add_bootstrap_arguments
+from Python.fragment_detection import detect_fragment_windows, format_fragment_ion_ranges
+from Python.bootstrap import new_seed, BOOTSTRAP_CONFIDENCE
+
+# Campaign mode - runs the pipeline on many experiment directories (e.g. one per compensation voltage) with a single pool of worker processes, instead of one run after the other.
+# The .wiff conversions and mzml integrations of all directories go to the same pool, so the workers stay busy while a directory is converting, verifying or writing its .csv.
+# Each directory gets its own photofragmentation efficiency .csv (and checkpoint), written into the directory itself, and the rows of all of them are combined into
+# campaign_summary.csv, with the compensation voltage (CV) read from the directory name and the directory as the first two columns. Run from the GUI directory:
+# python -m Python.campaign "data/CV*" --base-peak 239.0,242.0 --fragments "(54.5,57.0),(114.5,116.0)" [--power-file "powerscan*.csv"] [--extract-mzml] [--workers 8]
+# Exits with 0 when every directory was analyzed and 1 otherwise (the summary is still written for the directories that were).
+
+CAMPAIGN_SUMMARY_NAME = 'campaign_summary.csv'
+
+def cv_from_name(name):
+    '''Compensation voltage written in a directory or file name, e.g. CV-21, CV_-21.5 or CV 15. Returns None if the name doesn't contain one.'''
+    match = re.search(r'CV[ _]?(-?\d+(?:\.\d+)?)', name, re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+def directory_cv(directory):
+    '''Compensation voltage of an experiment directory - from the directory name, or else from the name of the first data file in it.'''
+    cv = cv_from_name(os.path.basename(os.path.normpath(directory)))
+    if cv is None:
+        data_files = sorted(f for f in os.listdir(directory) if f.lower().endswith(('.wiff', '.mzml')))
+        cv = cv_from_name(data_files[0]) if len(data_files) > 0 else None
+    return cv
+
+def expand_directories(patterns):
+    '''Expands the directory arguments of a campaign. Usage is:
+    list of directories or glob patterns, each optionally followed by =<laser power file> for that directory (e.g. "data/CV-21=data/power_CV-21.csv").
+    Returns a list of (directory, power data file or None) in the order given, without duplicates. A glob pattern that matches no directory is returned as (None, pattern).
+    '''
+    directories = []
+    seen = set()
+    for pattern in patterns:
+        #split off the power file at the last '=' so that directory names can contain one
+        if '=' in pattern:
+            directory_pattern, power_data_file_name = pattern.rsplit('=', 1)
+        else:
+            directory_pattern, power_data_file_name = pattern, None
+
+        matches = sorted(path for path in glob.glob(directory_pattern) if os.path.isdir(path)) if glob.has_magic(directory_pattern) else [directory_pattern]
+        if len(matches) == 0:
+            directories.append((None, directory_pattern))
+
+        for directory in matches:
+            if os.path.normpath(directory) not in seen:
+                seen.add(os.path.normpath(directory))
+                directories.append((directory, power_data_file_name))
+    return directories
+
+def find_power_file(directory, power_file_pattern):
+    '''Laser power file of a directory, matched with a glob pattern relative to the directory. Returns the file, or raises a ValueError if there isn't exactly one match.'''
+    matches = sorted(path for path in glob.glob(os.path.join(glob.escape(directory), power_file_pattern)) if os.path.isfile(path))
+    if len(matches) != 1:
+        raise ValueError(f'{len(matches)} files in {directory} match the power file pattern "{power_file_pattern}", but exactly one is needed.' + (f' ({", ".join(map(os.path.basename, matches))})' if matches else ''))
+    return matches[0]
+
+def _convert_wiff_file(wiff_file, directory, mzml_directory, compression='none', intensity_32bit=False):
+    #runs in a worker process of the shared pool - messages can't be printed from there, so they are returned (or raised) instead
+    messages = []
+    start_time = time.time()
+    try:
+        mzml_file = convert_wiff_to_mzml(wiff_file, directory, mzml_directory, update_output=messages.append, compression=compression, intensity_32bit=intensity_32bit)
+    except Exception as e:
+        raise Exception(f'{"".join(messages)}{e}')
+    finally:
+        sys.stdout = sys.__stdout__ #convert_wiff_to_mzml redirects sys.stdout to messages.append
+    messages.append(f'{wiff_file} converted to {mzml_file} in {np.round(time.time() - start_time, 2)} seconds.\n')
+    return ''.join(messages)
+
+def convert_directory(directory, executor, update_output=print_output, compression='none', intensity_32bit=False, cancel_event=None, resume=False):
+    '''Converts the .wiff files of one directory of a campaign to .mzML (into directory/mzml_directory) with the shared pool of worker processes. Usage is:
+    directory with the .wiff files, the pool, and the settings of headless.run. When resuming, an existing mzml_directory is used as it is. Returns the directory with the .mzML files, or None if the conversion failed (the reason has been passed to update_output).
+    '''
+    mzml_directory = os.path.join(directory, 'mzml_directory')
+    wiff_files = sorted(f for f in os.listdir(directory) if f.endswith('.wiff'))
+
+    if len(wiff_files) == 0:
+        update_output(f'There are no .wiff files present in {directory} to extract!\n')
+        return
+
+    #resuming a run that extracted the .wiff files uses the .mzML files it already wrote
+    if resume and os.path.isdir(mzml_directory):
+        update_output(f'Resuming the last run: the .wiff files are not extracted again, the .mzML files already in {mzml_directory} are used.\n')
+        return mzml_directory
+
+    try:
+        os.mkdir(mzml_directory)
+    except FileExistsError:
+        update_output(f'{mzml_directory} already exists. To prevent overwriting files / combining incorrect data, delete it or run without --extract-mzml.\n')
+        return
+
+    #the conversions queue up in the shared pool next to the work of the other directories
+    futures = {executor.submit(_convert_wiff_file, wiff_file, directory, mzml_directory, compression, intensity_32bit): wiff_file for wiff_file in wiff_files}
+    failed = []
+    for future in as_completed(futures):
+        if cancel_event is not None and cancel_event.is_set():
+            for pending_future in futures:
+                pending_future.cancel()
+            update_output('The campaign was cancelled before all .wiff files were converted.\n')
+            return
+        try:
+            update_output(future.result())
+        except Exception as e:
+            update_output(f'There was a problem extracting {futures[future]}: {e}\n')
+            failed.append(futures[future])
+
+    if len(failed) > 0:
+        update_output(f'{len(failed)} of {len(wiff_files)} .wiff files could not be converted, so {directory} is not analyzed.\n')
+        return
+
+    #lossy encodings are checked against the uncompressed conversion of one file before the results are trusted
+    if compression != 'none' or intensity_32bit:
+        try:
+            if not verify_mzml_compression(wiff_files[0], directory, mzml_directory, compression, intensity_32bit, update_output=update_output):
+                update_output('The compressed .mzML files differ too much from the uncompressed data. Please convert them again with a lossless --compression (none or zlib).\n')
+                return
+        except Exception as e:
+            update_output(f'There was a problem checking the compressed .mzML files: {e}\n')
+            return
+    return mzml_directory
+
+def run_directory(directory, base_peak_range, fragment_ion_ranges, power_data_file_name, executor, update_output=print_output, integration_mode='grid', extract_mzml=False,
+                  compression='none', intensity_32bit=False, use_cache=False, cache_results=False, resume=False, cancel_event=None, mzml_directory=None, **bootstrap_settings):
+    '''Runs the pipeline on one directory of a campaign, using the shared pool of worker processes (executor) for the .wiff conversion and the integration. Usage is the same as
+    headless.run: directory with the .mzML files (or the .wiff files with extract_mzml), base peak range, fragment ion ranges, the laser power file (or None), and the settings.
+    mzml_directory is the directory with the .mzML files when they have already been converted (see convert_directory), and bootstrap_settings are passed on to main()
+    (bootstrap_resamples, bootstrap_confidence and bootstrap_seed).
+    Returns the photofragmentation efficiency .csv written to the directory, or None if the run failed (the reason has been passed to update_output).
+    '''
+    if mzml_directory is None:
+        mzml_directory = convert_directory(directory, executor, update_output, compression, intensity_32bit, cancel_event, resume) if extract_mzml else directory
+        if mzml_directory is None:
+            return
+
+    return main(mzml_directory, base_peak_range, fragment_ion_ranges, power_data_file_name, update_output=update_output, integration_mode=integration_mode, cancel_event=cancel_event,
+                use_cache=use_cache, cache_results=cache_results, resume=resume, executor=executor, output_directory=directory, **bootstrap_settings)
+
+def write_campaign_summary(summary_file, results):
+    '''Combines the photofragmentation efficiency .csv files of a campaign into one table. Usage is:
+    file to write, and a list of (directory, CV, .csv file) of the directories that were analyzed (all with the same columns, as they were run with the same settings).
+    Rows are sorted by CV (directories without one last), directory and wavelength. Returns the number of rows written.
+    '''
+    with open(results[0][2]) as file:
+        column_names = file.readline().strip().split(',')
+
+    rows = []
+    for directory, cv, output_file in results:
+        PE_data = np.atleast_2d(np.loadtxt(output_file, delimiter=',', skiprows=1, ndmin=2))
+        for PE_row in PE_data:
+            rows.append((cv, directory, PE_row))
+
+    rows.sort(key=lambda row: (row[0] is None, row[0] if row[0] is not None else 0., row[1], row[2][0]))
+
+    with open(summary_file, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['CV', 'Directory'] + column_names)
+        for cv, directory, PE_row in rows:
+            writer.writerow(['' if cv is None else f'{cv:g}', directory] + [f'{value:.6f}' for value in PE_row])
+    return len(rows)
+
+def run_campaign(directories, base_peak_range, fragment_ion_ranges, power_file_pattern=None, update_output=print_output, integration_mode='grid', workers=None, extract_mzml=False,
+                 compression='none', intensity_32bit=False, use_cache=False, cache_results=False, resume=False, cancel_event=None, summary_file=None, bootstrap_resamples=0,
+                 bootstrap_confidence=BOOTSTRAP_CONFIDENCE, bootstrap_seed=None):
+    '''Runs the pipeline on every directory of a campaign with one shared pool of worker processes. Usage is:
+    list of (directory, power data file or None) from expand_directories, base peak range, fragment ion ranges (or 'auto' to detect them from all the directories, see fragment_detection.py), a glob pattern to find the power file of directories that weren't given one
+    (relative to each directory, e.g. "powerscan*.csv" - without either, PE is not normalized to laser power), the number of worker processes (defaults to the number of CPUs),
+    the same settings as headless.run, the summary file (defaults to campaign_summary.csv in the folder that contains all the directories), and the bootstrap settings of main()
+    (every directory uses the same seed - one is picked and reported if none is given).
+    Returns the summary file (None if no directory was analyzed) and a dict of directory -> photofragmentation efficiency .csv (None for the directories that failed).
+    '''
+    workers = workers or os.cpu_count() or 1
+    outputs = {}
+    runs = [] #(directory, CV, power data file) of the directories that can be started
+
+    #check every directory before anything is started, so a typo doesn't show up half way through the campaign
+    for directory, power_data_file_name in directories:
+        if directory is None:
+            update_output(f'No directory matches {power_data_file_name}.\n')
+            outputs[power_data_file_name] = None
+            continue
+        outputs[directory] = None
+
+        if not os.path.isdir(directory):
+            update_output(f'The directory {directory} does not exist. Please provide a valid file path.\n')
+            continue
+
+        if power_data_file_name is None and power_file_pattern is not None:
+            try:
+                power_data_file_name = find_power_file(directory, power_file_pattern)
+            except ValueError as e:
+                update_output(f'{e}\n')
+                continue
+
+        if power_data_file_name is not None and not os.path.isfile(power_data_file_name):
+            update_output(f'The power data file {power_data_file_name} could not be found.\n')
+            continue
+
+        runs.append((directory, directory_cv(directory), power_data_file_name))
+
+    if len(runs) == 0:
+        update_output('There are no directories to analyze.\n')
+        return None, outputs
+
+    #one seed for the whole campaign, so it can be repeated
+    if bootstrap_resamples > 0 and bootstrap_seed is None:
+        bootstrap_seed = new_seed()
+
+    update_output(f'Running a campaign of {len(runs)} directories with {workers} shared worker processes...\n')
+    for directory, cv, power_data_file_name in runs:
+        update_output(f'  {directory}: CV {"unknown" if cv is None else f"{cv:g}"}, {"laser power " + power_data_file_name if power_data_file_name is not None else "no power normalization"}\n')
+
+    output_lock = threading.Lock()
+    def directory_output(directory):
+        #messages of all directories end up in the same place, so each one is labelled with its directory
+        label = os.path.basename(os.path.normpath(directory))
+        def labelled_output(text):
+            with output_lock:
+                update_output(''.join(f'[{label}] {line}' if line.strip() else line for line in text.splitlines(True)))
+        return labelled_output
+
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        mzml_directories = {directory: None for directory, _, _ in runs} #None - run_directory converts the .wiff files itself when extract_mzml is set
+
+        #automatic fragment windows are detected from all the directories at once, so that every directory gets the same ones - with extract_mzml that means converting all of them first
+        if fragment_ion_ranges == 'auto':
+            if extract_mzml:
+                with ThreadPoolExecutor(max_workers=len(runs)) as threads:
+                    futures = {threads.submit(convert_directory, directory, executor, update_output=directory_output(directory), compression=compression, intensity_32bit=intensity_32bit,
+                                              cancel_event=cancel_event, resume=resume): directory for directory, _, _ in runs}
+                    for future in as_completed(futures):
+                        try:
+                            mzml_directories[futures[future]] = future.result()
+                        except Exception as e:
+                            directory_output(futures[future])(f'Unexpected error during the .wiff conversion: {e}\nTraceback: {traceback.format_exc()}\n')
+            else:
+                mzml_directories = {directory: directory for directory, _, _ in runs}
+
+            runs = [run for run in runs if mzml_directories[run[0]] is not None]
+            peaks = detect_fragment_windows([mzml_directories[directory] for directory, _, _ in runs], base_peak_range, update_output=update_output, use_cache=use_cache,
+                                            executor=executor, cancel_event=cancel_event) if len(runs) > 0 else None
+            if peaks is None:
+                update_output('No fragment windows were detected, so no directory is analyzed.\n')
+                return None, outputs
+
+            fragment_ion_ranges = [[peak['lower'], peak['upper']] for peak in peaks]
+            update_output(f'Using the detected fragment ion ranges --fragments "{format_fragment_ion_ranges(peaks)}" for every directory.\n')
+
+        #each directory is driven by a thread, which only waits for the pool - the work itself is done by the worker processes
+        with ThreadPoolExecutor(max_workers=len(runs)) as threads:
+            futures = {threads.submit(run_directory, directory, base_peak_range, fragment_ion_ranges, power_data_file_name, executor, update_output=directory_output(directory),
+                                      integration_mode=integration_mode, extract_mzml=extract_mzml, compression=compression, intensity_32bit=intensity_32bit,
+                                      use_cache=use_cache, cache_results=cache_results, resume=resume, cancel_event=cancel_event,
+                                      mzml_directory=mzml_directories[directory], bootstrap_resamples=bootstrap_resamples, bootstrap_confidence=bootstrap_confidence,
+                                      bootstrap_seed=bootstrap_seed): directory for directory, _, power_data_file_name in runs}
+
+            for future in as_completed(futures):
+                directory = futures[future]
+                try:
+                    outputs[directory] = future.result()
+                except Exception as e:
+                    directory_output(directory)(f'Unexpected error during the analysis: {e}\nTraceback: {traceback.format_exc()}\n')
+
+    sys.stdout = sys.__stdout__ #main() and workflows.py leave sys.stdout redirected
+
+    #status of every directory, in the order they were given
+    update_output(f'\nCampaign finished in {np.round((time.time() - start_time)/60, 1)} minutes:\n')
+    for directory in outputs:
+        update_output(f'  {directory}: {outputs[directory] if outputs[directory] is not None else "FAILED"}\n')
+
+    results = [(directory, cv, outputs[directory]) for directory, cv, _ in runs if outputs[directory] is not None]
+    if len(results) == 0:
+        update_output('No directory was analyzed, so no campaign summary was written.\n')
+        return None, outputs
+
+    if summary_file is None:
+        #the folder that contains all the directories (there is none if they are on different drives)
+        try:
+            summary_directory = os.path.commonpath([os.path.dirname(os.path.abspath(directory)) for directory, _, _ in results])
+        except ValueError:
+            summary_directory = os.getcwd()
+
+        #mechanism to prevent overwriting existing output files
+        summary_file = os.path.join(summary_directory, CAMPAIGN_SUMMARY_NAME)
+        index = 0
+        while os.path.exists(summary_file):
+            index += 1
+            summary_file = os.path.join(summary_directory, f'campaign_summary_{index}.csv')
+
+    try:
+        num_rows = write_campaign_summary(summary_file, results)
+    except Exception as e:
+        update_output(f'There was a problem writing the campaign summary {summary_file}: {e}\nTraceback: {traceback.format_exc()}\n')
+        return None, outputs
+
+    update_output(f'The campaign summary ({num_rows} rows from {len(results)} directories) has been written to {summary_file}\n')
+    return summary_file, outputs
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m Python.campaign', description='Calculates UVPD photofragmentation efficiency for many experiment directories (e.g. one per compensation voltage) with one shared pool of worker processes.')
+    parser.add_argument('directories', nargs='+', help='experiment directories or glob patterns (quote them), each optionally followed by =<laser power file> for that directory, e.g. "data/CV*" or data/CV-21=power_CV-21.csv')
+    parser.add_argument('--base-peak', required=True, type=parse_base_peak_range, help='lower and upper m/z of the parent ion peak, e.g. 239.0,242.0')
+    parser.add_argument('--fragments', required=True, type=parse_fragment_ion_ranges, help='fragment ion ranges, e.g. "(54.5,57.0),(114.5,116.0)", or auto to detect them from the average spectrum of all the directories, so they are the same for every directory')
+    parser.add_argument('--power-file', default=None, help='glob pattern of the laser power .csv inside each directory (e.g. "powerscan*.csv") for directories that weren\'t given one with =. PE is normalized to laser power when there is one')
+    parser.add_argument('--extract-mzml', action='store_true', help='convert the .wiff files in each directory to .mzML (into directory/mzml_directory) with msconvert first')
+    parser.add_argument('--compression', default='none', choices=list(MZML_COMPRESSIONS), help='encoding of the binary arrays of the .mzML files written by --extract-mzml (default: none)')
+    parser.add_argument('--inten32', action='store_true', help='write 32-bit intensities with --extract-mzml (m/z values stay 64-bit)')
+    parser.add_argument('--mode', default='grid', choices=INTEGRATION_MODES, help='integration mode (default: grid)')
+    parser.add_argument('--cache', action='store_true', help='keep decoded spectra in a cache next to the .mzML files so re-runs skip the XML parsing')
+    parser.add_argument('--cache-results', action='store_true', help='remember the integration of every (file, window) so re-runs only integrate windows that are new or changed')
+    parser.add_argument('--resume', action='store_true', help='resume the last run of each directory from its checkpoint (see --resume of Python.headless)')
+    parser.add_argument('--workers', default=None, type=int, help='number of worker processes shared by all directories (default: number of CPUs)')
+    parser.add_argument('--summary', default=None, help=f'file to write the combined table to (default: {CAMPAIGN_SUMMARY_NAME} in the folder that contains the directories)')
+    add_bootstrap_arguments(parser)
+    return parser
+
+def cli(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        summary_file, outputs = run_campaign(expand_directories(args.directories), args.base_peak, args.fragments, power_file_pattern=args.power_file, integration_mode=args.mode, workers=args.workers,
+                                             extract_mzml=args.extract_mzml, compression=args.compression, intensity_32bit=args.inten32, use_cache=args.cache, cache_results=args.cache_results,
+                                             resume=args.resume, summary_file=args.summary, bootstrap_resamples=args.bootstrap, bootstrap_confidence=args.confidence, bootstrap_seed=args.bootstrap_seed)
+        exit_code = 0 if summary_file is not None and all(output_file is not None for output_file in outputs.values()) else 1
+    except Exception as e:
+        print_output(f'Unexpected error during the campaign: {e}\nTraceback: {traceback.format_exc()}\n')
+        exit_code = 1
+    finally:
+        sys.stdout = sys.__stdout__
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,125 @@
+import os, csv, json, time
+from Python.spectra_store import is_spectra_store, STORE_INDEX_NAME
+
+# Checkpoint of a run of main(), so that a run that stops part way (a bad file, a locked share, a reboot) can be resumed instead of started again.
+# Two files are written next to the photofragmentation efficiency .csv:
+#   photofragmentation_efficiency_manifest.json  - inputs and settings of the run: the mzml files (with their size and modification time), the integration windows,
+#                                                  parent m/z, integration mode, laser power file and the status of the run ('running' or 'complete')
+#   photofragmentation_efficiency_checkpoint.csv - one row per mzml file, appended (and flushed to disk) as soon as the file is integrated:
+#                                                  file, size, modification time, wavelength, then the average integration and stdev of every window (full precision)
+# With main(resume=True), files in the checkpoint that haven't changed since are not integrated again. The settings have to be the same as in the manifest,
+# otherwise the run starts from the beginning (and a new checkpoint replaces the old one).
+
+CHECKPOINT_FORMAT_VERSION = 1
+MANIFEST_NAME = 'photofragmentation_efficiency_manifest.json'
+CHECKPOINT_NAME = 'photofragmentation_efficiency_checkpoint.csv'
+
+def file_signature(directory, mzml_file):
+    '''Size and modification time of an mzml file (of the index of a spectra store, which is rewritten whenever the store is built).'''
+    stat = os.stat(os.path.join(directory, STORE_INDEX_NAME if is_spectra_store(directory) else mzml_file))
+    return stat.st_size, stat.st_mtime_ns
+
+class RunCheckpoint:
+    '''Checkpoint and manifest of a run of main(). Usage is:
+    directory the outputs are written to, directory containing the mzml files (or a spectra store), and the settings that decide the integrations (these must match to resume).
+    Call load() to read the checkpoint of an earlier run, start() once the run begins, add() after each mzml file and finish() once the .csv is written.
+    '''
+    def __init__(self, output_directory, directory, settings):
+        self.manifest_file = os.path.join(output_directory, MANIFEST_NAME)
+        self.checkpoint_file = os.path.join(output_directory, CHECKPOINT_NAME)
+        self.directory = directory
+        self.settings = json.loads(json.dumps(settings)) #tuples become lists, so settings compare equal to the ones read back from the manifest
+        self.manifest = None
+        self.done = {} #mzml file -> (size, modification time, wavelength, window integrations) read from the checkpoint
+
+    def load(self):
+        '''Reads the checkpoint of an earlier run. Returns an empty string if it can be resumed, otherwise the reason why not.'''
+        try:
+            with open(self.manifest_file) as file:
+                manifest = json.load(file)
+        except FileNotFoundError:
+            return f'there is no {MANIFEST_NAME} next to the data'
+        except Exception as e:
+            return f'{self.manifest_file} could not be read ({e})'
+
+        if manifest.get('format_version') != CHECKPOINT_FORMAT_VERSION:
+            return f'{self.manifest_file} was written by a different version'
+        if manifest.get('settings') != self.settings:
+            changed = [name for name in self.settings if manifest.get('settings', {}).get(name) != self.settings[name]]
+            return f'the settings have changed since the last run ({", ".join(changed)})'
+
+        num_windows = len(self.settings['integration_bounds'])
+        done = {}
+        try:
+            with open(self.checkpoint_file, newline='') as file:
+                for row in csv.reader(file):
+                    #the header, and a last row that was cut off when the run stopped, are skipped
+                    if len(row) != 4 + 2 * num_windows or row[0] == 'file':
+                        continue
+                    try:
+                        values = [float(value) for value in row[4:]]
+                        done[row[0]] = (int(row[1]), int(row[2]), float(row[3]), [values[j:j + 2] for j in range(0, len(values), 2)])
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass #the run stopped before the first file was done
+
+        self.manifest = manifest
+        self.done = done
+        return ''
+
+    def completed(self, mzml_file):
+        '''Window integrations of an mzml file from the checkpoint, or None if it wasn't done (or has changed since).'''
+        if mzml_file not in self.done:
+            return None
+        size, mtime_ns, _, window_integrations = self.done[mzml_file]
+        try:
+            if file_signature(self.directory, mzml_file) != (size, mtime_ns):
+                return None
+        except FileNotFoundError:
+            return None
+        return window_integrations
+
+    def start(self, mzml_files, inputs, resume=False):
+        '''Writes the manifest of the run (inputs is a dict of other things to record, e.g. the laser power file) and a new checkpoint file,
+        unless the run resumes, in which case the rows of the files that are still valid are kept.
+        '''
+        kept = {mzml_file: self.done[mzml_file] for mzml_file in mzml_files if resume and self.completed(mzml_file) is not None}
+
+        self.manifest = {'format_version': CHECKPOINT_FORMAT_VERSION, 'status': 'running', 'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+                         'resumed_from': self.manifest['started'] if resume and self.manifest is not None else None, 'directory': os.path.abspath(self.directory),
+                         'settings': self.settings, 'inputs': inputs, 'output_file': None,
+                         'files': {mzml_file: list(file_signature(self.directory, mzml_file)) for mzml_file in mzml_files}}
+        self._write_manifest()
+
+        #write the kept rows to a new file first, so a checkpoint is never lost half way through being rewritten
+        temporary_file = f'{self.checkpoint_file}.{os.getpid()}.tmp'
+        with open(temporary_file, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['file', 'size', 'mtime_ns', 'wavelength'] + [f'window {j} {value}' for j in range(len(self.settings['integration_bounds'])) for value in ('average', 'stdev')])
+            for mzml_file, (size, mtime_ns, wavelength, window_integrations) in kept.items():
+                writer.writerow([mzml_file, size, mtime_ns, repr(wavelength)] + [repr(float(value)) for window_integration in window_integrations for value in window_integration])
+        os.replace(temporary_file, self.checkpoint_file)
+        self.done = kept
+
+    def add(self, mzml_file, wavelength, window_integrations):
+        '''Appends the window integrations of an mzml file to the checkpoint, and makes sure they are on disk before returning.'''
+        size, mtime_ns = file_signature(self.directory, mzml_file)
+        with open(self.checkpoint_file, 'a', newline='') as file:
+            csv.writer(file).writerow([mzml_file, size, mtime_ns, repr(float(wavelength))] + [repr(float(value)) for window_integration in window_integrations for value in window_integration])
+            file.flush()
+            os.fsync(file.fileno())
+        self.done[mzml_file] = (size, mtime_ns, float(wavelength), window_integrations)
+
+    def finish(self, output_file):
+        '''Marks the run as complete in the manifest.'''
+        self.manifest['status'] = 'complete'
+        self.manifest['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.manifest['output_file'] = output_file
+        self._write_manifest()
+
+    def _write_manifest(self):
+        temporary_file = f'{self.manifest_file}.{os.getpid()}.tmp'
+        with open(temporary_file, 'w') as file:
+            json.dump(self.manifest, file, indent=1)
+        os.replace(temporary_file, self.manifest_file)
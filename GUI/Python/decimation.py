@@ -0,0 +1,89 @@
+import os
+import numpy as np
+
+# Min/max decimation pyramids for the spectrum viewer (see viewer.py).
+# A plot is only a few thousand pixels wide, but an averaged spectrum can have tens or hundreds of thousands of m/z points. Drawing every point on every repaint
+# (or picking every n-th point, which drops narrow peaks) doesn't scale, so the minimum and maximum of blocks of PYRAMID_FACTOR, PYRAMID_FACTOR**2, ... m/z points
+# are computed once when the data is loaded. A view then reads the coarsest level that still has at least one value per pixel, so the work per repaint depends
+# on the width of the plot rather than on the size of the m/z grid, and every peak stays visible at any zoom.
+
+PYRAMID_FACTOR = 4
+PYRAMID_MIN_COLUMNS = 256 #levels stop once they are this narrow
+
+def load_raw_data(raw_data_file):
+    '''Reads a raw data file written by extract_RawData. Usage is:
+    Raw_data.csv (one m/z column plus one column per wavelength), or Raw_data.npy (wavelengths x m/z, with the _mz.npy and _wavelengths.npy files next to it - either of those may be given too).
+    Returns the wavelengths (sorted), the m/z axis and the wavelengths x m/z matrix of averaged spectra. The .npy matrix is memory mapped if its rows are already in wavelength order.
+    '''
+    if raw_data_file.endswith('.npy'):
+        base_name = os.path.splitext(raw_data_file)[0]
+        for sidecar in ('_mz', '_wavelengths'):
+            if base_name.endswith(sidecar):
+                base_name = base_name[:-len(sidecar)]
+
+        matrix = np.load(f'{base_name}.npy', mmap_mode='r')
+        mz = np.load(f'{base_name}_mz.npy')
+        wavelengths = np.load(f'{base_name}_wavelengths.npy')
+
+    else:
+        with open(raw_data_file) as file:
+            header = file.readline().strip().split(',')
+        data = np.loadtxt(raw_data_file, delimiter=',', skiprows=1, ndmin=2)
+        mz = data[:, 0]
+        matrix = np.ascontiguousarray(data[:, 1:].T)
+        wavelengths = np.array(header[1:], dtype=float)
+
+    if matrix.ndim != 2 or matrix.shape != (len(wavelengths), len(mz)):
+        raise ValueError(f'{raw_data_file} holds a {" x ".join(map(str, matrix.shape))} matrix, but {len(wavelengths)} wavelengths and {len(mz)} m/z values.')
+
+    #rows are in the order the mzml files were read, which isn't always the wavelength order
+    order = np.argsort(wavelengths, kind='stable')
+    if np.any(order != np.arange(len(order))):
+        matrix = np.asarray(matrix)[order]
+        wavelengths = wavelengths[order]
+    return wavelengths, mz, matrix
+
+class MinMaxPyramid:
+    '''Min/max decimation pyramid of a matrix, along its columns. Usage is:
+    matrix (rows x columns, e.g. wavelengths x m/z - a memory map is read once), the number of columns each level combines into one, and the width at which to stop.
+    Level 0 is the matrix itself, level k holds the minimum and maximum of each block of factor**k columns. Read it with query().
+    '''
+    def __init__(self, matrix, factor=PYRAMID_FACTOR, min_columns=PYRAMID_MIN_COLUMNS):
+        self.num_rows, self.num_columns = matrix.shape
+        self.levels = [(1, matrix, matrix)] #(columns per block, minimum, maximum)
+
+        block = 1
+        level_min = level_max = np.asarray(matrix)
+        while level_min.shape[1] > min_columns:
+            #the last block is padded with copies of its last column, which doesn't change its minimum or maximum
+            padding = (-level_min.shape[1]) % factor
+            if padding > 0:
+                level_min = np.pad(level_min, ((0, 0), (0, padding)), mode='edge')
+                level_max = np.pad(level_max, ((0, 0), (0, padding)), mode='edge')
+
+            level_min = level_min.reshape(self.num_rows, -1, factor).min(axis=2)
+            level_max = level_max.reshape(self.num_rows, -1, factor).max(axis=2)
+            block *= factor
+            self.levels.append((block, level_min, level_max))
+
+    def query(self, start, stop, num_bins, rows=None):
+        '''Minimum and maximum of each row over columns start to stop, in at most num_bins bins. Usage is:
+        first and last (exclusive) column, number of bins (e.g. the width of the plot in pixels), and the rows to return (default: all of them).
+        Returns the column edges of the bins (number of bins + 1, in columns of the matrix), and the minimum and maximum of each row in each bin (rows x bins).
+        Bins are made of whole blocks of the level that is read, so their edges are accurate to a block (fewer columns than a bin).
+        '''
+        start = min(max(int(start), 0), self.num_columns - 1)
+        stop = min(max(int(stop), start + 1), self.num_columns)
+        columns_per_bin = max((stop - start) / max(num_bins, 1), 1.)
+
+        #coarsest level with at least one block per bin
+        block, level_min, level_max = [level for level in self.levels if level[0] <= columns_per_bin][-1]
+        lower, upper = start // block, -(-stop // block)
+
+        edges = np.unique(np.round(np.linspace(lower, upper, min(num_bins, upper - lower) + 1)).astype(np.int64))
+        level_min = np.asarray(level_min[:, lower:upper] if rows is None else level_min[rows, lower:upper])
+        level_max = np.asarray(level_max[:, lower:upper] if rows is None else level_max[rows, lower:upper])
+
+        bin_min = np.minimum.reduceat(level_min, edges[:-1] - lower, axis=1)
+        bin_max = np.maximum.reduceat(level_max, edges[:-1] - lower, axis=1)
+        return np.minimum(edges * block, self.num_columns), bin_min, bin_max
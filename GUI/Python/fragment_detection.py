@@ -0,0 +1,238 @@
+import os, sys, time, argparse, traceback
+import numpy as np
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+from Python.workflows import iter_spectra, list_mzml_files, INTEGRATION_GRID_STEP, INTEGRATION_GRID_MARGIN
+from Python.headless import update_output as print_output, parse_base_peak_range
+
+# Automatic fragment ion windows. Instead of guessing the fragment ion ranges and re-running the whole analysis until they look right, every scan of every .mzML file
+# (of one directory, or of all the directories of a campaign, so they all get the same windows) is added up on the common integration grid in one pass, and the
+# peaks below the base peak range are picked from that averaged spectrum. Each peak gets a window that ends where the peak falls to DETECTION_EDGE_FRACTION of its
+# height (or at the valley to the next peak), rounded outwards to DETECTION_ROUNDING Da. The windows are only a proposal - the GUI puts them in the fragment ion field
+# for review. Run from the GUI directory:
+# python -m Python.fragment_detection <directory> [<directory> ...] --base-peak 239.0,242.0 [--min-height 0.005] [--max-windows 12] [--workers 8]
+# The proposed windows are printed in the format of the fragment ion field (and of --fragments, which also takes "auto" to detect them before the analysis).
+
+DETECTION_MIN_HEIGHT = 0.005      #peaks lower than this fraction of the base peak are ignored
+DETECTION_NOISE_FACTOR = 5.       #... and so are peaks lower than this many times the noise (median absolute deviation of the spectrum below the base peak)
+DETECTION_SMOOTHING = 0.05        #Da either side of each point in the moving average that is applied before picking peaks
+DETECTION_MIN_SEPARATION = 1.0    #Da between two peaks - only the higher one is kept when they are closer
+DETECTION_MAX_HALF_WIDTH = 1.5    #Da either side of the apex a window can reach
+DETECTION_EDGE_FRACTION = 0.02    #a window ends where the peak falls to this fraction of its height
+DETECTION_ROUNDING = 0.1          #Da the bounds are rounded (outwards) to
+DETECTION_MAX_WINDOWS = 12        #only the highest peaks are proposed
+
+def spectrum_sum(mzml_path, parent_mz, use_cache=False):
+    '''Sum of all the scans of an mzml file on the common integration grid (0 to parent m/z + INTEGRATION_GRID_MARGIN in INTEGRATION_GRID_STEP increments). Usage is:
+    path of the mzml file (or of an mzml file in a spectra store), the m/z of the parent ion, and whether to use the on-disk cache of decoded spectra.
+    Returns the summed intensities and the number of scans. Runs in the worker processes when detect_fragment_windows is given a pool.
+    '''
+    max_mz = parent_mz + INTEGRATION_GRID_MARGIN
+    common_mz_grid = np.round(np.linspace(0., max_mz, int(max_mz / INTEGRATION_GRID_STEP + 1)),2)
+    summed_intensity = np.zeros(len(common_mz_grid))
+    num_scans = 0
+
+    with closing(iter_spectra(mzml_path, use_cache=use_cache)) as spectra:
+        for spectrum in spectra:
+            mz = np.asarray(spectrum['m/z array'], dtype=np.float64)
+            intensity = np.asarray(spectrum['intensity array'], dtype=np.float64)
+            if len(mz) != len(intensity):
+                raise ValueError(f'Inconsistent lengths of m/z and intensity values in scan {num_scans + 1} of {os.path.basename(mzml_path)}')
+
+            num_scans += 1
+            if len(mz) == 0:
+                continue
+
+            #scans are nearly always in m/z order already, so only sort the ones that aren't
+            if np.any(mz[1:] < mz[:-1]):
+                sort_indices = np.argsort(mz, kind='stable')
+                mz = mz[sort_indices]
+                intensity = intensity[sort_indices]
+
+            #zero outside the m/z range of the scan, like the padding in integrate_spectra_multi (only the position of the peaks matters here)
+            summed_intensity += np.interp(common_mz_grid, mz, intensity, left=0., right=0.)
+
+    return summed_intensity, num_scans
+
+def average_spectrum(mzml_paths, parent_mz, update_output=None, use_cache=False, executor=None, cancel_event=None):
+    '''Average of every scan of every mzml file given, on the common integration grid - each file is read once. Usage is:
+    list of mzml file paths, the m/z of the parent ion, whether to use the on-disk cache of decoded spectra, a pool of worker processes to read the files in (None reads them here, one after the other),
+    and a threading.Event that stops the pass early.
+    Returns the m/z grid, the averaged intensities and the number of scans, or None if it was cancelled.
+    '''
+    update_output = update_output or print
+    max_mz = parent_mz + INTEGRATION_GRID_MARGIN
+    common_mz_grid = np.round(np.linspace(0., max_mz, int(max_mz / INTEGRATION_GRID_STEP + 1)),2)
+    summed_intensity = np.zeros(len(common_mz_grid))
+    num_scans = 0
+
+    if executor is not None:
+        futures = [executor.submit(spectrum_sum, mzml_path, parent_mz, use_cache) for mzml_path in mzml_paths]
+        results = (future.result() for future in futures)
+    else:
+        results = (spectrum_sum(mzml_path, parent_mz, use_cache) for mzml_path in mzml_paths)
+
+    for i, (file_sum, file_scans) in enumerate(results):
+        if cancel_event is not None and cancel_event.is_set():
+            if executor is not None:
+                for future in futures:
+                    future.cancel()
+            update_output('The fragment window detection was cancelled.\n')
+            return None
+
+        summed_intensity += file_sum
+        num_scans += file_scans
+        if (i + 1) % 25 == 0 or i + 1 == len(mzml_paths):
+            update_output(f'{i + 1} of {len(mzml_paths)} files summed.\n')
+
+    if num_scans == 0:
+        raise ValueError('The .mzML files contain no scans.')
+    return common_mz_grid, summed_intensity / num_scans, num_scans
+
+def pick_fragment_peaks(mz, intensity, base_peak_range, min_height=DETECTION_MIN_HEIGHT, noise_factor=DETECTION_NOISE_FACTOR, smoothing=DETECTION_SMOOTHING,
+                        min_separation=DETECTION_MIN_SEPARATION, max_half_width=DETECTION_MAX_HALF_WIDTH, edge_fraction=DETECTION_EDGE_FRACTION, rounding=DETECTION_ROUNDING,
+                        max_windows=DETECTION_MAX_WINDOWS):
+    '''Picks the fragment peaks of an averaged spectrum and proposes an integration window for each. Usage is:
+    m/z grid (evenly spaced, in increasing order), averaged intensities, base peak range [lower, upper], and the detection settings (see the DETECTION_ constants).
+    Only peaks below the lower end of the base peak range are picked. Returns a list of dicts with the apex m/z, the window (lower, upper), and the height and area of the peak
+    relative to the base peak, sorted by m/z. The list is empty if there is no base peak or no fragment peak.
+    '''
+    step = mz[1] - mz[0]
+
+    #moving average, so that a peak split by noise is picked once
+    smoothing_points = max(int(round(smoothing / step)), 0)
+    smoothed = np.convolve(intensity, np.ones(2*smoothing_points + 1) / (2*smoothing_points + 1), mode='same')
+
+    base_filter = (mz >= base_peak_range[0]) & (mz <= base_peak_range[1])
+    base_height = smoothed[base_filter].max() if np.any(base_filter) else 0.
+    if base_height <= 0:
+        return []
+
+    #peaks must stand out from the noise below the base peak as well as reach min_height of the base peak
+    region = mz < base_peak_range[0]
+    noise = 1.4826 * np.median(np.abs(smoothed[region] - np.median(smoothed[region])))
+    threshold = max(min_height * base_height, noise_factor * noise)
+
+    #a peak is the highest point within min_separation on both sides (the base peak is in the comparison too, so its tail isn't picked)
+    separation_points = max(int(round(min_separation / step)), 1)
+    padded = np.pad(smoothed, separation_points, constant_values=-np.inf)
+    local_max = np.lib.stride_tricks.sliding_window_view(padded, 2*separation_points + 1).max(axis=1)
+    apex_indices = np.flatnonzero((smoothed == local_max) & (smoothed >= threshold) & (smoothed > 0) & region)
+
+    #a flat top gives several equal maxima - keep the first of them
+    if len(apex_indices) > 0:
+        apex_indices = apex_indices[np.diff(apex_indices, prepend=-separation_points - 1) > separation_points]
+    if len(apex_indices) == 0:
+        return []
+    heights = smoothed[apex_indices]
+
+    #each window ends at the last point below edge_fraction of the height within max_half_width of the apex (or at max_half_width when the peak doesn't fall that far)
+    half_width_points = max(int(round(max_half_width / step)), 1)
+    offsets = np.arange(-half_width_points, half_width_points + 1)
+    segments = smoothed[np.clip(apex_indices[:, None] + offsets, 0, len(smoothed) - 1)]
+    low = segments <= edge_fraction * heights[:, None]
+
+    left_low = low[:, :half_width_points + 1][:, ::-1] #from the apex going down in m/z
+    right_low = low[:, half_width_points:]
+    lower_indices = apex_indices - np.where(left_low.any(axis=1), np.argmax(left_low, axis=1), half_width_points)
+    upper_indices = apex_indices + np.where(right_low.any(axis=1), np.argmax(right_low, axis=1), half_width_points)
+    lower_indices = np.maximum(lower_indices, 0)
+    upper_indices = np.minimum(upper_indices, np.searchsorted(mz, base_peak_range[0], side='left') - 1)
+
+    #... and never past the lowest point between it and the next peak
+    valley_indices = np.array([start + np.argmin(smoothed[start:stop + 1]) for start, stop in zip(apex_indices[:-1], apex_indices[1:])], dtype=np.int64)
+    upper_indices[:-1] = np.minimum(upper_indices[:-1], valley_indices)
+    lower_indices[1:] = np.maximum(lower_indices[1:], valley_indices)
+
+    #bounds are rounded outwards, but not past a valley or into the base peak range
+    lower_bounds = np.round(np.floor(mz[lower_indices] / rounding + 1e-9) * rounding, 2)
+    upper_bounds = np.round(np.ceil(mz[upper_indices] / rounding - 1e-9) * rounding, 2)
+    lower_bounds[1:] = np.maximum(lower_bounds[1:], mz[valley_indices])
+    upper_bounds[:-1] = np.minimum(upper_bounds[:-1], mz[valley_indices])
+    upper_bounds = np.minimum(upper_bounds, np.round(base_peak_range[0], 2))
+
+    #areas relative to the base peak, from the unsmoothed spectrum
+    cumulative = np.concatenate(([0.], np.cumsum(intensity)))
+    base_area = intensity[base_filter].sum()
+    areas = (cumulative[upper_indices + 1] - cumulative[lower_indices]) / base_area
+
+    #the highest peaks are proposed, in m/z order
+    selected = np.sort(np.argsort(-heights, kind='stable')[:max_windows])
+    return [{'apex': float(mz[apex_indices[k]]), 'lower': float(lower_bounds[k]), 'upper': float(upper_bounds[k]),
+             'height': float(heights[k] / base_height), 'area': float(areas[k])} for k in selected]
+
+def format_fragment_ion_ranges(peaks):
+    '''Text for the GUI's fragment ion field (and --fragments) from the peaks returned by pick_fragment_peaks, e.g. (54.50,57.00),(114.50,116.00)'''
+    return ','.join(f'({peak["lower"]:.2f},{peak["upper"]:.2f})' for peak in peaks)
+
+def detect_fragment_windows(directories, base_peak_range, update_output=None, use_cache=False, executor=None, cancel_event=None, **detection_settings):
+    '''Proposes fragment ion windows from the average spectrum of all the .mzML files in one or more directories. Usage is:
+    list of directories with .mzML files (or spectra stores), base peak range [lower, upper], whether to use the on-disk cache of decoded spectra, a pool of worker processes
+    (or None), a threading.Event to cancel, and any of the settings of pick_fragment_peaks (e.g. min_height=0.01, max_windows=6).
+    Returns the list of peaks from pick_fragment_peaks (the fragment ion ranges are [[peak['lower'], peak['upper']], ...]), or None if there was a problem (the reason has been passed to update_output).
+    '''
+    update_output = update_output or print
+    start_time = time.time()
+
+    mzml_paths = []
+    for directory in directories:
+        if not os.path.isdir(directory):
+            update_output(f'The directory {directory} does not exist. Please provide a valid file path.\n')
+            return None
+        mzml_paths += [os.path.join(directory, mzml_file) for mzml_file in sorted(list_mzml_files(directory))]
+
+    if len(mzml_paths) == 0:
+        update_output(f'There are no .mzML files in {", ".join(directories)} to detect fragment windows from.\n')
+        return None
+
+    parent_mz = (np.round(np.average(base_peak_range),2))  # get parent mass - needed for the upper end of mz window for interpolation
+    update_output(f'Detecting fragment windows from the average spectrum of {len(mzml_paths)} .mzML files...\n')
+    try:
+        spectrum = average_spectrum(mzml_paths, parent_mz, update_output=update_output, use_cache=use_cache, executor=executor, cancel_event=cancel_event)
+        if spectrum is None:
+            return None
+        mz, intensity, num_scans = spectrum
+        peaks = pick_fragment_peaks(mz, intensity, base_peak_range, **detection_settings)
+    except Exception as e:
+        update_output(f'There was a problem detecting the fragment windows: {e}\nTraceback: {traceback.format_exc()}\n')
+        return None
+
+    if len(peaks) == 0:
+        update_output(f'No fragment peaks were found below m/z {base_peak_range[0]} in {num_scans} scans (or there is no base peak between {base_peak_range[0]} and {base_peak_range[1]}).\n')
+        return None
+
+    update_output(f'{len(peaks)} fragment windows were found in {num_scans} scans in {np.round(time.time() - start_time, 2)} seconds:\n')
+    update_output('  apex m/z   window            height   area (relative to the base peak)\n')
+    for peak in peaks:
+        update_output(f'  {peak["apex"]:8.2f}   {peak["lower"]:7.2f}-{peak["upper"]:<7.2f}   {100*peak["height"]:5.1f}%   {100*peak["area"]:5.1f}%\n')
+    return peaks
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m Python.fragment_detection', description='Proposes fragment ion windows from the average spectrum of all the .mzML files in one or more directories.')
+    parser.add_argument('directories', nargs='+', help='directories that contain the .mzML files (or spectra stores). Give all the directories of a campaign to get the same windows for all of them')
+    parser.add_argument('--base-peak', required=True, type=parse_base_peak_range, help='lower and upper m/z of the parent ion peak, e.g. 239.0,242.0')
+    parser.add_argument('--min-height', default=DETECTION_MIN_HEIGHT, type=float, help=f'ignore peaks lower than this fraction of the base peak (default: {DETECTION_MIN_HEIGHT})')
+    parser.add_argument('--max-windows', default=DETECTION_MAX_WINDOWS, type=int, help=f'propose at most this many windows, for the highest peaks (default: {DETECTION_MAX_WINDOWS})')
+    parser.add_argument('--cache', action='store_true', help='keep decoded spectra in a cache next to the .mzML files so re-runs skip the XML parsing')
+    parser.add_argument('--workers', default=1, type=int, help='number of worker processes to read the files with (default: 1)')
+    return parser
+
+def cli(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        if args.workers > 1:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                peaks = detect_fragment_windows(args.directories, args.base_peak, update_output=print_output, use_cache=args.cache, executor=executor, min_height=args.min_height, max_windows=args.max_windows)
+        else:
+            peaks = detect_fragment_windows(args.directories, args.base_peak, update_output=print_output, use_cache=args.cache, min_height=args.min_height, max_windows=args.max_windows)
+    except Exception as e:
+        print_output(f'Unexpected error during the fragment window detection: {e}\nTraceback: {traceback.format_exc()}\n')
+        return 1
+
+    if peaks is None:
+        return 1
+    print_output(f'\n--fragments "{format_fragment_ion_ranges(peaks)}"\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,209 @@
+import os, sys, time, argparse, traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from Python.workflows import convert_wiff_files_to_mzml, verify_mzml_compression, extract_RawData, INTEGRATION_MODES, RAW_DATA_FORMATS, MZML_COMPRESSIONS
+from Python.main import main
+from Python.spectra_store import build_spectra_store
+from Python.watch import watch_directory
+from Python.bootstrap import BOOTSTRAP_CONFIDENCE
+
+# Headless entry point - runs the same pipeline as the GUI's "Analyze spectra" button without importing PyQt5. Run from the GUI directory:
+# python -m Python.headless <directory> --base-peak 239.0,242.0 --fragments "(54.5,57.0),(114.5,116.0)" [--power-file powerdata.csv] [--extract-mzml] [--raw-data] [--mode native] [--build-store] [--cache] [--cache-results] [--profile] [--cprofile] [--workers 8] [--bootstrap 2000]
+# With --watch the directory is watched during the experiment and each new file is processed as it is acquired, until Ctrl+C (or --idle-timeout).
+# Exits with 0 when the photofragmentation efficiency .csv was written and 1 otherwise.
+
+def update_output(text):
+    '''Prints pipeline output straight to the terminal (main() and workflows.py redirect sys.stdout, so use the original one).'''
+    sys.__stdout__.write(text)
+    sys.__stdout__.flush()
+
+def parse_base_peak_range(text):
+    '''Parses the base peak range in the same format as the GUI, e.g. 239.0,242.0'''
+    try:
+        base_peak_range = list(map(float, text.replace(' ','').strip().split(',')))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Base peak input contains non-numeric characters!')
+
+    if len(base_peak_range) != 2:
+        raise argparse.ArgumentTypeError(f'The base peak range must be exactly two comma separated numbers, but {len(base_peak_range)} were given.')
+    return base_peak_range
+
+def parse_fragment_ion_ranges(text):
+    '''Parses the fragment ion ranges in the same format as the GUI, e.g. (54.5,57.0),(114.5,116.0), or "auto" to detect them from the data (returned as is, see fragment_detection.py)'''
+    fragment_ion_input = text.replace(' ','').strip()
+    if fragment_ion_input.lower() == 'auto':
+        return 'auto'
+    if '(' not in fragment_ion_input or ')' not in fragment_ion_input:
+        raise argparse.ArgumentTypeError('No brackets were found in the fragment peak range input. Please use the format (lower,upper),(lower,upper),...')
+
+    try:
+        fragment_ion_ranges = [list(map(float, pair.strip('()').split(','))) for pair in fragment_ion_input.split('),(')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Fragment peak input likely contains non-numeric characters.')
+
+    if any(len(pair) != 2 for pair in fragment_ion_ranges):
+        raise argparse.ArgumentTypeError('Each fragment ion range (ie. the contents within each bracket) must be exactly two numbers separated by a comma.')
+    return fragment_ion_ranges
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m Python.headless', description='Calculates UVPD photofragmentation efficiency from a directory of .mzML (or .wiff) files without the GUI.')
+    parser.add_argument('directory', help='directory that contains the .mzML files (or a spectra store), or the .wiff files when --extract-mzml is used')
+    parser.add_argument('--base-peak', required=True, type=parse_base_peak_range, help='lower and upper m/z of the parent ion peak, e.g. 239.0,242.0')
+    parser.add_argument('--fragments', required=True, type=parse_fragment_ion_ranges, help='fragment ion ranges, e.g. "(54.5,57.0),(114.5,116.0)", or auto to detect them from the average spectrum of all the .mzML files first (see Python.fragment_detection)')
+    parser.add_argument('--power-file', default=None, help='laser power .csv (Wavelength, LaserPower, PowerStdDev). PE is normalized to laser power when given')
+    parser.add_argument('--extract-mzml', action='store_true', help='convert the .wiff files in the directory to .mzML (into directory/mzml_directory) with msconvert first')
+    parser.add_argument('--compression', default='none', choices=list(MZML_COMPRESSIONS), help='encoding of the binary arrays of the .mzML files written by --extract-mzml: none, zlib (lossless), or numpress-linear/-pic/-slof (lossy, smallest). '
+                        'The first file is checked against an uncompressed conversion (default: none)')
+    parser.add_argument('--inten32', action='store_true', help='write 32-bit intensities with --extract-mzml (m/z values stay 64-bit)')
+    parser.add_argument('--raw-data', action='store_true', help='also write the averaged mass spectrum of every wavelength to Raw_data.csv')
+    parser.add_argument('--raw-data-format', default='csv', choices=RAW_DATA_FORMATS, help='format of the raw data file: csv (Raw_data.csv) or npy (memory-mapped Raw_data.npy plus _mz.npy and _wavelengths.npy sidecar arrays)')
+    parser.add_argument('--mode', default='grid', choices=INTEGRATION_MODES, help='integration mode (default: grid)')
+    parser.add_argument('--build-store', action='store_true', help='consolidate the .mzML files into a columnar spectra store (<mzml directory>_store) first and analyze from it. The directory may also be an existing store')
+    parser.add_argument('--cache', action='store_true', help='keep decoded spectra in a cache next to the .mzML files so re-runs skip the XML parsing')
+    parser.add_argument('--cache-results', action='store_true', help='remember the integration of every (file, window) so re-runs only integrate windows that are new or changed')
+    parser.add_argument('--profile', action='store_true', help='write a run profile (time spent parsing, padding/sorting, interpolating and integrating each file, PE calculation, .csv writing and peak memory) next to the .csv as <name>_profile.json and <name>_profile.csv')
+    parser.add_argument('--cprofile', action='store_true', help='also write a cProfile dump of the run next to the .csv as <name>.prof (worker processes are not included)')
+    parser.add_argument('--resume', action='store_true', help='resume the last run on this directory: .mzML files that it already integrated (see photofragmentation_efficiency_checkpoint.csv next to the data) are skipped. The settings must be the same')
+    parser.add_argument('--watch', action='store_true', help='live acquisition mode: keep watching the directory and process each new .mzML (or .wiff with --extract-mzml) file as soon as it is complete, appending its row to the .csv. Stop with Ctrl+C')
+    parser.add_argument('--poll-interval', default=5., type=float, help='seconds between checks of the directory in --watch mode (default: 5)')
+    parser.add_argument('--idle-timeout', default=None, type=float, help='stop --watch mode when no file has been added or changed for this many seconds')
+    parser.add_argument('--workers', default=1, type=int, help='number of worker processes for .wiff conversion and integration (default: 1)')
+    add_bootstrap_arguments(parser)
+    return parser
+
+def add_bootstrap_arguments(parser):
+    '''Adds the options of the bootstrap confidence intervals (see bootstrap.py) to a parser - shared with Python.campaign.'''
+    parser.add_argument('--bootstrap', default=0, type=int, metavar='RESAMPLES', help='also write bootstrap confidence intervals of every PE value, from this many resamples of the scans of each .mzML file '
+                        '(e.g. 2000, default: 0 = off). Every file is integrated, as the checkpoint and result cache don\'t keep the integral of each scan')
+    parser.add_argument('--bootstrap-seed', default=None, type=int, help='seed of the bootstrap resamples, to get the same intervals again (default: a new seed, which is printed)')
+    parser.add_argument('--confidence', default=BOOTSTRAP_CONFIDENCE, type=float, help=f'confidence level of the bootstrap intervals (default: {BOOTSTRAP_CONFIDENCE})')
+
+def run(args):
+    '''Runs the pipeline for parsed command line arguments. Returns the exit code.'''
+    start_time = time.time()
+    directory = args.directory
+
+    if not os.path.isdir(directory):
+        update_output(f'The directory {directory} does not exist. Please provide a valid file path.\n')
+        return 1
+
+    if args.power_file is not None and not os.path.isfile(args.power_file):
+        update_output(f'The power data file {args.power_file} could not be found.\n')
+        return 1
+
+    if args.watch:
+        return run_watch(args)
+
+    mzml_directory = directory
+    if args.extract_mzml:
+        mzml_directory = os.path.join(directory, 'mzml_directory')
+        wiff_files = [f for f in os.listdir(directory) if f.endswith('.wiff')]
+
+        if len(wiff_files) == 0:
+            update_output(f'There are no .wiff files present in {directory} to extract!\n')
+            return 1
+
+        #resuming a run that extracted the .wiff files uses the .mzML files it already wrote - the integrations that were done are in its checkpoint
+        if args.resume and os.path.isdir(mzml_directory):
+            update_output(f'Resuming the last run: the .wiff files are not extracted again, the .mzML files already in {mzml_directory} are used.\n')
+
+        else:
+            try:
+                os.mkdir(mzml_directory)
+            except FileExistsError:
+                update_output(f'{mzml_directory} already exists. To prevent overwriting files / combining incorrect data, delete it or run without --extract-mzml.\n')
+                return 1
+
+            try:
+                convert_wiff_files_to_mzml(wiff_files, directory, mzml_directory, max_concurrent=args.workers, update_output=update_output, compression=args.compression, intensity_32bit=args.inten32)
+            except Exception as e:
+                update_output(f'There was a problem extracting the .wiff files: {e}\n')
+                return 1
+
+            #lossy encodings are checked against the uncompressed conversion of one file before the results are trusted
+            if args.compression != 'none' or args.inten32:
+                try:
+                    if not verify_mzml_compression(sorted(wiff_files)[0], directory, mzml_directory, args.compression, args.inten32, update_output=update_output):
+                        update_output('The compressed .mzML files differ too much from the uncompressed data. Please convert them again with a lossless --compression (none or zlib).\n')
+                        return 1
+                except Exception as e:
+                    update_output(f'There was a problem checking the compressed .mzML files: {e}\n')
+                    return 1
+
+    if args.build_store:
+        try:
+            mzml_directory = build_spectra_store(mzml_directory, update_output=update_output)
+        except Exception as e:
+            update_output(f'There was a problem building the spectra store: {e}\n')
+            return 1
+
+    fragment_ion_ranges = args.fragments
+    if fragment_ion_ranges == 'auto':
+        from Python.fragment_detection import detect_fragment_windows, format_fragment_ion_ranges #only needed for auto, and it imports this module
+
+        if args.workers > 1:
+            with ProcessPoolExecutor(max_workers=args.workers) as executor:
+                peaks = detect_fragment_windows([mzml_directory], args.base_peak, update_output=update_output, use_cache=args.cache, executor=executor)
+        else:
+            peaks = detect_fragment_windows([mzml_directory], args.base_peak, update_output=update_output, use_cache=args.cache)
+        if peaks is None:
+            return 1
+
+        fragment_ion_ranges = [[peak['lower'], peak['upper']] for peak in peaks]
+        update_output(f'Using the detected fragment ion ranges --fragments "{format_fragment_ion_ranges(peaks)}"\n')
+
+    output_file = main(mzml_directory, args.base_peak, fragment_ion_ranges, args.power_file, update_output=update_output, integration_mode=args.mode, workers=args.workers, use_cache=args.cache, cache_results=args.cache_results, run_profile=args.profile, cprofile=args.cprofile, resume=args.resume,
+                       bootstrap_resamples=args.bootstrap, bootstrap_confidence=args.confidence, bootstrap_seed=args.bootstrap_seed)
+    if output_file is None:
+        return 1
+
+    if args.raw_data:
+        rawdata_file_name = os.path.join(directory,f'Raw_data.{args.raw_data_format}')
+
+        #mechanism to prevent overwriting existing output files
+        index = 0
+        while os.path.exists(rawdata_file_name):
+            index += 1
+            rawdata_file_name = os.path.join(directory,f'Raw_data_{index}.{args.raw_data_format}')
+
+        parent_mz = (np.round(np.average(args.base_peak), 2))  # get parent mass - needed for the upper end of mz window for interpolation
+        if not extract_RawData(mzml_directory, parent_mz, rawdata_file_name, update_output=update_output, use_cache=args.cache, output_format=args.raw_data_format):
+            return 1
+
+    run_time = np.round((time.time() - start_time)/60,1)
+    update_output(f'UVPD photofragmentation efficiency calculation has completed in {run_time} minutes.\n')
+    return 0
+
+def run_watch(args):
+    '''Runs the live acquisition mode for parsed command line arguments. Returns the exit code.'''
+    if args.raw_data or args.build_store or args.bootstrap > 0:
+        update_output('--raw-data, --build-store and --bootstrap are not available in --watch mode; run them on the finished directory instead.\n')
+        return 1
+
+    if args.fragments == 'auto':
+        update_output('--fragments auto is not available in --watch mode, as the files aren\'t there yet. Detect the windows on an earlier run with python -m Python.fragment_detection instead.\n')
+        return 1
+
+    try:
+        output_file = watch_directory(args.directory, args.base_peak, args.fragments, args.power_file, update_output=update_output, integration_mode=args.mode, extract_mzml_from_wiff=args.extract_mzml,
+                                      use_cache=args.cache, cache_results=args.cache_results, poll_interval=args.poll_interval, idle_timeout=args.idle_timeout,
+                                      compression=args.compression, intensity_32bit=args.inten32)
+    except KeyboardInterrupt:
+        update_output('\nStopped watching. The rows written so far have been kept.\n')
+        return 0
+
+    return 0 if output_file is not None else 1
+
+def cli(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        exit_code = run(args)
+    except Exception as e:
+        update_output(f'Unexpected error during the analysis: {e}\nTraceback: {traceback.format_exc()}\n')
+        exit_code = 1
+    finally:
+        sys.stdout = sys.__stdout__ #main() and workflows.py leave sys.stdout redirected
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,62 @@
+import io, os, sys, threading
+
+# Output of the pipeline. Everything is reported with update_output(text), and print() is sent the same way by redirect_stdout (the pipeline was written with prints).
+# The GUI doesn't write each message into its output window straight away: messages go into a LogSink, which keeps them until the GUI's timer collects them
+# (several times a second), and appends everything to a log file as well. Repainting the output window once per batch instead of once per message keeps verbose runs fast.
+
+class TextRedirect(io.TextIOBase):
+    '''Stream that sends everything written to it to update_output(text) (nothing is kept).'''
+    def __init__(self, textWritten=None):
+        super().__init__()
+        self.update_output = textWritten
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.update_output(text)
+        return len(text)
+
+def redirect_stdout(update_output):
+    '''Sends print() output to update_output. sys.stdout is only replaced if it doesn't already go there.'''
+    if not (isinstance(sys.stdout, TextRedirect) and sys.stdout.update_output == update_output):
+        sys.stdout = TextRedirect(textWritten=update_output)
+
+class LogSink:
+    '''Thread-safe buffer for messages on their way to the GUI's output window, which also writes them to a log file. Usage is:
+    log file to append every message to (None for no file). Call write(text) from any thread, and drain() from the GUI thread to get the text written since the last drain().
+    '''
+    def __init__(self, log_file=None):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.log_file = log_file
+        self.file = None
+        self.file_error = None
+
+        if log_file is not None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+                self.file = open(log_file, 'a', encoding='utf-8')
+            except OSError as e:
+                self.file_error = e #the output window still works without the log file
+
+    def write(self, text):
+        with self.lock:
+            self.pending.append(text)
+            if self.file is not None:
+                self.file.write(text)
+
+    def drain(self):
+        '''Returns the text written since the last call (an empty string if there is none), and flushes the log file.'''
+        with self.lock:
+            text = ''.join(self.pending)
+            self.pending = []
+            if self.file is not None and text:
+                self.file.flush()
+        return text
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -1,69 +1,152 @@
-import os, re, time, sys, traceback
+import os, re, time, traceback, cProfile
 import numpy as np
-from Python.workflows import integrate_spectra, PE_calc, PE_calc_noNorm
-from PyQt5.QtWidgets import QApplication
-from io import StringIO
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+from Python.workflows import integrate_spectra_multi, list_mzml_files, PE_calc_array, PE_calc_noNorm_array
+from Python.result_cache import IntegrationResultCache
+from Python.profiling import RunProfile, StageTimer
+from Python.checkpoint import RunCheckpoint
+from Python.log import redirect_stdout
+from Python.bootstrap import bootstrap_PE, bootstrap_column_names, new_seed, BOOTSTRAP_CONFIDENCE
+
+def integrate_mzml_file(directory, mzml_file, integration_bounds_list, parent_mz, integration_mode='grid', use_cache=False, update_output=None, return_scans=False):
+    '''Integrates every window of a single mzml file and times it. Runs either in the GUI process or in a worker process of the pool in main(). Usage is:
+    directory containing mzml files, name of mzml file, list of integration bounds (base peak first), m/z of the parent ion, the integration mode, whether to use the on-disk cache of decoded spectra,
+    and whether to keep the integral of every scan (for the bootstrap, see bootstrap.py).
+    Returns the list of [average integration, stdev] for each window, the runtime in seconds, the time spent in each stage (StageTimer.as_dict(), plus the unrounded runtime as 'total'),
+    the integrals of each scan (scans x windows - None without return_scans), and the messages printed in a worker process (e.g. a spectra cache that couldn't be written).
+    '''
+    mzml_start_time = time.time() #timer to keep track of mzml processing
+    stage_timer = StageTimer()
+
+    #worker processes can't talk to the GUI, so anything they want to print is collected and sent back with the results (or with the error)
+    messages = []
+    scan_integrals = None
+    try:
+        window_integrations = integrate_spectra_multi(directory, mzml_file, integration_bounds_list, parent_mz, update_output=update_output or messages.append, integration_mode=integration_mode, use_cache=use_cache,
+                                                      stage_timer=stage_timer, return_scans=return_scans)
+        if return_scans:
+            window_integrations, scan_integrals = window_integrations
+    except Exception as e:
+        raise Exception(f'{"".join(messages)}{e}')
 
-class TextRedirect(StringIO):
-    def __init__(self, textWritten=None, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.update_output = textWritten
+    timings = stage_timer.as_dict()
+    timings['total'] = time.time() - mzml_start_time
+    return window_integrations, np.round(timings['total'],2), timings, scan_integrals, ''.join(messages)
 
-    def write(self, text):
-        super().write(text)
-        self.update_output(text)
+def PE_column_names(fragment_ion_ranges):
+    '''Column names of the photofragmentation efficiency table, labelled with the central m/z of each fragment ion range.'''
+    column_names = ['Wavelength', 'Total PE', 'Total PE stdev']
 
-# Main function (aka where the magic happens)
-def main(directory, base_peak_range, fragment_ion_ranges, power_data_file_name, update_output=None):
+    #Alternate labels for Frag PE and Frag PE stdev
+    for frag_ion_range in fragment_ion_ranges:
+        frag_mz = np.round(np.average(frag_ion_range),0)
+        column_names.extend([f'PE mz {frag_mz}', f'PE mz {frag_mz} stdev'])
+    return column_names
+
+def calculate_PE_matrix(wavelengths, laser_power, power_stdev, base_peaks, fragment_peaks, PE_function, update_output=None, fragment_ion_ranges=None):
+    '''Calculates the photofragmentation efficiency of every mzml file (ie. every wavelength) and every fragment ion at once. Usage is:
+    wavelengths, laser power and its stdev (one per wavelength), [average integration, stdev] of the base peak (wavelengths x 2) and of each fragment ion peak (wavelengths x fragment ions x 2),
+    PE_calc_array or PE_calc_noNorm_array, and the fragment ion ranges (only used to name the channels in error messages).
+    Returns the photofragmentation efficiency table (wavelengths x columns, see PE_column_names). Values that can't be calculated (division by zero) are nan.
+    '''
+    base_peaks = np.asarray(base_peaks, dtype=float).reshape(-1, 2)
+    fragment_peaks = np.asarray(fragment_peaks, dtype=float).reshape(len(base_peaks), -1, 2)
+    num_fragment_ions = fragment_peaks.shape[1]
+
+    '''Step 4.3: Total fragment ion integration'''
+    #Since total PE is not the sum of the PE from all fragment channels, we need the total integration of all fragment ion peaks and their stdevs
+    total_fragment_ion_integration = np.sum(fragment_peaks[:, :, 0], axis=1)
+
+    #propagate stdev of each fragment ion uncertainty together. Since its jsut addition, proparation is the square root of the sum of squares
+    total_fragment_ion_integration_stdev = np.sqrt(np.sum(np.square(fragment_peaks[:, :, 1]), axis=1))
+
+    '''Step4.4: Compute the total photofragmentation efficiency and the PE of each fragment ion in one go - the first channel is the total, followed by each fragment ion'''
+    Frag = np.column_stack([total_fragment_ion_integration, fragment_peaks[:, :, 0]])
+    dFrag = np.column_stack([total_fragment_ion_integration_stdev, fragment_peaks[:, :, 1]])
+    channel_names = ['total PE'] + [f'PE mz {np.round(np.average(fragment_ion_range),0)}' for fragment_ion_range in fragment_ion_ranges] if fragment_ion_ranges is not None else None
+
+    PE, PE_stdev = PE_function(wavelengths, laser_power, power_stdev, base_peaks[:, 0], base_peaks[:, 1], Frag, dFrag, update_output=update_output, channel_names=channel_names) # W, P, dP, Par, dPar, Frag, dFrag
+
+    PE_data = np.empty(shape=(len(base_peaks), num_fragment_ions * 2 + 3), dtype=float)
+    PE_data[:, 0] = wavelengths #wavelengths in first column
+    PE_data[:, 1] = PE[:, 0] # Store total_efficiency in the second column
+    PE_data[:, 2] = PE_stdev[:, 0] # Store total_efficiency stdev in the third column       
+    PE_data[:, 3::2] = PE[:, 1:] # Store fragment ion efficiency in the 4, 6, 8, 10, .... columns
+    PE_data[:, 4::2] = PE_stdev[:, 1:] # Store fragment ion efficiency stdev in the 5, 7, 9, 11, .... columns
+    return PE_data
+
+def calculate_PE_row(wavelength, laser_power, power_stdev, base_peak, fragment_peaks, PE_function, update_output=None, fragment_ion_ranges=None):
+    '''Calculates the photofragmentation efficiency of one mzml file (ie. one wavelength). Usage is the same as calculate_PE_matrix, for a single wavelength.
+    Returns one row of the photofragmentation efficiency table (see PE_column_names).
+    '''
+    return calculate_PE_matrix([wavelength], [laser_power], [power_stdev], [base_peak], [fragment_peaks], PE_function, update_output=update_output, fragment_ion_ranges=fragment_ion_ranges)[0]
+
+# Main function (aka where the magic happens). Returns the name of the .csv file written, or None if the run failed or was cancelled.
+# cancel_event (a threading.Event) is checked between mzml files, and progress_callback(files done, total files) is called after each one.
+# With cache_results, integrations of windows that haven't changed since the last run are taken from the result cache (see result_cache.py).
+# With run_profile, the time spent in each stage of each file and the peak memory are written next to the .csv (see profiling.py), and with cprofile a cProfile dump (<name>.prof) of this process.
+# The integrations of each mzml file are appended to a checkpoint next to the .csv as soon as the file is done. With resume, files that an earlier run with the same settings
+# already integrated are taken from the checkpoint (see checkpoint.py).
+# executor is a pool of worker processes shared with other runs (see campaign.py) - it is used in place of a pool of its own and is left running. The .csv and checkpoint
+# are written to output_directory, which defaults to the directory that contains the mzml directory.
+# With bootstrap_resamples > 0, the integral of every scan is kept and bootstrap confidence intervals (at bootstrap_confidence) of every PE value are written as extra columns
+# (see bootstrap.py). bootstrap_seed makes them reproducible - a run without one picks a seed and reports it.
+def main(directory, base_peak_range, fragment_ion_ranges, power_data_file_name, update_output=None, integration_mode='grid', workers=1, cancel_event=None, progress_callback=None, use_cache=False, cache_results=False,
+         run_profile=False, cprofile=False, resume=False, executor=None, output_directory=None, bootstrap_resamples=0, bootstrap_confidence=BOOTSTRAP_CONFIDENCE, bootstrap_seed=None):
+
+    #run the whole thing under cProfile, and put the dump next to the .csv (worker processes are not included)
+    if cprofile:
+        profiler = cProfile.Profile()
+        output_file = profiler.runcall(main, directory, base_peak_range, fragment_ion_ranges, power_data_file_name, update_output, integration_mode, workers, cancel_event, progress_callback, use_cache, cache_results, run_profile,
+                                       resume=resume, executor=executor, output_directory=output_directory, bootstrap_resamples=bootstrap_resamples,
+                                       bootstrap_confidence=bootstrap_confidence, bootstrap_seed=bootstrap_seed)
+        if output_file is not None:
+            profiler.dump_stats(f'{os.path.splitext(output_file)[0]}.prof')
+            update_output(f'cProfile statistics have been written to {os.path.splitext(output_file)[0]}.prof\n\n')
+        return output_file
     
     # Redirect print outputs to the GUI output window
-    sys.stdout = TextRedirect(textWritten=update_output)
+    redirect_stdout(update_output)
+
+    profile = RunProfile() #timings of each step are recorded with profile.timer.lap(step)
+    output_directory = output_directory or os.path.dirname(directory)
 
     #print statements are now called with update_output in order for the text to be directed to the GUI window
     update_output('\nStarting interpolation and integration of mass spectra and calculation of photogragmentaion efficiency...\n\n')
-    QApplication.processEvents()  # Allow the GUI to update
 
     '''Step 1: Get list of mzml files'''
-    mzml_files = [f for f in os.listdir(directory) if f.endswith('.mzML')]
+    mzml_files = list_mzml_files(directory) #also works for a spectra store (see spectra_store.py)
 
     if len(mzml_files) == 0:
         update_output(f'There are no mzml files in {directory}. Were they deleted?\n')
-        QApplication.processEvents()  # Allow the GUI to update  
         return     
+    profile.timer.lap('list_files')
 
     '''Step 2: Parse power_data.csv file (if present), and assign corresponding photofragmentation efficiency function depending on its presence.'''
     #empty array for PE_calc_NoNorm functions that requires these arguements because ... reasons. Don't worry about it future reader. This is the way. 
     laser_data = np.empty(shape=(len(mzml_files), 3), dtype=[('Wavelength', None),('LaserPower', None), ('PowerStdDev', None)]) 
 
     #Assisgn method to calcualte photofragmentation efficiency depending on if Power normalization is used or not
-    PE_function = PE_calc_noNorm 
+    PE_function = PE_calc_noNorm_array 
     if power_data_file_name is not None: 
         # Load laser data from a CSV file into a structured NumPy array
         laser_data = np.genfromtxt(power_data_file_name, delimiter=',', dtype=None, names=['Wavelength', 'LaserPower', 'PowerStdDev'], encoding=None)
-        PE_function = PE_calc
+        PE_function = PE_calc_array
     
     #check to see if the number of mzml files (ie. the number of wavelengths scanned) matches the number of rows in the laser power data file. If not, we'll have index errors!
     if len(mzml_files) != len(laser_data['Wavelength']):
         update_output(f'The number of mzml files ({len(mzml_files)}) does not match the number of rows in the laser power data file ({len(laser_data["Wavelength"])}).\n')
-        QApplication.processEvents()  # Allow the GUI to update  
         return
+    profile.timer.lap('power_data')
     
-    '''Step3: Get the m/z of each fragmentation channel and create arrays for PE data to be written to'''
-    #Get central value of fragment ion ranges and mass of parent peak
+    '''Step3: Get the m/z of the parent ion'''
+    #Get mass of parent peak (the central m/z of each fragment ion range is only needed for the column names, see PE_column_names)
+    #The PE data array (number of wavelengths x number of fragment ions * 2 (PE + stdev) + 2 (total PE + stdev) +1 (wavelengths)) is made by calculate_PE_matrix in Step 4.2
     parent_mz = (np.round(np.average(base_peak_range),2))
-    frag_mz = []
-    for frag_ion_range in fragment_ion_ranges:
-        frag_mz.append(np.round(np.average(frag_ion_range),0))  
 
-    # Create an empty NumPy array for the final results to be written to
-    num_fragment_ions = len(fragment_ion_ranges)
-    
-    #array size (rows x columns) to store photofragmentation efficiency (PE) data should be number of wavelengths x number of fragment ions * 2 (PE + stdev) + 2 (total PE + stdev) +1 (wavelengths)
-    PE_data = np.empty(shape=(len(mzml_files), num_fragment_ions * 2 + 3), dtype=float) 
-
-    '''Step4: Loop through each mzml file in the directory and calculate the fragmentation efficiency for each fragment specified'''
+    '''Step4: Get the laser wavelength of each mzml file'''
     wavelengths = [] #empty list to store wavlengths to - wavelength written as last characters in each .mzML file
-    i = 0 #index to keep track of which row of the power normalization file that we are in
 
     for mzml_file in mzml_files: #Each mzML file is data taken at a specific laser wavelength
         
@@ -74,108 +157,227 @@ def main(directory, base_peak_range, fragment_ion_ranges, power_data_file_name,
         except ValueError as ve:
             update_output(f'Could not extract the wavelength from the .mzml file name. This is what the code has found: {wavelength}.\n\nDoes the filename contain the text: "Laser"?\n')
             update_output(f'Error: {ve}\nTraceback: {traceback.format_exc()}\n')
-            QApplication.processEvents()  # Allow the GUI to update        
             return     
 
-        #empty lists to store the average integrations and their stdev for each fragment - we need these to calcualte the total PE later.  
-        fragment_ion_integrations = [] 
-        fragment_ion_integrations_stdevs = []
-
-        fragment_ion_efficiencies = [] #empty list to store PE for each fragmentation channel
-        fragment_ion_efficiency_stdevs = [] #empty list to store PE stdev for each fragmentation channel
+    #rows are written in order of wavelength (the order of the rows of the laser power data file), whatever order the directory lists the files in
+    wavelengths, mzml_files = (list(values) for values in zip(*sorted(zip(wavelengths, mzml_files))))
+
+    #a repeat acquisition in the same directory gives two files with the same wavelength - each one still gets its own row, but they are probably not meant to be analyzed together
+    for wavelength in sorted(set(w for w in wavelengths if wavelengths.count(w) > 1)):
+        duplicate_files = [mzml_file for mzml_file, w in zip(mzml_files, wavelengths) if w == wavelength]
+        update_output(f'More than one mzml file has the wavelength {np.round(wavelength,0)}nm: {", ".join(duplicate_files)}. Each of them gets its own row.\n')
+
+    '''Step4.1: Integrate the mass spectrum to get the integrations of the parent ion peak and each fragment ion peak'''
+    #all windows are integrated in a single pass over each mzml file - the base peak is the first window, followed by each fragment ion range
+    integration_bounds_list = [base_peak_range] + list(fragment_ion_ranges)
+    integration_results = {} #window integrations of each mzml file, keyed by mzml file name (two files can have the same wavelength)
+    missing_windows = {} #indices of the windows that have to be integrated for each mzml file - all of them, unless the file is in the checkpoint or some are in the result cache
+    result_keys = {} #result cache key of each window of each mzml file
+
+    #the bootstrap resamples the integral of every scan, which the checkpoint and the result cache don't keep - so every file is integrated in this run
+    scan_integrals = {} #integrals of each scan of each mzml file (scans x windows), keyed by mzml file name - only kept for the bootstrap
+    if bootstrap_resamples > 0:
+        if not 0 < bootstrap_confidence < 1:
+            update_output(f'The confidence level of the bootstrap intervals must be between 0 and 1 (e.g. 0.95), but it is {bootstrap_confidence}.\n')
+            return
+        bootstrap_seed = bootstrap_seed if bootstrap_seed is not None else new_seed()
+        if resume or cache_results:
+            update_output('The bootstrap needs the integral of every scan, which the checkpoint and the result cache don\'t keep, so every mzml file is integrated in this run.\n')
+            resume = False
+
+    #files that were already integrated by the run being resumed
+    checkpoint_settings = {'directory': os.path.abspath(directory), 'integration_bounds': [[float(bound) for bound in integration_bounds] for integration_bounds in integration_bounds_list],
+                           'parent_mz': float(parent_mz), 'integration_mode': integration_mode}
+    checkpoint = RunCheckpoint(output_directory, directory, checkpoint_settings)
+    resumed_files = set()
+    if resume:
+        reason = checkpoint.load()
+        if reason:
+            update_output(f'The last run can\'t be resumed because {reason}. Starting from the beginning.\n')
+            resume = False
+        else:
+            for mzml_file, wavelength in zip(mzml_files, wavelengths):
+                window_integrations = checkpoint.completed(mzml_file)
+                if window_integrations is not None:
+                    integration_results[mzml_file] = window_integrations
+                    resumed_files.add(mzml_file)
+            update_output(f'Resuming the last run: {len(resumed_files)} of {len(mzml_files)} mzml files were already integrated.\n')
 
-        mzml_start_time = time.time() #timer to keep track of mzml processing
+    try:
+        checkpoint.start(mzml_files, {'power_data_file': os.path.abspath(power_data_file_name) if power_data_file_name is not None else None, 'wavelengths': wavelengths,
+                                      'workers': workers, 'use_cache': use_cache, 'cache_results': cache_results, 'bootstrap_resamples': bootstrap_resamples,
+                                      'bootstrap_seed': bootstrap_seed if bootstrap_resamples > 0 else None}, resume=resume)
+    except Exception as e:
+        update_output(f'Could not write the checkpoint of this run next to {directory} - it can\'t be resumed if it stops: {e}\n')
+        checkpoint = None
 
-        #get integration for base peak (parent ion)
+    result_cache = None
+    if cache_results:
         try:
-            base_peak = integrate_spectra(directory, mzml_file, base_peak_range, parent_mz)
+            result_cache = IntegrationResultCache(directory)
+            for mzml_file, wavelength in zip(mzml_files, wavelengths):
+                if mzml_file in resumed_files:
+                    continue
+                fingerprint = result_cache.fingerprint(mzml_file)
+                result_keys[mzml_file] = [result_cache.key(fingerprint, integration_bounds, parent_mz, integration_mode) for integration_bounds in integration_bounds_list]
+                integration_results[mzml_file] = [result_cache.get(key) if bootstrap_resamples == 0 else None for key in result_keys[mzml_file]]
 
         except Exception as e:
-            update_output(f'Problem encountered when integrating the base peak in {mzml_file}:\n{e}\nTraceback: {traceback.format_exc()}\n')
-            QApplication.processEvents()  # Allow the GUI to update        
-            return     
-        
-        '''Step4.1: Integrate the mass spectrum to get the integrations of the parent ion peak and each fragment ion peak'''
-        for fragment_ion_range in fragment_ion_ranges:
-            try:
-                fragment_peak = integrate_spectra(directory, mzml_file, fragment_ion_range, parent_mz)
-            except Exception as e:
-                update_output(f'Problem encountered when integrating the fragment m/z={np.round(np.mean(fragment_ion_range),1)}) in {mzml_file}:\n{e}\nTraceback: {traceback.format_exc()}\n')
-                QApplication.processEvents()  # Allow the GUI to update        
-                return     
-
-        #print runtime to GUI window        
-        mzml_runtime = np.round((time.time() - mzml_start_time),2)
-        update_output(f'Integration for {np.round((wavelength),0)}nm has completed in {mzml_runtime} seconds.\n')
-        QApplication.processEvents()  # Allow the GUI to update
-        
-        '''Step 4.2: Calculate PE for each fragment ion, then append PE to the fragment_ion_efficiencies list'''
-        
-        for fragment_ion_range in fragment_ion_ranges:    
+            update_output(f'Problem encountered when reading the integration result cache in {directory}:\n{e}\nTraceback: {traceback.format_exc()}\n')
+            return
+
+    def checkpoint_integrations(mzml_file, wavelength):
+        #a problem writing the checkpoint only costs the ability to resume, so the run carries on without it
+        nonlocal checkpoint
+        if checkpoint is None:
+            return
+        try:
+            checkpoint.add(mzml_file, wavelength, integration_results[mzml_file])
+        except Exception as e:
+            update_output(f'Could not write to the checkpoint {checkpoint.checkpoint_file} - this run can\'t be resumed if it stops: {e}\n')
+            checkpoint = None
+
+    for mzml_file, wavelength in zip(mzml_files, wavelengths):
+        missing = [j for j in range(len(integration_bounds_list)) if mzml_file not in integration_results or integration_results[mzml_file][j] is None]
+        if len(missing) > 0:
+            missing_windows[mzml_file] = missing
+
+    for mzml_file, wavelength in zip(mzml_files, wavelengths):
+        if mzml_file not in missing_windows:
+            profile.add_file(mzml_file, wavelength, 0.) #everything came from the checkpoint or the result cache
+            if mzml_file not in resumed_files:
+                checkpoint_integrations(mzml_file, wavelength)
+
+    if result_cache is not None:
+        update_output(f'{len(mzml_files) - len(missing_windows) - len(resumed_files)} of {len(mzml_files) - len(resumed_files)} mzml files were taken from the integration result cache. {sum(map(len, missing_windows.values()))} windows need to be integrated.\n')
+
+    files_done = len(mzml_files) - len(missing_windows)
+    profile.timer.lap('setup') #parent m/z, wavelengths, the checkpoint and the result cache lookup
+
+    def store_integrations(mzml_file, wavelength, window_integrations, file_scan_integrals):
+        #fill in the windows that were integrated (in the order of missing_windows), and remember them for the next run
+        if file_scan_integrals is not None:
+            scan_integrals[mzml_file] = file_scan_integrals
+        results = integration_results.setdefault(mzml_file, [None] * len(integration_bounds_list))
+        for j, window_integration in zip(missing_windows[mzml_file], window_integrations):
+            results[j] = window_integration
+            if result_cache is not None:
+                result_cache.put(result_keys[mzml_file][j], window_integration)
+        checkpoint_integrations(mzml_file, wavelength)
+
+    try:
+        #mzml files are independent of each other, so they can be sent to a pool of worker processes
+        if (executor is not None or workers > 1) and len(missing_windows) > 1:
+            update_output(f'Integrating {len(missing_windows)} mzml files using {"the shared pool of" if executor is not None else workers} worker processes...\n')
+
+            #a shared pool is only borrowed, so it isn't shut down at the end of the run
+            with nullcontext(executor) if executor is not None else ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(integrate_mzml_file, directory, mzml_file, [integration_bounds_list[j] for j in missing_windows[mzml_file]], parent_mz, integration_mode, use_cache,
+                                       return_scans=bootstrap_resamples > 0): (mzml_file, wavelength)
+                           for mzml_file, wavelength in zip(mzml_files, wavelengths) if mzml_file in missing_windows}
+
+                #results come back in whatever order the workers finish them
+                for future in as_completed(futures):
+                    mzml_file, wavelength = futures[future]
+
+                    #stop cleanly: drop the files that haven't started, and let the pool finish the ones that have
+                    if cancel_event is not None and cancel_event.is_set():
+                        for pending_future in futures:
+                            pending_future.cancel()
+                        update_output('The analysis was cancelled before all mzml files were integrated. No photofragmentation efficiency file was written.\n')
+                        return
+
+                    try:
+                        window_integrations, mzml_runtime, timings, file_scan_integrals, messages = future.result()
+                        if messages:
+                            update_output(messages)
+                        store_integrations(mzml_file, wavelength, window_integrations, file_scan_integrals)
+                        profile.add_file(mzml_file, wavelength, timings['total'], timings, len(missing_windows[mzml_file]))
+
+                    except Exception as e:
+                        update_output(f'Problem encountered when integrating the base peak and fragment ions in {mzml_file}:\n{e}\n')
+                        for pending_future in futures:
+                            pending_future.cancel() #no point integrating the rest
+                        return
+
+                    #print runtime to GUI window
+                    update_output(f'Integration for {np.round((wavelength),0)}nm has completed in {mzml_runtime} seconds.\n')
+                    files_done += 1
+                    if progress_callback is not None:
+                        progress_callback(files_done, len(mzml_files))
+
+        else:
+            for mzml_file, wavelength in zip(mzml_files, wavelengths):
+                if mzml_file not in missing_windows:
+                    continue
+
+                if cancel_event is not None and cancel_event.is_set():
+                    update_output('The analysis was cancelled before all mzml files were integrated. No photofragmentation efficiency file was written.\n')
+                    return
+
+                try:
+                    window_integrations, mzml_runtime, timings, file_scan_integrals, _ = integrate_mzml_file(directory, mzml_file, [integration_bounds_list[j] for j in missing_windows[mzml_file]], parent_mz, integration_mode, use_cache,
+                                                                                                          update_output=update_output, return_scans=bootstrap_resamples > 0)
+                    store_integrations(mzml_file, wavelength, window_integrations, file_scan_integrals)
+                    profile.add_file(mzml_file, wavelength, timings['total'], timings, len(missing_windows[mzml_file]))
+
+                except Exception as e:
+                    update_output(f'Problem encountered when integrating the base peak and fragment ions in {mzml_file}:\n{e}\nTraceback: {traceback.format_exc()}\n')
+                    return     
+
+                #print runtime to GUI window        
+                update_output(f'Integration for {np.round((wavelength),0)}nm has completed in {mzml_runtime} seconds.\n')
+                files_done += 1
+                if progress_callback is not None:
+                    progress_callback(files_done, len(mzml_files))
+
+    finally:
+        #keep whatever was integrated, even if the run was cancelled or failed part way
+        if result_cache is not None:
             try:
-                PE = PE_function(wavelength, laser_data['LaserPower'][i], laser_data['PowerStdDev'][i], base_peak[0], base_peak[1], fragment_peak[0], fragment_peak[1]) # W, P, dP, Par, dPar, Frag, dFrag
-            
-            except IndexError:
-                update_output('The number of wavelengths sampled in your powerdata.csv file does not match the number of .mzML files extracted. These need to be the same.\n')
-                update_output(f"There are {len(mzml_files)} .mzML files in {directory} and {len(laser_data['LaserPower'])} wavelengths in {power_data_file_name}.\nTraceback: {traceback.format_exc()}\n")
-                QApplication.processEvents()  # Allow the GUI to update       
-                return
-            
+                result_cache.save()
             except Exception as e:
-                update_output(f'Problem encountered when calculating the photofragmentation efficiency of m/z={np.round(np.mean(fragment_ion_range),1)}) in {mzml_file}:\n{e}\nTraceback: {traceback.format_exc()}\n')
-                QApplication.processEvents()  # Allow the GUI to update        
-                return     
+                update_output(f'Could not write the integration result cache: {e}\n')
+
+    if progress_callback is not None and len(missing_windows) == 0:
+        progress_callback(len(mzml_files), len(mzml_files))
+    profile.timer.lap('integration')
 
-            #Since there are multiple fragmentation channels, append the PE from each channel to a list
-            #The PE_function returns a list - the first entry is the photofragmentation efficiency averaged over N spectra; the second entry is the associated stdev
-            fragment_ion_efficiencies.append(PE[0]) 
-            fragment_ion_efficiency_stdevs.append(PE[1])
+    '''Step4.2: Calculate the fragmentation efficiency of each fragment specified for all mzml files at once (in a fixed order - row i matches row i of the power normalization file). Steps 4.3 and 4.4 are in calculate_PE_matrix'''
+    try:
+        #without power normalization laser_data is only a placeholder - the power isn't used
+        laser_power = laser_data['LaserPower'] if power_data_file_name is not None else np.zeros(len(mzml_files))
+        power_stdev = laser_data['PowerStdDev'] if power_data_file_name is not None else np.zeros(len(mzml_files))
 
-            #Since total PE is not the sum of the PE from all fragment channels, we need to store the total integration of all fragment ion peaks and their stdevs
-            fragment_ion_integrations.append(fragment_peak[0]) #storing total fragment ion area to calculate total PE later
-            fragment_ion_integrations_stdevs.append(fragment_peak[1]) #storing total fragment ion area stdev to calculate total PE stdev later
+        '''Step4.5: Store calculated efficiencies in the result_data array. row index = i'''  
+        PE_data = calculate_PE_matrix(wavelengths, laser_power, power_stdev, [integration_results[mzml_file][0] for mzml_file in mzml_files], [integration_results[mzml_file][1:] for mzml_file in mzml_files],
+                                      PE_function, update_output=update_output, fragment_ion_ranges=fragment_ion_ranges)
 
-        '''Step4.3: Compute the total photofragmentation efficiency'''    
-        #get total fragment ion integration 
-        total_fragment_ion_integration = np.sum(fragment_ion_integrations)
+    except Exception as e:
+        update_output(f'Problem encountered when calculating the photofragmentation efficiency:\n{e}\nTraceback: {traceback.format_exc()}\n')
+        return
 
-        #propagate stdev of each fragment ion uncertainty together. Since its jsut addition, proparation is the square root of the sum of squares
-        total_fragment_ion_integration_stdev = np.sqrt(np.sum(np.square(fragment_ion_integrations_stdevs)))
+    profile.timer.lap('PE_calculation')
 
-        #compute total PE for each mzml file
+    '''Step4.6: Bootstrap confidence intervals of every PE value from the integrals of each scan (see bootstrap.py), added as extra columns'''
+    column_names = PE_column_names(fragment_ion_ranges)
+    if bootstrap_resamples > 0:
         try:
-            Total_PE = PE_function(wavelength, laser_data['LaserPower'][i], laser_data['PowerStdDev'][i], base_peak[0], base_peak[1], total_fragment_ion_integration, total_fragment_ion_integration_stdev) # W, P, dP, Par, dPar, Frag, dFrag
-        
-        except IndexError:
-            update_output('The number of wavelengths sampled in your powerdata.csv file does not match the number of .mzML files extracted. These need to be the same.\n')
-            update_output(f"There are {len(mzml_files)} .mzML files in {directory} and {len(laser_data['LaserPower'])} wavelengths in {power_data_file_name}.\n")
-            QApplication.processEvents()  # Allow the GUI to update       
-            return
-        
-        except Exception as e:
-            update_output(f'Problem encountered when calculating the TOTAL photofragmentation efficiency in {mzml_file}:\n{e}\n')
-            QApplication.processEvents()  # Allow the GUI to update        
-            return   
+            update_output(f'Calculating {100*bootstrap_confidence:g}% bootstrap confidence intervals from {bootstrap_resamples} resamples of the scans of each mzml file (seed {bootstrap_seed})...\n')
+            PE_CI = bootstrap_PE(wavelengths, laser_power, power_stdev, [scan_integrals[mzml_file] for mzml_file in mzml_files], power_data_file_name is not None,
+                                 num_resamples=bootstrap_resamples, confidence=bootstrap_confidence, seed=bootstrap_seed)
+            PE_data = np.column_stack([PE_data, PE_CI])
+            column_names += bootstrap_column_names(fragment_ion_ranges, bootstrap_confidence)
 
-        '''Step4.3: Store calculated efficiencies in the result_data array. row index = i'''  
-        PE_data[i, 0] = wavelengths[i] #wavelengths in first column
-        PE_data[i, 1] = Total_PE[0] # Store total_efficiency in the second column
-        PE_data[i, 2] = Total_PE[1] # Store total_efficiency stdev in the third column       
-        PE_data[i, 3:num_fragment_ions*2 + 3:2] = fragment_ion_efficiencies # Store fragment ion efficiency in the 4, 6, 8, 10, .... columns
-        PE_data[i, 4:num_fragment_ions*2 + 3:2] = fragment_ion_efficiency_stdevs # Store fragment ion efficiency stdev in the 5, 7, 9, 11, .... columns
+        except Exception as e:
+            update_output(f'Problem encountered when calculating the bootstrap confidence intervals:\n{e}\nTraceback: {traceback.format_exc()}\n')
+            return
 
-        i+=1 #update index to start next row of laser data file when the next mzml file is read in
+        profile.timer.lap('bootstrap')
 
     '''Step5: Create an array to write PE data to'''
-    # Create a structured array for results
-    dtype = [('Wavelength', float)]
-    dtype.extend([('Total PE', float)])
-    dtype.extend([('Total PE stdev', float)])
-
-    #Alternate labels for Frag PE and Frag PE stdev
-    for i in range(num_fragment_ions): 
-        dtype.extend([(f'PE mz {frag_mz[i]}', float)])
-        dtype.extend([(f'PE mz {frag_mz[i]} stdev', float)])
+    # Create a structured array for results - Wavelength, Total PE, Total PE stdev, then PE mz ... and PE mz ... stdev for each fragment ion (and the bootstrap confidence intervals)
+    dtype = [(column_name, float) for column_name in column_names]
 
     #python magic that I figured out at one point to make a structured data array, but I forget how this works now, so good luck. 
     try:
@@ -183,25 +385,43 @@ def main(directory, base_peak_range, fragment_ion_ranges, power_data_file_name,
 
     except Exception as e:
         update_output(f'Problem encountered when creating structured data array in main.py:\n{e}\nTraceback: {traceback.format_exc()}')
-        QApplication.processEvents()  # Allow the GUI to update        
         return    
 
     '''Step6: Write the PE data to a .csv file'''
-    output_file = os.path.join(os.path.dirname(directory),'photofragmentation_efficiency.csv')
+    output_file = os.path.join(output_directory,'photofragmentation_efficiency.csv')
     index = 0
 
     #mechanism to prevent overwriting existing output files
     while os.path.exists(output_file):
         index += 1
-        output_file = os.path.join(os.path.dirname(directory),f'photofragmentation_efficiency_{index}.csv')
+        output_file = os.path.join(output_directory,f'photofragmentation_efficiency_{index}.csv')
 
     try:
         np.savetxt(output_file, result_structured, delimiter=',', fmt='%.6f', header=','.join(result_structured.dtype.names), comments='')
         update_output(f'The photofragmentation efficiency data has been succesfully written to {output_file}\n\n')
-        return
+        profile.timer.lap('csv_writing')
 
     except PermissionError: #this should never proc because we check for existing files and change the ending index to make sure the file is new, but you never know...
         print(f'Python is trying to write to {output_file}, but it is open. Please close it and then rerun the code.')
-        QApplication.processEvents()  # Allow the GUI to update       
         return
 
+    #the table is written, so the checkpoint is no longer needed to resume - the manifest is kept as a record of the run
+    if checkpoint is not None:
+        try:
+            checkpoint.finish(output_file)
+        except Exception as e:
+            update_output(f'Could not mark the run as complete in {checkpoint.manifest_file}: {e}\n')
+
+    #the run profile is extra information - a problem writing it doesn't fail the run
+    if run_profile:
+        try:
+            settings = {'directory': directory, 'integration_mode': integration_mode, 'workers': workers, 'use_cache': use_cache, 'cache_results': cache_results, 'windows': len(integration_bounds_list), 'files': len(mzml_files),
+                        'bootstrap_resamples': bootstrap_resamples}
+            profile_files = profile.save(output_file, settings)
+            update_output(profile.summary())
+            update_output(f'The run profile has been written to {profile_files[0]} and {profile_files[1]}\n\n')
+        except Exception as e:
+            update_output(f'Could not write the run profile: {e}\nTraceback: {traceback.format_exc()}\n')
+
+    return output_file
+
@@ -0,0 +1,25 @@
+# Choices offered by the GUI and the command line. They live here rather than in workflows.py, which imports numpy (and pandas / pyteomics when they are needed),
+# so that the GUI can fill in its drop-down menus and show its window without importing the analysis code. workflows.py imports them from here.
+
+#Integration modes understood by integrate_spectra_multi (and everything that calls it)
+#grid   - each window is masked out of the interpolated scan and integrated with trapz (the original method)
+#cumsum - scans are stacked into 2D blocks of CUMSUM_BLOCK_SCANS scans and every window is answered from a cumulative trapezoid lookup
+#native - no common grid at all; the piecewise-linear spectrum is integrated exactly on its own m/z points, interpolating only at the two window edges.
+#         Tolerance vs grid/cumsum: when the m/z values of a scan sit on the 0.01 Da grid (as they do for QTRAP data) the results are identical to rounding error,
+#         except in a window that contains the first or last point of a scan. There the grid modes also count the ramp down to the zero-intensity grid point
+#         0.01 Da further out, so the per-scan difference is at most 0.005 * (intensity of that edge point). On the example data this is < 2.1% of the base peak area.
+INTEGRATION_MODES = ['grid', 'cumsum', 'native']
+
+#Output formats of extract_RawData
+#csv - one m/z column plus one column per wavelength (the original format)
+#npy - wavelengths x m/z matrix in a .npy file that is written one row at a time through a memory map, with the m/z axis and the wavelengths in <name>_mz.npy and <name>_wavelengths.npy
+RAW_DATA_FORMATS = ['csv', 'npy']
+
+#Encodings msconvert can write the binary arrays of the .mzml files in (see msconvert_command). All but none make the mzml directory several times smaller
+#none            - uncompressed (the original conversion)
+#zlib            - lossless zlib compression
+#numpress-linear - numpress linear prediction of the m/z values (relative error below 2e-9), intensities as they are
+#numpress-pic    - numpress linear m/z values, and intensities rounded to whole numbers (positive integer compression, error up to 0.5 counts)
+#numpress-slof   - numpress linear m/z values, and intensities as short logged floats (relative error below 2e-4)
+MZML_COMPRESSIONS = {'none': [], 'zlib': ['--zlib'], 'numpress-linear': ['--numpressLinear'],
+                     'numpress-pic': ['--numpressLinear', '--numpressPic'], 'numpress-slof': ['--numpressLinear', '--numpressSlof']}
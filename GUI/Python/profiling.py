@@ -0,0 +1,86 @@
+import os, sys, csv, json, time
+
+# Run profile of main(): where the time of a run goes, for each mzml file and for each stage, and how much memory it took.
+# The integration of each mzml file is split into
+#   parse         - reading the XML and decoding the m/z and intensity arrays (or reading them from the cache / spectra store)
+#   pad_sort      - padding each scan with zeros on the common grid and sorting it
+#   interpolation - interpolating each scan onto the common grid
+#   integration   - integrating the windows
+# and the run as a whole into the steps of main() (listing files, reading the power data, integration, PE calculation, the bootstrap confidence intervals if any, and writing the .csv).
+# With main(run_profile=True) the profile is written next to the photofragmentation efficiency .csv as <name>_profile.json and <name>_profile.csv (one row per mzml file).
+
+try:
+    import resource #not available on Windows - peak RSS is reported as None there
+except ImportError:
+    resource = None
+
+PROFILE_FORMAT_VERSION = 1
+FILE_STAGES = ['parse', 'pad_sort', 'interpolation', 'integration']
+
+class StageTimer:
+    '''Adds up the time spent in each stage of a loop with one call per stage. Usage is:
+    call lap(stage) at the end of each stage - the time since the previous lap (or since the timer was made) is added to that stage.
+    '''
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.seconds[stage] = self.seconds.get(stage, 0.) + now - self.last
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+        self.last = now
+
+    def as_dict(self):
+        return {'seconds': dict(self.seconds), 'counts': dict(self.counts)}
+
+def peak_rss_mb(children=False):
+    '''Peak resident memory in MB of this process (or of its largest finished child process, e.g. a pool worker). None where the resource module isn't available.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024 #bytes on macOS, kB on Linux
+
+class RunProfile:
+    '''Timings of one run of main(). The steps of the run are timed with the stage timer (profile.timer.lap(step)), and each mzml file is added with add_file.'''
+    def __init__(self):
+        self.started = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.start_time = time.perf_counter()
+        self.timer = StageTimer()
+        self.files = []
+
+    def add_file(self, mzml_file, wavelength, seconds, file_timings=None, windows_integrated=0):
+        '''Adds the timings of one mzml file (file_timings is StageTimer.as_dict() of its integration, None if every window came from the result cache).'''
+        file_timings = file_timings or {'seconds': {}, 'counts': {}}
+        self.files.append({'file': mzml_file, 'wavelength': wavelength, 'seconds': seconds, 'scans': file_timings['counts'].get('parse', 0),
+                           'windows_integrated': windows_integrated, 'stages': {stage: file_timings['seconds'].get(stage, 0.) for stage in FILE_STAGES}})
+
+    def file_stage_totals(self):
+        return {stage: sum(file['stages'][stage] for file in self.files) for stage in FILE_STAGES}
+
+    def summary(self):
+        '''One line summary of where the integration time went.'''
+        totals = self.file_stage_totals()
+        total = sum(totals.values())
+        if total == 0:
+            return 'No mzml files were integrated in this run.\n'
+        return 'Integration time (summed over files): ' + ', '.join(f'{stage} {seconds:.2f} s ({100 * seconds / total:.0f}%)' for stage, seconds in totals.items()) + '\n'
+
+    def save(self, output_file, settings=None):
+        '''Writes the profile next to output_file (the photofragmentation efficiency .csv). Returns the names of the .json and .csv files.'''
+        base_name = os.path.splitext(output_file)[0]
+
+        profile = {'format_version': PROFILE_FORMAT_VERSION, 'started': self.started, 'total_seconds': time.perf_counter() - self.start_time,
+                   'steps': dict(self.timer.seconds), 'file_stage_totals': self.file_stage_totals(),
+                   'peak_rss_mb': peak_rss_mb(), 'peak_worker_rss_mb': peak_rss_mb(children=True), 'settings': settings or {}, 'files': self.files}
+        with open(f'{base_name}_profile.json', 'w') as file:
+            json.dump(profile, file, indent=1)
+
+        with open(f'{base_name}_profile.csv', 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['file', 'wavelength', 'seconds', 'scans', 'windows_integrated'] + [f'{stage}_seconds' for stage in FILE_STAGES])
+            for record in self.files:
+                writer.writerow([record['file'], record['wavelength'], f'{record["seconds"]:.6f}', record['scans'], record['windows_integrated']] + [f'{record["stages"][stage]:.6f}' for stage in FILE_STAGES])
+
+        return f'{base_name}_profile.json', f'{base_name}_profile.csv'
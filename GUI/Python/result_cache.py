@@ -0,0 +1,79 @@
+import os, json
+import numpy as np
+from Python.spectra_cache import CACHE_DIRECTORY_NAME, file_hash
+from Python.spectra_store import SpectraStore, is_spectra_store, STORE_INDEX_NAME
+from Python.workflows import INTEGRATION_GRID_STEP, INTEGRATION_GRID_MARGIN
+
+# Cache of integration results, so that re-running main() after changing one fragment window only integrates the windows that are new or changed.
+# The [average integration, stdev] of every (mzml file, window) is stored in one .json file in the cache directory next to the data, keyed by
+#   SHA-1 of the mzml file contents | integration mode | integration grid | window bounds rounded to 2 decimals (the precision they are integrated at)
+# The hash of each mzml file is only recomputed when its size or modification time changes. For a spectra store, the stored spectra of the file are hashed.
+# The least recently used results are dropped once there are more than max_results of them.
+
+RESULT_CACHE_NAME = 'integration_results.json'
+RESULT_CACHE_FORMAT_VERSION = 1
+DEFAULT_MAX_RESULTS = 100000
+
+class IntegrationResultCache:
+    '''Integration results of the mzml files in a directory (or spectra store). Usage is:
+    directory containing mzml files, and the maximum number of results to keep. Look results up with get(key(...)), add them with put() and write the cache with save().
+    '''
+    def __init__(self, directory, max_results=DEFAULT_MAX_RESULTS):
+        self.directory = directory
+        self.path = os.path.join(directory, CACHE_DIRECTORY_NAME, RESULT_CACHE_NAME)
+        self.max_results = max_results
+        self.files = {}   #size, modification time and hash of each mzml file
+        self.results = {} #[average integration, stdev] for each key, least recently used first
+        self._store = SpectraStore(directory) if is_spectra_store(directory) else None
+
+        try:
+            with open(self.path) as file:
+                cached = json.load(file)
+            if cached['format_version'] == RESULT_CACHE_FORMAT_VERSION:
+                self.files = cached['files']
+                self.results = cached['results']
+        except Exception:
+            pass #missing or unreadable cache files are treated as empty (they get overwritten)
+
+    def fingerprint(self, mzml_file):
+        '''Hash of the contents of an mzml file - only recomputed if the file (or the store) has changed since it was last hashed.'''
+        path = os.path.join(self.directory, STORE_INDEX_NAME if self._store is not None else mzml_file)
+        stat = os.stat(path)
+
+        known = self.files.get(mzml_file)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['fingerprint']
+
+        fingerprint = self._store.file_hash(mzml_file) if self._store is not None else file_hash(path)
+        self.files[mzml_file] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'fingerprint': fingerprint}
+        return fingerprint
+
+    def key(self, fingerprint, integration_bounds, parent_mz, integration_mode):
+        '''Key of the result of integrating one window of an mzml file.'''
+        lower_bound, upper_bound = np.round(integration_bounds, 2)
+        max_mz = parent_mz + INTEGRATION_GRID_MARGIN
+        return f'{fingerprint}|{integration_mode}|0:{max_mz:.2f}:{INTEGRATION_GRID_STEP}|{lower_bound:.2f}:{upper_bound:.2f}'
+
+    def get(self, key):
+        '''Returns the cached [average integration, stdev], or None.'''
+        result = self.results.pop(key, None)
+        if result is not None:
+            self.results[key] = result #move to the end (most recently used)
+        return result
+
+    def put(self, key, result):
+        self.results.pop(key, None)
+        self.results[key] = [float(result[0]), float(result[1])]
+
+    def save(self):
+        '''Writes the cache, dropping the least recently used results above max_results.'''
+        for key in list(self.results)[:max(len(self.results) - self.max_results, 0)]:
+            del self.results[key]
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        #write to a temporary file first so that a run that is stopped part way never leaves a half written cache file
+        temporary_file = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary_file, 'w') as file:
+            json.dump({'format_version': RESULT_CACHE_FORMAT_VERSION, 'files': self.files, 'results': self.results}, file)
+        os.replace(temporary_file, self.path)
@@ -0,0 +1,117 @@
+import os, hashlib
+import numpy as np
+
+# On-disk cache of decoded spectra. Parsing the XML and base64-decoding the arrays of an mzml file is the slow part of reading it,
+# so the decoded m/z and intensity arrays of each mzml file are stored in a single .npz file in a cache directory next to the data.
+# A cache file is used only if the mzml file still has the same size and modification time (or, if only the modification time changed, the same SHA-1 hash - the new modification time is then stored).
+# The cache directory is kept under a size limit by removing the least recently used files first.
+# The cache is only a speed-up: if it can't be written (e.g. a read-only data directory) the problem is reported and the spectra are used from memory as usual.
+
+CACHE_DIRECTORY_NAME = '.spectra_cache'
+DEFAULT_MAX_CACHE_BYTES = 2 * 1024**3 #2 GB
+
+def cache_file_path(mzml_path):
+    '''Returns the name of the cache file for an mzml file (in the cache directory next to it).'''
+    return os.path.join(os.path.dirname(os.path.abspath(mzml_path)), CACHE_DIRECTORY_NAME, os.path.basename(mzml_path) + '.npz')
+
+def file_hash(path):
+    '''SHA-1 hash of the contents of a file.'''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def load_cached_spectra(mzml_path, update_output=None):
+    '''Loads the decoded spectra of an mzml file from the cache. Usage is:
+    path of the mzml file, and the function to report cache problems with (print by default). Returns a list of (m/z array, intensity array) for each scan, or None if there is no valid cache file.
+    '''
+    cache_file = cache_file_path(mzml_path)
+    if not os.path.isfile(cache_file):
+        return None
+
+    try:
+        with np.load(cache_file) as cached:
+            stat = os.stat(mzml_path)
+            if int(cached['size']) != stat.st_size:
+                return None
+
+            #a different modification time alone (e.g. the data was copied) is fine as long as the contents are the same
+            mtime_changed = int(cached['mtime_ns']) != stat.st_mtime_ns
+            if mtime_changed and str(cached['sha1']) != file_hash(mzml_path):
+                return None
+
+            mz = cached['mz']
+            intensity = cached['intensity']
+            offsets = cached['offsets']
+            sha1 = str(cached['sha1'])
+
+    except Exception:
+        return None #unreadable cache files are treated as missing (they get overwritten)
+
+    #store the new modification time, so the next load doesn't hash the whole file again. Rewriting it also marks the cache file as recently used for the LRU eviction
+    if mtime_changed:
+        try:
+            write_cache_file(cache_file, mz, intensity, offsets, stat.st_size, stat.st_mtime_ns, sha1)
+        except OSError:
+            pass #the cache file is still valid - the next load just hashes the mzml file again
+    else:
+        try:
+            os.utime(cache_file)
+        except OSError as e:
+            (update_output or print)(f'Could not mark the spectra cache file {cache_file} as recently used: {e}\n')
+
+    #views into the concatenated arrays - one per scan
+    return [(mz[start:end], intensity[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+def save_cached_spectra(mzml_path, spectra, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES, update_output=None):
+    '''Stores the decoded spectra of an mzml file in the cache. Usage is:
+    path of the mzml file, list of (m/z array, intensity array) for each scan, the size limit of the cache directory in bytes, and the function to report cache problems with (print by default).
+    Returns True if the spectra were stored. A cache that can't be written is reported and skipped, it never stops the run.
+    '''
+    cache_file = cache_file_path(mzml_path)
+
+    #all scans are stored as two concatenated arrays, plus the offset of the start of each scan
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum([len(mz) for mz, _ in spectra], out=offsets[1:])
+    mz = np.concatenate([np.asarray(mz, dtype=np.float64) for mz, _ in spectra]) if spectra else np.zeros(0)
+    intensity = np.concatenate([np.asarray(intensity, dtype=np.float64) for _, intensity in spectra]) if spectra else np.zeros(0)
+
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        stat = os.stat(mzml_path)
+        write_cache_file(cache_file, mz, intensity, offsets, stat.st_size, stat.st_mtime_ns, file_hash(mzml_path))
+        evict_cache(os.path.dirname(cache_file), max_cache_bytes)
+    except OSError as e:
+        (update_output or print)(f'Could not write the spectra cache of {os.path.basename(mzml_path)}, carrying on without it: {e}\n')
+        return False
+    return True
+
+def write_cache_file(cache_file, mz, intensity, offsets, size, mtime_ns, sha1):
+    '''Writes a cache file: the concatenated m/z and intensity arrays, the offset of the start of each scan, and the size, modification time and SHA-1 hash of the mzml file.'''
+    #write to a temporary file first so that other processes never see a half written cache file
+    temporary_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(temporary_file, 'wb') as file:
+        np.savez(file, mz=mz, intensity=intensity, offsets=offsets, size=size, mtime_ns=mtime_ns, sha1=sha1)
+    os.replace(temporary_file, cache_file)
+
+def evict_cache(cache_directory, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+    '''Removes the least recently used cache files until the cache directory is no larger than max_cache_bytes.'''
+    cache_files = []
+    for name in os.listdir(cache_directory):
+        if name.endswith('.npz'):
+            try:
+                stat = os.stat(os.path.join(cache_directory, name))
+                cache_files.append((stat.st_mtime, stat.st_size, os.path.join(cache_directory, name)))
+            except FileNotFoundError:
+                pass #removed by another process in the meantime
+
+    total_bytes = sum(size for _, size, _ in cache_files)
+    for _, size, path in sorted(cache_files): #oldest first
+        if total_bytes <= max_cache_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
@@ -0,0 +1,150 @@
+import os, re, sys, json, time, hashlib
+import numpy as np
+from contextlib import closing
+
+# Columnar store of all the spectra in a directory of mzml files. Instead of one XML document per wavelength, the m/z and intensity values of every scan
+# of every file are concatenated into two flat binary arrays, with offset arrays marking where each scan and each file starts:
+#   mz.bin, intensity.bin  - float64 values of all scans, back to back
+#   scan_offsets.bin       - int64, (number of scans + 1) - scan k is mz[scan_offsets[k]:scan_offsets[k+1]]
+#   file_offsets.bin       - int64, (number of files + 1) - file f holds scans file_offsets[f] to file_offsets[f+1] - 1
+#   spectra_store.json     - index with the original mzml file names, their wavelengths and the array lengths (written last, so a half built store is never used)
+# The arrays are opened with np.memmap, so nothing is parsed and only the scans that are used are ever read from disk.
+# main(), integrate_spectra_multi and extract_RawData read from a store when they are given its directory in place of the mzml directory.
+
+STORE_INDEX_NAME = 'spectra_store.json'
+STORE_FORMAT_VERSION = 1
+
+def default_store_directory(mzml_directory):
+    '''The store for an mzml directory is written next to it (so the .csv outputs of main() end up in the same place).'''
+    return os.path.normpath(mzml_directory) + '_store'
+
+def is_spectra_store(directory):
+    '''True if the directory contains a (completely written) spectra store.'''
+    return os.path.isfile(os.path.join(directory, STORE_INDEX_NAME))
+
+def build_spectra_store(mzml_directory, store_directory=None, update_output=print):
+    '''Consolidates all mzml files of a directory into a single columnar store. Usage is:
+    directory containing mzml files, and the directory to write the store to (defaults to <mzml directory>_store). Returns the store directory.
+    Files are streamed one scan at a time, so memory use does not depend on the size of the data.
+    '''
+    #imported here to avoid a circular import (workflows.py reads from stores)
+    from Python.workflows import iter_spectra, list_mzml_files
+
+    store_directory = store_directory or default_store_directory(mzml_directory)
+    os.makedirs(store_directory, exist_ok=True)
+
+    #remove the index of an old store first - the store is only valid again once the new index is written
+    if is_spectra_store(store_directory):
+        os.remove(os.path.join(store_directory, STORE_INDEX_NAME))
+
+    #same file order as main() uses for the mzml directory, because rows of the power data file are matched to the files by position
+    mzml_files = list_mzml_files(mzml_directory)
+    if len(mzml_files) == 0:
+        raise ValueError(f'There are no mzml files in {mzml_directory}.')
+
+    wavelengths = []
+    scan_offsets = [0]
+    file_offsets = [0]
+
+    with open(os.path.join(store_directory, 'mz.bin'), 'wb') as mz_file, open(os.path.join(store_directory, 'intensity.bin'), 'wb') as intensity_file:
+        for mzml_file in mzml_files:
+            start_time = time.time()
+            with closing(iter_spectra(os.path.join(mzml_directory, mzml_file))) as spectra:
+                for spectrum in spectra:
+                    mz = np.asarray(spectrum['m/z array'], dtype=np.float64)
+                    intensity = np.asarray(spectrum['intensity array'], dtype=np.float64)
+                    if len(mz) != len(intensity):
+                        raise ValueError(f'Inconsistent lengths of m/z and intensity values in {mzml_file}')
+
+                    mz_file.write(mz.tobytes())
+                    intensity_file.write(intensity.tobytes())
+                    scan_offsets.append(scan_offsets[-1] + len(mz))
+
+            file_offsets.append(len(scan_offsets) - 1)
+
+            #same wavelength parsing as main() - None if the file name doesn't contain one
+            try:
+                wavelengths.append(float(re.findall(r'\d+', mzml_file.split('Laser')[-1])[-1]))
+            except IndexError:
+                wavelengths.append(None)
+
+            update_output(f'Added {mzml_file} to the spectra store in {np.round(time.time() - start_time, 2)} seconds.\n')
+
+    np.asarray(scan_offsets, dtype=np.int64).tofile(os.path.join(store_directory, 'scan_offsets.bin'))
+    np.asarray(file_offsets, dtype=np.int64).tofile(os.path.join(store_directory, 'file_offsets.bin'))
+
+    index = {'format_version': STORE_FORMAT_VERSION, 'files': mzml_files, 'wavelengths': wavelengths, 'num_points': scan_offsets[-1], 'num_scans': len(scan_offsets) - 1}
+    with open(os.path.join(store_directory, STORE_INDEX_NAME), 'w') as file:
+        json.dump(index, file, indent=1)
+
+    update_output(f'Spectra store with {len(mzml_files)} files and {index["num_scans"]} scans written to {store_directory}\n')
+    return store_directory
+
+class SpectraStore:
+    '''Read access to a spectra store written by build_spectra_store. All arrays are memory mapped (read only).'''
+
+    def __init__(self, store_directory):
+        with open(os.path.join(store_directory, STORE_INDEX_NAME)) as file:
+            index = json.load(file)
+
+        if index['format_version'] != STORE_FORMAT_VERSION:
+            raise ValueError(f'{store_directory} is a spectra store of version {index["format_version"]}, but only version {STORE_FORMAT_VERSION} can be read.')
+
+        self.directory = store_directory
+        self.files = index['files']
+        self.wavelengths = index['wavelengths']
+        self._file_index = {mzml_file: f for f, mzml_file in enumerate(self.files)}
+
+        self.scan_offsets = np.memmap(os.path.join(store_directory, 'scan_offsets.bin'), dtype=np.int64, mode='r', shape=(index['num_scans'] + 1,))
+        self.file_offsets = np.memmap(os.path.join(store_directory, 'file_offsets.bin'), dtype=np.int64, mode='r', shape=(len(self.files) + 1,))
+
+        #np.memmap can't map an empty file
+        if index['num_points'] > 0:
+            self.mz = np.memmap(os.path.join(store_directory, 'mz.bin'), dtype=np.float64, mode='r', shape=(index['num_points'],))
+            self.intensity = np.memmap(os.path.join(store_directory, 'intensity.bin'), dtype=np.float64, mode='r', shape=(index['num_points'],))
+        else:
+            self.mz = self.intensity = np.zeros(0)
+
+    def num_scans(self, mzml_file):
+        '''Number of scans stored for an mzml file.'''
+        f = self._file_index[mzml_file]
+        return int(self.file_offsets[f + 1] - self.file_offsets[f])
+
+    def spectrum(self, mzml_file, scan):
+        '''m/z and intensity array (read only views) of one scan of one mzml file.'''
+        if not 0 <= scan < self.num_scans(mzml_file):
+            raise IndexError(f'{mzml_file} has {self.num_scans(mzml_file)} scans, scan {scan} does not exist.')
+
+        k = int(self.file_offsets[self._file_index[mzml_file]]) + scan
+        start, end = int(self.scan_offsets[k]), int(self.scan_offsets[k + 1])
+        return self.mz[start:end], self.intensity[start:end]
+
+    def file_hash(self, mzml_file):
+        '''SHA-1 hash of the stored spectra of an mzml file (scan lengths, m/z and intensity values).'''
+        f = self._file_index[mzml_file]
+        first_scan, end_scan = int(self.file_offsets[f]), int(self.file_offsets[f + 1])
+        start, end = int(self.scan_offsets[first_scan]), int(self.scan_offsets[end_scan])
+
+        sha1 = hashlib.sha1()
+        sha1.update(np.diff(self.scan_offsets[first_scan:end_scan + 1]).tobytes())
+        sha1.update(np.ascontiguousarray(self.mz[start:end]).tobytes())
+        sha1.update(np.ascontiguousarray(self.intensity[start:end]).tobytes())
+        return sha1.hexdigest()
+
+    def iter_spectra(self, mzml_file):
+        '''Yields the spectra of an mzml file in the same form as workflows.iter_spectra.'''
+        for scan in range(self.num_scans(mzml_file)):
+            mz, intensity = self.spectrum(mzml_file, scan)
+            yield {'m/z array': mz, 'intensity array': intensity}
+
+# Import step - run from the GUI directory: python -m Python.spectra_store <mzml directory> [store directory]
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print('Usage: python -m Python.spectra_store <mzml directory> [store directory]')
+        sys.exit(2)
+
+    try:
+        build_spectra_store(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else None)
+    except Exception as e:
+        print(f'Could not build the spectra store: {e}')
+        sys.exit(1)
@@ -0,0 +1,387 @@
+import os, re
+import numpy as np
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QCheckBox
+from PyQt5.QtGui import QPainter, QImage, QColor, QPen, QPolygonF, QFontMetrics
+from PyQt5.QtCore import Qt, QRectF, QPointF, QLineF, pyqtSignal
+from Python.decimation import MinMaxPyramid, load_raw_data
+
+# Spectrum viewer - shows the averaged spectra of a Raw_data file (see extract_RawData) as a wavelength x m/z heatmap, with the spectra of selected wavelengths overlaid
+# underneath. Both plots share the m/z axis and are drawn from a min/max decimation pyramid (see decimation.py), so panning and zooming stay quick at any grid size.
+# The integration windows (base peak and fragment ions) are drawn as bands that can be dragged, and the changed windows are sent back with the windowsChanged signal.
+# Mouse: wheel zooms around the cursor, dragging the plot pans, dragging a window moves it and dragging its edge resizes it, double click shows everything.
+# Clicking a row of the heatmap adds (or removes) the spectrum of that wavelength to the traces.
+
+VIEWER_MAX_TRACES = 10
+VIEWER_DEFAULT_TRACES = 5
+VIEWER_WINDOW_STEP = 0.01 #windows snap to the integration grid (INTEGRATION_GRID_STEP in workflows.py)
+VIEWER_EDGE_TOLERANCE = 5 #pixels from a window edge that still grab the edge
+VIEWER_MARGINS = (75, 10, 18, 28) #left, top, right, bottom in pixels (room for the axis labels)
+
+#colormap of the heatmap (anchors of viridis, interpolated to 256 colors), packed as 0xffRRGGBB for QImage.Format_RGB32
+_COLORMAP_ANCHORS = np.array([(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)], dtype=float)
+_COLORMAP = np.array([np.interp(np.linspace(0, 1, 256), np.linspace(0, 1, len(_COLORMAP_ANCHORS)), _COLORMAP_ANCHORS[:, channel]) for channel in range(3)]).T.astype(np.uint32)
+COLORMAP_RGB32 = (0xff000000 | (_COLORMAP[:, 0] << 16) | (_COLORMAP[:, 1] << 8) | _COLORMAP[:, 2]).astype(np.uint32)
+
+TRACE_COLORS = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
+BASE_PEAK_COLOR = QColor(30, 144, 255, 70)
+FRAGMENT_ION_COLOR = QColor(255, 140, 0, 70)
+
+def parse_windows(base_peak_text, fragment_ion_text):
+    '''Integration windows from the text of the GUI's base peak and fragment ion fields (as far as they can be read - the run checks them properly).
+    Returns a list of [lower, upper] m/z, base peak first, or an empty list if the base peak can't be read.
+    '''
+    base_peak = re.findall(r'-?\d+(?:\.\d+)?', base_peak_text)
+    if len(base_peak) != 2:
+        return []
+
+    windows = [sorted(map(float, base_peak))]
+    for pair in re.findall(r'\(([^()]*)\)', fragment_ion_text):
+        bounds = re.findall(r'-?\d+(?:\.\d+)?', pair)
+        if len(bounds) == 2:
+            windows.append(sorted(map(float, bounds)))
+    return windows
+
+def format_windows(windows):
+    '''Text for the GUI's base peak and fragment ion fields from a list of windows (base peak first).'''
+    base_peak_text = f'{windows[0][0]:.2f},{windows[0][1]:.2f}'
+    fragment_ion_text = ','.join(f'({lower:.2f},{upper:.2f})' for lower, upper in windows[1:])
+    return base_peak_text, fragment_ion_text
+
+def polygon_from_array(points):
+    '''QPolygonF of an (n, 2) array of x, y - filled through its buffer, which is much faster than making a QPointF for each point.'''
+    polygon = QPolygonF(len(points))
+    buffer = polygon.data()
+    buffer.setsize(len(points) * 2 * 8)
+    np.frombuffer(buffer, dtype=np.float64).reshape(-1, 2)[:] = points
+    return polygon
+
+def nice_ticks(lower, upper, max_ticks=8):
+    '''Round tick positions between lower and upper (at most about max_ticks of them).'''
+    if upper <= lower:
+        return []
+    step = (upper - lower) / max_ticks
+    magnitude = 10 ** np.floor(np.log10(step))
+    step = magnitude * min((factor for factor in (1, 2, 5, 10) if factor * magnitude >= step))
+    return list(np.arange(np.ceil(lower / step) * step, upper + step * 1e-9, step))
+
+class _MzPlot(QWidget):
+    '''Plot with the viewer's m/z range on the x axis - the zooming, panning and window dragging shared by the heatmap and the traces.'''
+    def __init__(self, viewer):
+        super().__init__(viewer)
+        self.viewer = viewer
+        self.drag = None #(what is dragged, window index, x where the drag started, m/z range and windows when it started)
+        self.setMouseTracking(True)
+        self.setMinimumHeight(150)
+
+    def plot_rect(self):
+        left, top, right, bottom = VIEWER_MARGINS
+        return QRectF(left, top, max(self.width() - left - right, 1), max(self.height() - top - bottom, 1))
+
+    def mz_to_x(self, mz):
+        rect = self.plot_rect()
+        lower, upper = self.viewer.mz_range
+        return rect.left() + (np.asarray(mz) - lower) / (upper - lower) * rect.width()
+
+    def x_to_mz(self, x):
+        rect = self.plot_rect()
+        lower, upper = self.viewer.mz_range
+        return lower + (x - rect.left()) / rect.width() * (upper - lower)
+
+    def query(self, rows=None):
+        '''Min/max of the visible m/z range at one bin per pixel (see MinMaxPyramid.query). Returns the m/z of the bin edges, and the minimum and maximum.'''
+        viewer = self.viewer
+        start = np.searchsorted(viewer.mz, viewer.mz_range[0], side='left') - 1
+        stop = np.searchsorted(viewer.mz, viewer.mz_range[1], side='right') + 1
+        edges, bin_min, bin_max = viewer.pyramid.query(start, stop, int(self.plot_rect().width()), rows)
+        return viewer.mz[np.minimum(edges, len(viewer.mz) - 1)], bin_min, bin_max
+
+    def hit_window(self, x):
+        '''What a mouse press at x grabs: ('lower' or 'upper', window) for an edge, ('move', window) inside a window, or ('pan', None).'''
+        #edges first, and the narrowest window first, so a small window inside or next to a big one can still be grabbed
+        windows = sorted(enumerate(self.viewer.windows), key=lambda item: item[1][1] - item[1][0])
+        for j, (lower, upper) in windows:
+            if abs(x - self.mz_to_x(lower)) <= VIEWER_EDGE_TOLERANCE:
+                return 'lower', j
+            if abs(x - self.mz_to_x(upper)) <= VIEWER_EDGE_TOLERANCE:
+                return 'upper', j
+        for j, (lower, upper) in windows:
+            if self.mz_to_x(lower) < x < self.mz_to_x(upper):
+                return 'move', j
+        return 'pan', None
+
+    def mousePressEvent(self, event):
+        if event.button() != Qt.LeftButton:
+            return
+        what, j = self.hit_window(event.x())
+        self.drag = (what, j, event.x(), list(self.viewer.mz_range), [list(window) for window in self.viewer.windows])
+
+    def mouseMoveEvent(self, event):
+        self.viewer.show_position(self, event.x(), event.y())
+
+        if self.drag is None:
+            what, _ = self.hit_window(event.x())
+            self.setCursor({'lower': Qt.SizeHorCursor, 'upper': Qt.SizeHorCursor, 'move': Qt.SizeAllCursor}.get(what, Qt.ArrowCursor))
+            return
+
+        what, j, start_x, start_range, start_windows = self.drag
+        #distances are measured with the m/z range the drag started with, because panning changes it
+        mz_per_pixel = (start_range[1] - start_range[0]) / self.plot_rect().width()
+        shift = (event.x() - start_x) * mz_per_pixel
+
+        if what == 'pan':
+            self.viewer.set_mz_range(start_range[0] - shift, start_range[1] - shift)
+            return
+
+        step = VIEWER_WINDOW_STEP
+        lower, upper = start_windows[j]
+        shift = np.round(shift / step) * step
+        if what == 'lower':
+            lower = min(lower + shift, upper - step)
+        elif what == 'upper':
+            upper = max(upper + shift, lower + step)
+        else:
+            lower, upper = lower + shift, upper + shift
+        self.viewer.set_window(j, np.round(lower, 2), np.round(upper, 2))
+
+    def mouseReleaseEvent(self, event):
+        if self.drag is None:
+            return
+        what, j, start_x, _, start_windows = self.drag
+        self.drag = None
+
+        if what == 'pan' and abs(event.x() - start_x) <= 2:
+            self.clicked(event.x(), event.y())
+        elif what != 'pan' and self.viewer.windows != start_windows:
+            self.viewer.windows_edited()
+
+    def mouseDoubleClickEvent(self, event):
+        self.viewer.reset_zoom()
+
+    def wheelEvent(self, event):
+        #zoom around the m/z under the cursor
+        factor = 0.8 ** (event.angleDelta().y() / 120)
+        mz = self.x_to_mz(event.x())
+        lower, upper = self.viewer.mz_range
+        self.viewer.set_mz_range(mz - (mz - lower) * factor, mz + (upper - mz) * factor)
+
+    def clicked(self, x, y):
+        pass
+
+    def leaveEvent(self, event):
+        self.viewer.status_label.setText('')
+
+    def draw_windows(self, painter, rect):
+        metrics = QFontMetrics(painter.font())
+        for j, (lower, upper) in enumerate(self.viewer.windows):
+            x_lower, x_upper = max(self.mz_to_x(lower), rect.left()), min(self.mz_to_x(upper), rect.right())
+            if x_upper < rect.left() or x_lower > rect.right():
+                continue
+            color = BASE_PEAK_COLOR if j == 0 else FRAGMENT_ION_COLOR
+            painter.fillRect(QRectF(x_lower, rect.top(), max(x_upper - x_lower, 1.), rect.height()), color)
+            painter.setPen(QPen(color.darker(150), 1))
+            painter.drawLine(QLineF(x_lower, rect.top(), x_lower, rect.bottom()))
+            painter.drawLine(QLineF(x_upper, rect.top(), x_upper, rect.bottom()))
+            painter.setPen(Qt.black)
+            painter.drawText(QPointF(x_lower + 2, rect.top() + metrics.ascent() + 1), 'base' if j == 0 else str(j))
+
+    def draw_mz_axis(self, painter, rect):
+        painter.setPen(Qt.black)
+        painter.drawRect(rect)
+        metrics = QFontMetrics(painter.font())
+        lower, upper = self.viewer.mz_range
+        for tick in nice_ticks(lower, upper, max(int(rect.width() / 80), 2)):
+            x = self.mz_to_x(tick)
+            painter.drawLine(QLineF(x, rect.bottom(), x, rect.bottom() + 4))
+            label = f'{tick:g}'
+            painter.drawText(QPointF(x - metrics.width(label) / 2, rect.bottom() + 6 + metrics.ascent()), label)
+
+class HeatmapPlot(_MzPlot):
+    '''Wavelength x m/z heatmap of the averaged spectra (brightest = largest intensity in the view, per pixel the largest value it covers).'''
+    def row_at(self, y):
+        rect = self.plot_rect()
+        row = int((rect.bottom() - y) / rect.height() * len(self.viewer.wavelengths))
+        return row if 0 <= row < len(self.viewer.wavelengths) else None
+
+    def clicked(self, x, y):
+        row = self.row_at(y)
+        if row is not None:
+            self.viewer.toggle_trace(row)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.white)
+        rect = self.plot_rect()
+
+        edges_mz, _, bin_max = self.query()
+        scaled = self.viewer.scale_intensities(bin_max)
+
+        #first wavelength at the bottom
+        pixels = np.ascontiguousarray(COLORMAP_RGB32[scaled[::-1]])
+        image = QImage(pixels.data, pixels.shape[1], pixels.shape[0], pixels.shape[1] * 4, QImage.Format_RGB32)
+        x_lower, x_upper = self.mz_to_x(edges_mz[0]), self.mz_to_x(edges_mz[-1])
+        painter.setClipRect(rect)
+        painter.drawImage(QRectF(x_lower, rect.top(), x_upper - x_lower, rect.height()), image)
+
+        #rows of the traces that are shown
+        num_rows = len(self.viewer.wavelengths)
+        for color, row in zip(TRACE_COLORS, self.viewer.selected_rows):
+            y = rect.bottom() - (row + 0.5) / num_rows * rect.height()
+            painter.setPen(QPen(QColor(color), 2))
+            painter.drawLine(QLineF(rect.left(), y, rect.left() + 8, y))
+
+        self.draw_windows(painter, rect)
+        painter.setClipping(False)
+        self.draw_mz_axis(painter, rect)
+
+        #wavelength axis
+        metrics = QFontMetrics(painter.font())
+        wavelengths = self.viewer.wavelengths
+        for tick in nice_ticks(wavelengths[0], wavelengths[-1], max(int(rect.height() / 30), 2)):
+            row = np.searchsorted(wavelengths, tick)
+            if row >= num_rows:
+                continue
+            y = rect.bottom() - (row + 0.5) / num_rows * rect.height()
+            label = f'{tick:g} nm'
+            painter.drawLine(QLineF(rect.left() - 4, y, rect.left(), y))
+            painter.drawText(QPointF(rect.left() - 6 - metrics.width(label), y + metrics.ascent() / 2 - 1), label)
+        painter.end()
+
+class TracePlot(_MzPlot):
+    '''Overlaid spectra of the selected wavelengths, drawn as min/max envelopes (one vertical stroke per pixel from the smallest to the largest value it covers).'''
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.white)
+        rect = self.plot_rect()
+        metrics = QFontMetrics(painter.font())
+        rows = self.viewer.selected_rows
+
+        if len(rows) > 0:
+            edges_mz, bin_min, bin_max = self.query(rows)
+            top = max(float(np.max(bin_max)), 1e-12)
+            x = self.mz_to_x((edges_mz[:-1] + edges_mz[1:]) / 2)
+
+            painter.setClipRect(rect)
+            painter.setRenderHint(QPainter.Antialiasing, False)
+            for k, row in enumerate(rows):
+                y_min = rect.bottom() - bin_min[k] / top * rect.height()
+                y_max = rect.bottom() - bin_max[k] / top * rect.height()
+                #zig-zag through (x, min), (x, max) of each pixel - draws the envelope as a single polyline
+                points = np.empty((len(x) * 2, 2))
+                points[0::2, 0] = points[1::2, 0] = x
+                points[0::2, 1], points[1::2, 1] = y_min, y_max
+                painter.setPen(QPen(QColor(TRACE_COLORS[k % len(TRACE_COLORS)]), 1))
+                painter.drawPolyline(polygon_from_array(points))
+            painter.setClipping(False)
+
+            #legend, and the intensity at the top of the plot
+            for k, row in enumerate(rows):
+                label = f'{self.viewer.wavelengths[row]:g} nm'
+                painter.setPen(QColor(TRACE_COLORS[k % len(TRACE_COLORS)]))
+                painter.drawText(QPointF(rect.right() - metrics.width(label) - 4, rect.top() + (k + 1) * metrics.height()), label)
+            painter.setPen(Qt.black)
+            painter.drawText(QPointF(4, rect.top() + metrics.ascent()), f'{top:.3g}')
+            painter.drawText(QPointF(4, rect.bottom()), '0')
+        else:
+            painter.drawText(rect, Qt.AlignCenter, 'Click a row of the heatmap to show the spectrum of that wavelength')
+
+        self.draw_windows(painter, rect)
+        self.draw_mz_axis(painter, rect)
+        painter.end()
+
+class SpectrumViewer(QWidget):
+    '''Window with the heatmap and traces of a raw data file. Usage is:
+    Raw_data.csv or Raw_data.npy file (see load_raw_data), and the integration windows to show (list of [lower, upper] m/z, base peak first).
+    windowsChanged is emitted with the new list of windows when one has been dragged.
+    '''
+    windowsChanged = pyqtSignal(object)
+
+    def __init__(self, raw_data_file, windows=None, parent=None):
+        super().__init__(parent)
+        self.wavelengths, self.mz, matrix = load_raw_data(raw_data_file)
+        if len(self.mz) < 2 or len(self.wavelengths) == 0:
+            raise ValueError(f'{raw_data_file} doesn\'t contain any spectra.')
+        self.pyramid = MinMaxPyramid(matrix)
+        self.windows = [list(window) for window in windows or []]
+        self.mz_range = [float(self.mz[0]), float(self.mz[-1])]
+        self.selected_rows = sorted(set(np.linspace(0, len(self.wavelengths) - 1, min(VIEWER_DEFAULT_TRACES, len(self.wavelengths))).round().astype(int).tolist()))
+
+        self.setWindowTitle(f'Spectrum viewer - {os.path.basename(raw_data_file)}')
+        self.resize(1100, 750)
+
+        self.heatmap = HeatmapPlot(self)
+        self.traces = TracePlot(self)
+        self.log_checkbox = QCheckBox('Log intensity scale')
+        self.log_checkbox.setChecked(True)
+        self.log_checkbox.toggled.connect(self.update_plots)
+        self.reset_button = QPushButton('Show everything')
+        self.reset_button.clicked.connect(self.reset_zoom)
+        self.status_label = QLabel('')
+        info_label = QLabel(f'{len(self.wavelengths)} wavelengths x {len(self.mz)} m/z values. Wheel: zoom, drag: pan, drag a window (or its edge) to move (or resize) it, click a heatmap row: show / hide its spectrum.')
+        info_label.setWordWrap(True)
+
+        controls = QHBoxLayout()
+        controls.addWidget(self.log_checkbox)
+        controls.addWidget(self.reset_button)
+        controls.addWidget(self.status_label, 1)
+
+        layout = QVBoxLayout()
+        layout.addWidget(info_label)
+        layout.addWidget(self.heatmap, 3)
+        layout.addWidget(self.traces, 2)
+        layout.addLayout(controls)
+        self.setLayout(layout)
+
+    def scale_intensities(self, values):
+        '''Colormap index (0-255) of each value, relative to the largest value in the view.'''
+        top = max(float(np.max(values)), 1e-12)
+        scaled = np.clip(values / top, 0, 1)
+        if self.log_checkbox.isChecked():
+            scaled = np.log10(1 + 999 * scaled) / 3 #three decades
+        return (scaled * 255).astype(np.uint8)
+
+    def update_plots(self):
+        self.heatmap.update()
+        self.traces.update()
+
+    def set_mz_range(self, lower, upper):
+        '''Shows m/z lower to upper (kept within the data, and at least a few points wide).'''
+        full_lower, full_upper = float(self.mz[0]), float(self.mz[-1])
+        width = min(max(upper - lower, 4 * (full_upper - full_lower) / (len(self.mz) - 1)), full_upper - full_lower)
+        lower = min(max(lower, full_lower), full_upper - width)
+        self.mz_range = [lower, lower + width]
+        self.update_plots()
+
+    def reset_zoom(self):
+        self.set_mz_range(float(self.mz[0]), float(self.mz[-1]))
+
+    def toggle_trace(self, row):
+        if row in self.selected_rows:
+            self.selected_rows.remove(row)
+        elif len(self.selected_rows) < VIEWER_MAX_TRACES:
+            self.selected_rows = sorted(self.selected_rows + [row])
+        self.update_plots()
+
+    def set_window(self, j, lower, upper):
+        self.windows[j] = [float(lower), float(upper)]
+        self.update_plots()
+
+    def set_windows(self, windows):
+        '''Replaces the windows that are shown (e.g. after the GUI's fields were edited).'''
+        windows = [list(window) for window in windows]
+        if windows != self.windows:
+            self.windows = windows
+            self.update_plots()
+
+    def windows_edited(self):
+        self.windowsChanged.emit([list(window) for window in self.windows])
+
+    def show_position(self, plot, x, y):
+        '''Shows the m/z (and, over the heatmap, the wavelength and intensity) under the mouse.'''
+        mz = plot.x_to_mz(x)
+        text = f'm/z {mz:.2f}'
+        if plot is self.heatmap:
+            row = plot.row_at(y)
+            column = int(np.clip(np.searchsorted(self.mz, mz), 0, len(self.mz) - 1))
+            if row is not None:
+                text += f'   {self.wavelengths[row]:g} nm   intensity {float(self.pyramid.levels[0][1][row, column]):.4g}'
+        self.status_label.setText(text)
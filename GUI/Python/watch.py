@@ -0,0 +1,228 @@
+import os, re, time, traceback
+import numpy as np
+from Python.workflows import convert_wiff_files_to_mzml, PE_calc_array, PE_calc_noNorm_array
+from Python.main import integrate_mzml_file, calculate_PE_row, PE_column_names
+from Python.result_cache import IntegrationResultCache
+from Python.log import redirect_stdout
+
+# Live acquisition mode. Instead of analyzing a directory once the whole wavelength scan is done, the directory is polled while the experiment runs,
+# and each new wavelength file is converted (.wiff) and integrated as soon as it is complete. Its row is appended to the photofragmentation efficiency .csv
+# (and printed to the output) right away, so the action spectrum builds up during the experiment. Only new files are processed on each poll.
+# A .wiff file holds every wavelength of an acquisition, and msconvert writes one <name>-<wavelength>.mzML file per wavelength (as in main()), so each .wiff file
+# gives as many rows as .mzML files come out of its conversion - these are integrated exactly like the .mzML files of the mzML watch mode.
+# A file counts as complete once its size and modification time have not changed for settle_time seconds (and, for .mzML files, once the closing tag has been written).
+# Rows are matched to the laser power data file by wavelength rather than by position, since the files arrive one at a time.
+
+def wavelength_from_file_name(file_name):
+    '''Wavelength written as the last number after "Laser" in the file name (same as main()). Returns None if there isn't one.'''
+    try:
+        return float(re.findall(r'\d+', file_name.split('Laser')[-1])[-1])
+    except IndexError:
+        return None
+
+def file_signature(path):
+    '''Size and modification time of a file (and of the .wiff.scan file that goes with a .wiff file, which is where SCIEX instruments write the spectra).'''
+    signature = []
+    for file_path in (path, path + '.scan') if path.endswith('.wiff') else (path,):
+        try:
+            stat = os.stat(file_path)
+            signature.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+def mzml_files_from_wiff(mzml_directory, wiff_file):
+    '''Names of the .mzML files converted from a .wiff file (<name>.mzML, or <name>-<sample>.mzML for each sample - ie. wavelength - in it), sorted by wavelength.'''
+    pattern = re.compile(re.escape(os.path.splitext(wiff_file)[0]) + r'(-.+)?\.mzML')
+    mzml_files = [f for f in os.listdir(mzml_directory) if pattern.fullmatch(f)]
+    return sorted(mzml_files, key=lambda f: (wavelength_from_file_name(f) is None, wavelength_from_file_name(f) or 0, f))
+
+def is_complete_mzml(path):
+    '''True if an .mzML file has been written to the end (ie. ends with the closing mzML or indexedmzML tag).'''
+    try:
+        with open(path, 'rb') as file:
+            file.seek(max(os.path.getsize(path) - 4096, 0))
+            tail = file.read()
+    except OSError:
+        return False
+    return b'</mzML>' in tail or b'</indexedmzML>' in tail
+
+def read_laser_data(power_data_file_name):
+    '''Laser power data file as a structured array (Wavelength, LaserPower, PowerStdDev), like main() reads it.'''
+    return np.atleast_1d(np.genfromtxt(power_data_file_name, delimiter=',', dtype=None, names=['Wavelength', 'LaserPower', 'PowerStdDev'], encoding=None))
+
+def watch_directory(directory, base_peak_range, fragment_ion_ranges, power_data_file_name=None, update_output=None, integration_mode='grid', extract_mzml_from_wiff=False,
+                    use_cache=False, cache_results=False, cancel_event=None, progress_callback=None, poll_interval=5., settle_time=None, idle_timeout=None, compression='none', intensity_32bit=False):
+    '''Watches a directory and calculates the photofragmentation efficiency of each new wavelength file as it is acquired. Usage is:
+    directory to watch (.mzML files, or .wiff files with extract_mzml_from_wiff - these are converted into directory/mzml_directory), base peak range, fragment ion ranges,
+    laser power data file (or None), the integration mode, whether to use the spectra cache and the integration result cache, the time between polls of the directory,
+    how long a file has to stay unchanged before it is processed (defaults to poll_interval), and how long to wait without any new or changed file before stopping (None to keep watching).
+    .wiff files are converted with the given compression and 32-bit intensity setting (see MZML_COMPRESSIONS in workflows.py).
+    Keeps watching until cancel_event (a threading.Event) is set or idle_timeout passes. progress_callback(files processed, files seen) is called after each file.
+    Returns the name of the .csv file written, or None if no file was processed.
+    '''
+    # Redirect print outputs to the GUI output window
+    redirect_stdout(update_output)
+
+    settle_time = poll_interval if settle_time is None else settle_time
+    extension = '.wiff' if extract_mzml_from_wiff else '.mzML'
+    mzml_directory = os.path.join(directory, 'mzml_directory') if extract_mzml_from_wiff else directory
+    os.makedirs(mzml_directory, exist_ok=True)
+
+    PE_function = PE_calc_array if power_data_file_name is not None else PE_calc_noNorm_array
+    laser_data = read_laser_data(power_data_file_name) if power_data_file_name is not None else None
+
+    parent_mz = (np.round(np.average(base_peak_range),2))
+    integration_bounds_list = [base_peak_range] + list(fragment_ion_ranges)
+    result_cache = IntegrationResultCache(mzml_directory) if cache_results else None
+
+    #same location and naming as the .csv written by main()
+    output_file = os.path.join(os.path.dirname(mzml_directory),'photofragmentation_efficiency.csv')
+    index = 0
+    while os.path.exists(output_file):
+        index += 1
+        output_file = os.path.join(os.path.dirname(mzml_directory),f'photofragmentation_efficiency_{index}.csv')
+
+    column_names = PE_column_names(fragment_ion_ranges)
+    with open(output_file, 'w') as file:
+        file.write(','.join(column_names) + '\n')
+
+    update_output(f'Watching {directory} for new {extension} files (every {poll_interval} seconds). Rows are appended to {output_file} as files are processed.\n\n')
+
+    signatures = {} #last size and modification time of each file that hasn't been processed yet, and when it last changed
+    processed = set() #files that have been processed (or skipped)
+    rows_written = 0
+    last_change_time = time.time()
+
+    while cancel_event is None or not cancel_event.is_set():
+
+        #files that haven't been processed yet, and haven't changed for settle_time seconds
+        complete_files = []
+        for file_name in sorted(f for f in os.listdir(directory) if f.endswith(extension) and f not in processed):
+            signature = file_signature(os.path.join(directory, file_name))
+            if file_name not in signatures or signatures[file_name][0] != signature:
+                signatures[file_name] = (signature, time.time())
+                last_change_time = time.time()
+            elif time.time() - signatures[file_name][1] >= settle_time and None not in signature:
+                if extension == '.wiff' or is_complete_mzml(os.path.join(directory, file_name)):
+                    complete_files.append(file_name)
+
+        #process in order of wavelength
+        for file_name in sorted(complete_files, key=lambda f: (wavelength_from_file_name(f) is None, wavelength_from_file_name(f) or 0)):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+
+            processed.add(file_name)
+            del signatures[file_name]
+
+            rows = process_new_file(directory, mzml_directory, file_name, integration_bounds_list, parent_mz, PE_function, power_data_file_name, laser_data, update_output,
+                                    integration_mode, extract_mzml_from_wiff, use_cache, result_cache, cancel_event, compression, intensity_32bit)
+
+            for row in rows:
+                #the row goes straight to disk, so everything processed so far is kept even if the program is closed
+                with open(output_file, 'a') as file:
+                    np.savetxt(file, row[np.newaxis], delimiter=',', fmt='%.6f')
+                rows_written += 1
+
+                update_output(f'{row[0]:.0f}nm: total PE = {row[1]:.6g} +/- {row[2]:.6g}' + ''.join(f', {name} = {row[k]:.6g} +/- {row[k + 1]:.6g}' for k, name in zip(range(3, len(row), 2), column_names[3::2])) + '\n')
+            if progress_callback is not None:
+                progress_callback(len(processed), len(processed) + len(signatures))
+
+        if idle_timeout is not None and len(signatures) == 0 and time.time() - last_change_time >= idle_timeout:
+            update_output(f'No new or changed {extension} files for {idle_timeout} seconds.\n')
+            break
+
+        #wait for the next poll (returns straight away when the run is cancelled)
+        if cancel_event is not None:
+            cancel_event.wait(poll_interval)
+        else:
+            time.sleep(poll_interval)
+
+    update_output(f'Stopped watching {directory}. {rows_written} rows were written to {output_file}\n\n')
+    if rows_written == 0:
+        os.remove(output_file)
+        return None
+    return output_file
+
+def process_new_file(directory, mzml_directory, file_name, integration_bounds_list, parent_mz, PE_function, power_data_file_name, laser_data, update_output,
+                     integration_mode, extract_mzml_from_wiff, use_cache, result_cache, cancel_event, compression='none', intensity_32bit=False):
+    '''Converts (if needed) and integrates one new file, and calculates its rows of the photofragmentation efficiency table: one row for an .mzML file,
+    and one for each .mzML file converted from a .wiff file. Returns the list of rows (empty if the file was skipped).
+    Problems with a single file are reported and the file is skipped, so one bad file doesn't stop the experiment from being watched.
+    '''
+    if not extract_mzml_from_wiff:
+        row = process_mzml_file(mzml_directory, file_name, integration_bounds_list, parent_mz, PE_function, power_data_file_name, laser_data, update_output, integration_mode, use_cache, result_cache)
+        return [row] if row is not None else []
+
+    try:
+        #a file that was already converted by an earlier run isn't converted again
+        if not any(is_complete_mzml(os.path.join(mzml_directory, mzml_file)) for mzml_file in mzml_files_from_wiff(mzml_directory, file_name)):
+            convert_wiff_files_to_mzml([file_name], directory, mzml_directory, update_output=update_output, cancel_event=cancel_event, compression=compression, intensity_32bit=intensity_32bit)
+        mzml_files = mzml_files_from_wiff(mzml_directory, file_name)
+    except Exception as e:
+        update_output(f'Problem encountered when converting {file_name}:\n{e}\nTraceback: {traceback.format_exc()}\nSkipping it.\n')
+        return []
+
+    if len(mzml_files) == 0:
+        update_output(f'No .mzML files were written for {file_name}. Skipping it.\n')
+        return []
+
+    rows = []
+    for mzml_file in mzml_files:
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        row = process_mzml_file(mzml_directory, mzml_file, integration_bounds_list, parent_mz, PE_function, power_data_file_name, laser_data, update_output, integration_mode, use_cache, result_cache)
+        if row is not None:
+            rows.append(row)
+    return rows
+
+def process_mzml_file(mzml_directory, mzml_file, integration_bounds_list, parent_mz, PE_function, power_data_file_name, laser_data, update_output, integration_mode, use_cache, result_cache):
+    '''Integrates one .mzML file and calculates its row of the photofragmentation efficiency table. Returns None if the file was skipped.'''
+    wavelength = wavelength_from_file_name(mzml_file)
+    if wavelength is None:
+        update_output(f'Could not extract the wavelength from {mzml_file}. Does the filename contain the text: "Laser"? Skipping it.\n')
+        return None
+
+    #laser power for this wavelength - the power data file is read again in case it is being written during the experiment too
+    laser_power, power_stdev = 0., 0. #not used without power normalization
+    if power_data_file_name is not None:
+        for attempt in range(2):
+            matches = np.flatnonzero(np.isclose(laser_data['Wavelength'], wavelength))
+            if len(matches) > 0 or attempt == 1:
+                break
+            try:
+                laser_data = read_laser_data(power_data_file_name)
+            except Exception as e:
+                update_output(f'Could not read {power_data_file_name}: {e}\n')
+                break
+
+        if len(matches) == 0:
+            update_output(f'There is no laser power for {wavelength}nm in {power_data_file_name}. Skipping {mzml_file}.\n')
+            return None
+        laser_power, power_stdev = laser_data['LaserPower'][matches[0]], laser_data['PowerStdDev'][matches[0]]
+
+    try:
+        #windows that are already in the result cache don't have to be integrated again
+        window_integrations = [None] * len(integration_bounds_list)
+        if result_cache is not None:
+            fingerprint = result_cache.fingerprint(mzml_file)
+            result_keys = [result_cache.key(fingerprint, integration_bounds, parent_mz, integration_mode) for integration_bounds in integration_bounds_list]
+            window_integrations = [result_cache.get(key) for key in result_keys]
+
+        missing = [j for j, window_integration in enumerate(window_integrations) if window_integration is None]
+        if len(missing) > 0:
+            new_integrations, mzml_runtime, _, _, _ = integrate_mzml_file(mzml_directory, mzml_file, [integration_bounds_list[j] for j in missing], parent_mz, integration_mode, use_cache, update_output=update_output)
+            for j, window_integration in zip(missing, new_integrations):
+                window_integrations[j] = window_integration
+                if result_cache is not None:
+                    result_cache.put(result_keys[j], window_integration)
+            update_output(f'Integration for {np.round((wavelength),0)}nm has completed in {mzml_runtime} seconds.\n')
+
+        if result_cache is not None:
+            result_cache.save()
+
+        return calculate_PE_row(wavelength, laser_power, power_stdev, window_integrations[0], window_integrations[1:], PE_function, update_output=update_output, fragment_ion_ranges=integration_bounds_list[1:])
+
+    except Exception as e:
+        update_output(f'Problem encountered when processing {mzml_file}:\n{e}\nTraceback: {traceback.format_exc()}\nSkipping it.\n')
+        return None
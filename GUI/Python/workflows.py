@@ -1,61 +1,477 @@
-import os, re, sys, traceback, subprocess
+import os, re, time, traceback, subprocess, threading, queue, base64, zlib, tempfile, itertools
 import numpy as np
-import pyteomics.mzml as mzml
-import pandas as pd
-from PyQt5.QtWidgets import QApplication
-from io import StringIO
-
-class TextRedirect(StringIO):
-    def __init__(self, textWritten=None, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.update_output = textWritten
-
-    def write(self, text):
-        super().write(text)
-        self.update_output(text)
-
-def convert_wiff_to_mzml(wiff_file, directory, mzml_directory, update_output=None):
+from contextlib import closing
+from xml.etree import ElementTree
+from Python.spectra_cache import load_cached_spectra, save_cached_spectra
+from Python.spectra_store import SpectraStore, is_spectra_store
+from Python.profiling import StageTimer
+from Python.log import redirect_stdout
+from Python.options import INTEGRATION_MODES, RAW_DATA_FORMATS, MZML_COMPRESSIONS
+
+#Common m/z grid used for integration: 0 to (parent m/z + INTEGRATION_GRID_MARGIN) in INTEGRATION_GRID_STEP increments
+INTEGRATION_GRID_STEP = 0.01
+INTEGRATION_GRID_MARGIN = 50.
+#Grid points are only padded onto a scan (with zero intensity) when they lie further than this (in Da) outside its m/z range. Otherwise an m/z value that is off by
+#rounding error (e.g. numpress linear encoded m/z values, relative error 2e-9) would put a zero on the grid point right next to the first or last point of the scan
+INTEGRATION_GRID_EDGE_TOLERANCE = 1e-5
+
+#Readers for mzml files (see iter_spectra)
+#fast      - read_spectra_fast: streams the XML and decodes only the m/z and intensity arrays of each spectrum. Files it can't read (e.g. other binary encodings) are handed to pyteomics
+#pyteomics - pyteomics.mzml.read, which builds the full nested dict of every spectrum (the original reader)
+MZML_READERS = ['fast', 'pyteomics']
+
+#PSI-MS accessions of the binary data arrays that the fast reader understands
+MZML_ARRAY_NAMES = {'MS:1000514': 'm/z array', 'MS:1000515': 'intensity array'}
+MZML_ARRAY_DTYPES = {'MS:1000521': np.dtype('<f4'), 'MS:1000523': np.dtype('<f8')} #32-bit float, 64-bit float (little endian, as mzML specifies)
+#compression accession -> (zlib compressed?, numpress encoding or None)
+MZML_ARRAY_COMPRESSIONS = {'MS:1000576': (False, None), 'MS:1000574': (True, None),
+                           'MS:1002312': (False, 'linear'), 'MS:1002313': (False, 'pic'), 'MS:1002314': (False, 'slof'),
+                           'MS:1002746': (True, 'linear'), 'MS:1002747': (True, 'pic'), 'MS:1002748': (True, 'slof')}
+
+#Largest differences from the uncompressed conversion accepted by verify_mzml_compression: m/z in Da (well below the 0.01 Da integration grid),
+#and intensity as a fraction of the base peak of the scan
+MZML_COMPRESSION_TOLERANCE = {'m/z array': 1e-4, 'intensity array': 1e-3}
+
+#Number of interpolated scans the cumsum mode stacks at a time - bounds its memory use (about 200 MB for a 1000 m/z grid) regardless of the number of scans in a file
+CUMSUM_BLOCK_SCANS = 256
+
+class RunningStats:
+    '''Single pass mean and standard deviation (Welford's algorithm), so the values don't have to be kept in memory. Usage is:
+    shape of the values (() for single numbers, (n,) for spectra or one value per window), and whether to keep the values as well (e.g. for a bootstrap, see bootstrap.py).
+    Add values with add(), or a block of them (stacked along the first axis) with add_block().
+    mean() and std() match np.mean and np.std (population standard deviation) of all values added, and are nan if nothing was added. values() returns the values kept.
+    '''
+    def __init__(self, shape=(), keep_values=False):
+        self.count = 0
+        self._mean = np.zeros(shape)
+        self._m2 = np.zeros(shape) #sum of squared differences from the mean
+        self._values = [] if keep_values else None
+
+    def add(self, value):
+        if self._values is not None:
+            self._values.append(np.array(value, dtype=float)[None])
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+
+    def add_block(self, values):
+        #combine the statistics of the block with the running ones (Chan et al.), rather than adding the values one at a time
+        block_count = len(values)
+        if block_count == 0:
+            return
+        if self._values is not None:
+            self._values.append(np.array(values, dtype=float))
+        block_mean = np.mean(values, axis=0)
+        block_m2 = np.sum((values - block_mean)**2, axis=0)
+
+        total = self.count + block_count
+        delta = block_mean - self._mean
+        self._mean += delta * (block_count / total)
+        self._m2 += block_m2 + delta**2 * (self.count * block_count / total)
+        self.count = total
+
+    def mean(self):
+        return self._mean.copy() if self.count > 0 else np.full_like(self._mean, np.nan)
+
+    def std(self):
+        return np.sqrt(self._m2 / self.count) if self.count > 0 else np.full_like(self._m2, np.nan)
+
+    def values(self):
+        '''Every value added, stacked along the first axis (None if the values weren't kept).'''
+        if self._values is None:
+            return None
+        return np.concatenate(self._values) if len(self._values) > 0 else np.empty((0,) + self._mean.shape)
+
+def convert_wiff_to_mzml(wiff_file, directory, mzml_directory, update_output=None, compression='none', intensity_32bit=False):
     ''' Function to convert .wiff files to .mzml using msconvert
-    input is .wiff file, directory that contains .wiff files, and directory to output mzml files to'''
+    input is .wiff file, directory that contains .wiff files, directory to output mzml files to, the encoding of the binary arrays (one of MZML_COMPRESSIONS) and whether to write 32-bit intensities'''
     
     # Redirect print outputs to the GUI output window
-    sys.stdout = TextRedirect(textWritten=update_output)
+    redirect_stdout(update_output)
 
     mzml_file = f'{os.path.splitext(wiff_file)[0]}.mzml'
     
     try:
-        subprocess.run(['msconvert', os.path.join(directory, wiff_file), '-o', mzml_directory, '--mzML', '--64'])
+        subprocess.run(msconvert_command(wiff_file, directory, mzml_directory, compression, intensity_32bit), check=True)
         return mzml_file
     
     except subprocess.CalledProcessError as cpe:
         update_output(f'Subprocess error converting {wiff_file} to mzML: {cpe}\nTraceback: {traceback.format_exc()}\n')
-        QApplication.processEvents()  # Allow the GUI to update        
-        raise subprocess.CalledProcessError('msconvert command failed during .wiff file conversion.')
+        raise
 
     except Exception as e:
         update_output(f'Unexpected error converting {wiff_file} to mzML: {e}\nTraceback: {traceback.format_exc()}\n')
-        QApplication.processEvents()  # Allow the GUI to update        
         raise Exception('Unexpected error during .wiff file conversion.')
     
+def msconvert_command(wiff_file, directory, mzml_directory, compression='none', intensity_32bit=False):
+    '''Builds the msconvert command line used to convert a .wiff file to .mzml. msconvert is looked up on the PATH.
+    compression is one of MZML_COMPRESSIONS, and with intensity_32bit the intensities are written as 32-bit floats (m/z values are always 64-bit).'''
+    if compression not in MZML_COMPRESSIONS:
+        raise ValueError(f'Unknown mzml compression "{compression}". Please use one of: {", ".join(MZML_COMPRESSIONS)}')
+    precision = ['--mz64', '--inten32'] if intensity_32bit else ['--64']
+    return ['msconvert', os.path.join(directory, wiff_file), '-o', mzml_directory, '--mzML'] + precision + MZML_COMPRESSIONS[compression]
+
+def convert_wiff_files_to_mzml(wiff_files, directory, mzml_directory, max_concurrent=1, update_output=None, cancel_event=None, compression='none', intensity_32bit=False):
+    ''' Function to convert several .wiff files to .mzml using msconvert, running up to max_concurrent msconvert processes at the same time.
+    input is a list of .wiff files, directory that contains .wiff files, directory to output mzml files to, the maximum number of msconvert processes running at once,
+    the encoding of the binary arrays (one of MZML_COMPRESSIONS) and whether to write 32-bit intensities.
+    The output of every msconvert process is streamed to the output window as it runs. Raises CalledProcessError once all files are done if any msconvert process failed.
+    If cancel_event (a threading.Event) is set, no new conversions are started and the ones already running are allowed to finish.'''
+
+    # Redirect print outputs to the GUI output window
+    redirect_stdout(update_output)
+
+    #lines from every msconvert process end up here (from reader threads) and are printed by this thread, which owns the GUI
+    output_lines = queue.Queue()
+
+    def stream_output(wiff_file, process):
+        for line in process.stdout:
+            output_lines.put(f'[{wiff_file}] {line}')
+        process.stdout.close()
+
+    def print_output():
+        while not output_lines.empty():
+            update_output(output_lines.get())
+
+    pending_files = list(wiff_files)
+    running = {} #process -> (wiff file, start time, reader thread)
+    failures = [] #(wiff file, CalledProcessError) for every msconvert process that did not exit cleanly
+
+    while pending_files or running:
+
+        if cancel_event is not None and cancel_event.is_set() and pending_files:
+            update_output(f'Conversion cancelled - {len(pending_files)} .wiff files will not be converted.\n')
+            pending_files = []
+
+        #start new msconvert processes until the limit is reached
+        while pending_files and len(running) < max_concurrent:
+            wiff_file = pending_files.pop(0)
+            command = msconvert_command(wiff_file, directory, mzml_directory, compression, intensity_32bit)
+            try:
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
+            except Exception as e:
+                update_output(f'Unexpected error converting {wiff_file} to mzML: {e}\nTraceback: {traceback.format_exc()}\n')
+                failures.append((wiff_file, e))
+                continue
+
+            reader = threading.Thread(target=stream_output, args=(wiff_file, process), daemon=True)
+            reader.start()
+            running[process] = (wiff_file, time.time(), reader)
+
+        print_output()
+
+        #check which processes have finished
+        for process in [process for process in running if process.poll() is not None]:
+            wiff_file, wiff_stime, reader = running.pop(process)
+            reader.join()
+            print_output()
+
+            elapsed_time = np.round((time.time() - wiff_stime),1)
+            if process.returncode != 0:
+                cpe = subprocess.CalledProcessError(process.returncode, process.args)
+                update_output(f'Subprocess error converting {wiff_file} to mzML after {elapsed_time}s: {cpe}\n')
+                failures.append((wiff_file, cpe))
+            else:
+                update_output(f'The wiff file:\n{wiff_file}\nhas been successfully extracted in {elapsed_time}s.\n')
+
+        time.sleep(0.05)
+
+    if failures:
+        wiff_file, error = failures[0]
+        update_output(f'{len(failures)} of {len(wiff_files)} .wiff files could not be converted: {", ".join(f for f, _ in failures)}\n')
+        if isinstance(error, subprocess.CalledProcessError):
+            raise error
+        raise Exception(f'Unexpected error during conversion of {wiff_file}.')
+
+def compare_mzml_files(reference_path, test_path):
+    '''Largest differences between the spectra of two mzml files of the same acquisition (e.g. an uncompressed and a compressed conversion). Usage is:
+    paths of the two mzml files. Returns {'m/z array': largest m/z difference in Da, 'intensity array': largest intensity difference as a fraction of the base peak of its scan}.
+    '''
+    differences = {'m/z array': 0., 'intensity array': 0.}
+    with closing(iter_spectra(reference_path)) as reference_spectra, closing(iter_spectra(test_path)) as test_spectra:
+        for scan, (reference, test) in enumerate(itertools.zip_longest(reference_spectra, test_spectra)):
+            if reference is None or test is None:
+                raise ValueError(f'{reference_path} and {test_path} have a different number of scans.')
+            if len(reference['m/z array']) != len(test['m/z array']) or len(reference['intensity array']) != len(test['intensity array']):
+                raise ValueError(f'Scan {scan + 1} has a different number of points in {reference_path} and {test_path}.')
+            if len(reference['m/z array']) == 0:
+                continue
+
+            differences['m/z array'] = max(differences['m/z array'], float(np.max(np.abs(test['m/z array'] - reference['m/z array']))))
+            base_peak = np.max(reference['intensity array'])
+            if base_peak > 0:
+                differences['intensity array'] = max(differences['intensity array'], float(np.max(np.abs(test['intensity array'] - reference['intensity array'])) / base_peak))
+    return differences
+
+def verify_mzml_compression(wiff_file, directory, mzml_directory, compression='none', intensity_32bit=False, update_output=None):
+    '''Checks a compressed conversion of a .wiff file against the uncompressed baseline. Usage is:
+    a .wiff file that has been converted into mzml_directory, directory that contains the .wiff file, the mzml directory, and the compression and 32-bit intensity setting it was converted with.
+    The .wiff file is converted again without compression (into a temporary directory) and the spectra of both conversions are compared.
+    Returns True if the differences are within MZML_COMPRESSION_TOLERANCE.
+    '''
+    mzml_file = f'{os.path.splitext(wiff_file)[0]}.mzML'
+    with tempfile.TemporaryDirectory() as baseline_directory:
+        convert_wiff_to_mzml(wiff_file, directory, baseline_directory, update_output=update_output)
+        baseline_size = os.path.getsize(os.path.join(baseline_directory, mzml_file))
+        differences = compare_mzml_files(os.path.join(baseline_directory, mzml_file), os.path.join(mzml_directory, mzml_file))
+
+    size = os.path.getsize(os.path.join(mzml_directory, mzml_file))
+    within_tolerance = all(differences[array] <= MZML_COMPRESSION_TOLERANCE[array] for array in differences)
+    update_output(f'Checked the {compression} compression' + (' with 32-bit intensities' if intensity_32bit else '') + f' of {wiff_file} against an uncompressed conversion: '
+                  f'{size / 1024**2:.2f} MB instead of {baseline_size / 1024**2:.2f} MB ({100 * size / baseline_size:.0f}%), largest m/z difference {differences["m/z array"]:.2g} Da '
+                  f'(tolerance {MZML_COMPRESSION_TOLERANCE["m/z array"]:g}), largest intensity difference {100 * differences["intensity array"]:.2g}% of the base peak '
+                  f'(tolerance {100 * MZML_COMPRESSION_TOLERANCE["intensity array"]:g}%). ' + ('OK.' if within_tolerance else 'This is outside the tolerance!') + '\n')
+    return within_tolerance
+
+def list_mzml_files(directory):
+    '''Names of the mzml files in a directory - or of the mzml files that were consolidated into it, if the directory is a spectra store (see spectra_store.py).'''
+    if is_spectra_store(directory):
+        return list(SpectraStore(directory).files)
+    return [f for f in os.listdir(directory) if f.endswith('.mzML')]
+
+class UnsupportedMzmlError(ValueError):
+    '''Raised by read_spectra_fast for mzml files it can't decode itself (iter_spectra reads those with pyteomics instead).'''
+
+def _decode_numpress_ints(data):
+    '''Decodes the stream of half-byte encoded 32-bit integers that all numpress encodings are built on. Returns them (unsigned) as an int64 array.
+    Each integer is a head half-byte h followed by 8 - n half-bytes (least significant first), where the n = h (or h - 8 for negative numbers) most significant half-bytes
+    are left out because they are 0 (or 0xf). Finding where each integer starts is done by pointer doubling, so the whole stream is decoded with array operations.
+    '''
+    data = np.frombuffer(data, dtype=np.uint8)
+    half_bytes = np.empty(2 * len(data), dtype=np.int64)
+    half_bytes[0::2] = data >> 4
+    half_bytes[1::2] = data & 0xf
+    num_half_bytes = len(half_bytes)
+
+    #number of left out half-bytes, and the position of the next integer if an integer starts at each position (num_half_bytes past the end)
+    left_out = np.where(half_bytes <= 8, half_bytes, half_bytes - 8)
+    jump = np.append(np.minimum(np.arange(num_half_bytes) + 9 - left_out, num_half_bytes), num_half_bytes)
+
+    #starts holds the positions of the first 2**k integers, and jump how far 2**k integers reach from each position
+    starts = np.zeros(1, dtype=np.int64)
+    while starts[-1] < num_half_bytes:
+        starts = np.concatenate([starts, jump[starts]])
+        jump = jump[jump]
+    starts = starts[starts < num_half_bytes]
+
+    #a trailing half-byte that pads the last byte doesn't hold a whole integer
+    starts = starts[starts + 9 - left_out[starts] <= num_half_bytes]
+
+    n = left_out[starts][:, np.newaxis]
+    positions = np.arange(8)
+    stored = positions < 8 - n
+    digits = half_bytes[np.minimum(starts[:, np.newaxis] + 1 + positions, num_half_bytes - 1)]
+    values = np.sum(np.where(stored, digits << (4 * positions), 0), axis=1)
+
+    #the left out half-bytes are all 0xf
+    ones = half_bytes[starts] > 8
+    values[ones] += (1 << 32) - (1 << (4 * (8 - n[ones, 0])))
+    return values
+
+def decode_numpress(data, encoding):
+    '''Decodes a numpress encoded array (as in MSNumpress, the reference implementation). Usage is:
+    decoded bytes (after base64 and zlib decoding) and the encoding - linear, pic or slof. Returns a float64 array.
+    '''
+    if encoding == 'pic':
+        return _decode_numpress_ints(data).astype(np.float64)
+
+    if len(data) < 8:
+        raise ValueError(f'Corrupt numpress {encoding} data - too short for the header.')
+    fixed_point = np.frombuffer(data[:8], dtype='>f8')[0] #stored big endian
+
+    if encoding == 'slof':
+        return np.exp(np.frombuffer(data[8:], dtype='<u2') / fixed_point) - 1
+
+    if encoding == 'linear':
+        if len(data) in (8, 12):
+            return np.frombuffer(data[8:], dtype='<u4') / fixed_point
+        if len(data) < 16:
+            raise ValueError('Corrupt numpress linear data - too short for the first two values.')
+
+        #each value is predicted linearly from the two before it, and the stream holds the differences from the predictions:
+        #y[k] = 2 * y[k-1] - y[k-2] + diff[k], ie. the differences are summed up twice
+        first, second = np.frombuffer(data[8:16], dtype='<u4').astype(np.int64)
+        differences = _decode_numpress_ints(data[16:])
+        differences[differences >= 1 << 31] -= 1 << 32 #signed
+        steps = (second - first) + np.cumsum(differences)
+        return np.concatenate([[first, second], second + np.cumsum(steps)]) / fixed_point
+
+    raise ValueError(f'Unknown numpress encoding "{encoding}".')
+
+def _decode_binary_data_array(element, array_length=None):
+    '''Name ('m/z array' or 'intensity array') and values of a binaryDataArray element. The name is None for any other array (it isn't decoded).
+    array_length (the defaultArrayLength of the spectrum) is the number of values expected, which numpress decoding needs to drop padding.
+    '''
+    name, dtype, compression, binary = None, None, None, None
+    for child in element:
+        tag = child.tag.rpartition('}')[2]
+        if tag == 'cvParam':
+            accession = child.get('accession')
+            if accession in MZML_ARRAY_NAMES:
+                name = MZML_ARRAY_NAMES[accession]
+            elif accession in MZML_ARRAY_DTYPES:
+                dtype = MZML_ARRAY_DTYPES[accession]
+            elif accession in MZML_ARRAY_COMPRESSIONS:
+                compression = MZML_ARRAY_COMPRESSIONS[accession]
+        elif tag == 'referenceableParamGroupRef':
+            raise UnsupportedMzmlError('Binary data arrays described by referenceable parameter groups are not supported.')
+        elif tag == 'binary':
+            binary = child.text or '' #an empty <binary/> is an empty array
+
+    if name is None:
+        return None, None
+    if dtype is None or compression is None:
+        raise UnsupportedMzmlError(f'Unknown data type or compression of the {name}.')
+    if binary is None:
+        raise UnsupportedMzmlError(f'The {name} has no binary element.')
+
+    use_zlib, numpress = compression
+    data = base64.b64decode(binary) if binary else b''
+    if use_zlib:
+        data = zlib.decompress(data)
+    if numpress is None:
+        return name, np.frombuffer(data, dtype=dtype)
+
+    #numpress arrays are always decoded to 64-bit floats
+    values = decode_numpress(data, numpress) if data else np.zeros(0)
+    array_length = int(element.get('arrayLength', array_length if array_length is not None else len(values)))
+    if len(values) < array_length:
+        raise ValueError(f'Corrupt numpress {numpress} data - {len(values)} values were decoded but the {name} has {array_length}.')
+    return name, values[:array_length]
+
+def read_spectra_fast(mzml_path):
+    '''Yields the spectra of an mzml file as {'m/z array': ..., 'intensity array': ...} dicts, without the rest of the spectrum metadata. Usage is:
+    path of the mzml file. The file is streamed with an incremental XML parser and only the binary data arrays inside spectrum elements are decoded
+    (base64, 32 or 64-bit floats, uncompressed, zlib or numpress linear/pic/slof - see MZML_ARRAY_COMPRESSIONS) straight into NumPy arrays. Chromatograms are skipped.
+    Raises UnsupportedMzmlError for anything else, so the file can be read with pyteomics instead.
+    '''
+    spectrum = None
+    array_length = None
+    parents = [] #elements that are open at the moment - finished spectra and chromatograms are removed from their parent so memory use stays flat
+    for event, element in ElementTree.iterparse(mzml_path, events=('start', 'end')):
+        if event == 'start':
+            if element.tag.rpartition('}')[2] == 'spectrum':
+                spectrum = {}
+                array_length = element.get('defaultArrayLength')
+            parents.append(element)
+            continue
+
+        parents.pop()
+        tag = element.tag.rpartition('}')[2]
+        if tag == 'binaryDataArray' and spectrum is not None:
+            name, values = _decode_binary_data_array(element, int(array_length) if array_length is not None else None)
+            if name is not None:
+                spectrum[name] = values
+        elif tag == 'spectrum':
+            if 'm/z array' not in spectrum or 'intensity array' not in spectrum:
+                raise UnsupportedMzmlError(f'Spectrum {element.get("id")} has no m/z or intensity array.')
+            yield spectrum
+            spectrum = None
+            parents[-1].remove(element)
+        elif tag == 'chromatogram':
+            parents[-1].remove(element)
+
+def iter_spectra(mzml_path, use_cache=False, reader='fast', update_output=None):
+    '''Yields the spectra of an mzml file. Each spectrum supports spectrum['m/z array'] and spectrum['intensity array'] like the pyteomics spectra do. Usage is:
+    path of the mzml file (or of an mzml file in a spectra store), whether to use the on-disk cache of decoded spectra (see spectra_cache.py), the reader (one of MZML_READERS),
+    and the function to report cache problems with (print by default).
+    '''
+    if reader not in MZML_READERS:
+        raise ValueError(f'Unknown mzml reader "{reader}". Please use one of: {", ".join(MZML_READERS)}')
+
+    #spectra from a store are already decoded, so there's nothing to cache
+    if is_spectra_store(os.path.dirname(mzml_path)):
+        yield from SpectraStore(os.path.dirname(mzml_path)).iter_spectra(os.path.basename(mzml_path))
+        return
+
+    if use_cache:
+        cached_spectra = load_cached_spectra(mzml_path, update_output=update_output)
+        if cached_spectra is not None:
+            for mz, intensity in cached_spectra:
+                yield {'m/z array': mz, 'intensity array': intensity}
+            return
+
+    decoded_spectra = [] #(m/z array, intensity array) of every scan, for the cache
+    spectra_read = 0
+
+    if reader == 'fast':
+        try:
+            with closing(read_spectra_fast(mzml_path)) as spectra:
+                for spectrum in spectra:
+                    if use_cache:
+                        decoded_spectra.append((spectrum['m/z array'], spectrum['intensity array']))
+                    spectra_read += 1
+                    yield spectrum
+        except (UnsupportedMzmlError, ElementTree.ParseError):
+            reader = 'pyteomics' #carry on with pyteomics from the first spectrum the fast reader couldn't read (malformed files get pyteomics' error message)
+
+    if reader == 'pyteomics':
+        import pyteomics.mzml as mzml #only imported when it is needed - it takes a while to import and the fast reader handles most files
+        with mzml.read(mzml_path) as spectra:
+            for i, spectrum in enumerate(spectra):
+                if i < spectra_read:
+                    continue
+                if use_cache:
+                    decoded_spectra.append((spectrum.get('m/z array'), spectrum.get('intensity array')))
+                yield spectrum
+
+    #only a file that was read all the way through (without errors) is cached
+    if use_cache:
+        save_cached_spectra(mzml_path, decoded_spectra, update_output=update_output)
+
 # Function to integrate mass spectra within specified bounds using NumPy
-def integrate_spectra(directory, mzml_file, integration_bounds, parent_mz, update_output=None):
+def integrate_spectra(directory, mzml_file, integration_bounds, parent_mz, update_output=None, integration_mode='grid', use_cache=False):
     '''Integrates the mass spectra from mzml files and averages them across all scans. Interpolation on a common mz grid for all mzml files provided is used. Usage is:
     directory containing mzml files, name of mzml file, integration bounds [as a list], and the m/z of the parent ion (needed for interpolation).
     '''
+    #single window version of integrate_spectra_multi - kept for anyone calling it directly
+    return integrate_spectra_multi(directory, mzml_file, [integration_bounds], parent_mz, update_output=update_output, integration_mode=integration_mode, use_cache=use_cache)[0]
+
+def integrate_spectra_multi(directory, mzml_file, integration_bounds_list, parent_mz, update_output=None, integration_mode='grid', use_cache=False, stage_timer=None, return_scans=False):
+    '''Integrates the mass spectra from an mzml file within several windows at once and averages them across all scans. The file is read and each scan is interpolated only once. Usage is:
+    directory containing mzml files, name of mzml file, list of integration bounds [[lower, upper], ...], the m/z of the parent ion (needed for interpolation), the integration mode (one of INTEGRATION_MODES),
+    whether to use the on-disk cache of decoded spectra, a profiling.StageTimer to record the time spent in each stage (see FILE_STAGES in profiling.py), and whether to return the integral of every scan too.
+    Returns a list of [average integration, stdev] for each window, in the same order as integration_bounds_list. With return_scans, also returns the integrals of each scan (scans x windows).
+    '''
     # Redirect print outputs to the GUI output window
-    sys.stdout = TextRedirect(textWritten=update_output)
+    redirect_stdout(update_output)
+
+    if integration_mode not in INTEGRATION_MODES:
+        update_output(f'Unknown integration mode "{integration_mode}". Please use one of: {", ".join(INTEGRATION_MODES)}\n')
+        raise ValueError('Unknown integration mode')
 
-    #Initialize lists to integrations, and variables for minimum and maximum m/z values
-    integrations = []
+    #Initialize running statistics of the integrations (one value per window), and variables for minimum and maximum m/z values
+    integrations = RunningStats(len(integration_bounds_list), keep_values=return_scans)
     min_mz = 0.
-    max_mz = parent_mz + 50.  #adding 50 mass units to the parent ion
+    max_mz = parent_mz + INTEGRATION_GRID_MARGIN  #adding 50 mass units to the parent ion
 
     #define common mz grid for interpolation
-    common_mz_grid = np.round(np.linspace(min_mz, max_mz, int((max_mz - min_mz) / 0.01 + 1)),2) #0.01 Da incremenets for mz grid
-
-    with mzml.read(os.path.join(directory, mzml_file)) as spectra:
+    common_mz_grid = np.round(np.linspace(min_mz, max_mz, int((max_mz - min_mz) / INTEGRATION_GRID_STEP + 1)),2) #0.01 Da incremenets for mz grid
+
+    #the window filters only depend on the grid, so build them once for the whole file rather than for every scan
+    window_filters = []
+    for integration_bounds in integration_bounds_list:
+        lower_bound = np.round(integration_bounds[0],2)
+        upper_bound = np.round(integration_bounds[1],2)
+        window_filters.append((common_mz_grid >= lower_bound) & (common_mz_grid <= upper_bound))
+
+    #for the cumsum mode each window is two indices into the grid: the first grid point >= lower bound and the last grid point <= upper bound (same points as the filters above)
+    lower_bounds = np.round([integration_bounds[0] for integration_bounds in integration_bounds_list],2)
+    upper_bounds = np.round([integration_bounds[1] for integration_bounds in integration_bounds_list],2)
+    lower_indices = np.minimum(np.searchsorted(common_mz_grid, lower_bounds, side='left'), len(common_mz_grid) - 1)
+    upper_indices = np.maximum(np.searchsorted(common_mz_grid, upper_bounds, side='right') - 1, lower_indices) #empty windows integrate to zero
+    interpolated_scans = [] #rows of the current scans x grid block used by the cumsum mode
+
+    #the time until each spectrum comes out of the file counts as parsing, the rest is split up by the laps below
+    stage_timer = stage_timer if stage_timer is not None else StageTimer()
+    stage_timer.last = time.perf_counter()
+
+    #closing() makes sure the mzml file is closed even if we stop reading part way through
+    with closing(iter_spectra(os.path.join(directory, mzml_file), use_cache=use_cache, update_output=update_output)) as spectra:
         i = 0        
         for spectrum in spectra:
+            stage_timer.lap('parse')
 
             #according to stack exchange, these are pre-defined lists from pyteomics              
             try:
@@ -68,17 +484,27 @@ def integrate_spectra(directory, mzml_file, integration_bounds, parent_mz, updat
 
             except Exception as e:
                 update_output(f'Error encounter when extract m/z and intensity arrays from spectrum number {i+1} in {mzml_file}: {e}.\nTraceback: {traceback.format_exc()}\n')
-                QApplication.processEvents()  # Allow the GUI to update 
                 raise Exception('mzML data extraction error.') 
             
             # Check for inconsistent data
             if len(mz) != len(intensity):
                 update_output(f'Inconsistent lengths of m/z and intensity values when integrating {mzml_file}\n')
-                QApplication.processEvents()  # Allow the GUI to update     
                 raise ValueError('Value error!')
             
+            #the native mode integrates the scan as is - no padding, sorting (unless needed) or interpolation onto the common grid
+            if integration_mode == 'native':
+                try:
+                    integrations.add(_integrate_native(mz, intensity, lower_bounds, upper_bounds))
+                    stage_timer.lap('integration')
+                    i+=1
+                    continue
+
+                except Exception as e:
+                    update_output(f'Error encountered during integration of the spectra within {mzml_file}: {e}\nTraceback: {traceback.format_exc()}\n')
+                    raise Exception('Integration error')
+
             #Filter out values in the common_mz_grid are are within the mz values taken from the mzml file, then define a new set of mz_values 
-            mask = (common_mz_grid < min_mz_mzml) | (common_mz_grid > max_mz_mzml)
+            mask = (common_mz_grid < min_mz_mzml - INTEGRATION_GRID_EDGE_TOLERANCE) | (common_mz_grid > max_mz_mzml + INTEGRATION_GRID_EDGE_TOLERANCE)
             new_mz_values = common_mz_grid[mask]
             
             # Append the new values to the mz array from the mzml file with correponding intensity of zero
@@ -89,60 +515,126 @@ def integrate_spectra(directory, mzml_file, integration_bounds, parent_mz, updat
             sort_indices = np.argsort(mz)
             mz = mz[sort_indices]
             intensity = intensity[sort_indices]
+            stage_timer.lap('pad_sort')
                     
             #now interpolate using
             try:
                 interp_intensity = np.interp(common_mz_grid, mz, intensity)
+                stage_timer.lap('interpolation')
             
             except ValueError as ve:
                 update_output(f'ValueError encountered during interpolation of the spectra within {mzml_file}: {ve}\nTraceback: {traceback.format_exc()}\n')
-                QApplication.processEvents()  # Allow the GUI to update      
                 raise ValueError('Interpolation error')
                 
             except Exception as e:
                 update_output(f'Unexpected error encountered during interpolation of the spectra within {mzml_file}: {e}\nTraceback: {traceback.format_exc()}\n')
-                QApplication.processEvents()  # Allow the GUI to update      
                 raise Exception('Interpolation error')
             
-            #Define integration bounds as the indicies within the common m/z grid 
-            try:
-                lower_bound = np.round(integration_bounds[0],2)
-                upper_bound = np.round(integration_bounds[1],2)
-                filter = (common_mz_grid >= lower_bound) & (common_mz_grid <= upper_bound)
+            #the cumsum mode integrates a block of scans at a time
+            if integration_mode == 'cumsum':
+                interpolated_scans.append(interp_intensity)
+                i+=1
+                if len(interpolated_scans) == CUMSUM_BLOCK_SCANS:
+                    _add_cumsum_block(integrations, interpolated_scans, common_mz_grid, lower_indices, upper_indices, mzml_file, update_output)
+                    interpolated_scans = []
+                stage_timer.lap('integration')
+                continue
 
-                #only take mz and intensity data from within the integration bounds
-                mz_interval = common_mz_grid[filter]
-                interp_intensity_interval = interp_intensity[filter]
-                
-                # Integrate within specified bounds using NumPy trapz, and append each integration to the integrations list; its not a trap, I swear. 
-                integration = np.trapz(interp_intensity_interval, x = mz_interval)
-                integrations.append(integration)
+            #Integrate every window from the same interpolated scan
+            try:
+                scan_integrations = np.zeros(len(window_filters))
+                for j, filter in enumerate(window_filters):
+                    #only take mz and intensity data from within the integration bounds
+                    mz_interval = common_mz_grid[filter]
+                    interp_intensity_interval = interp_intensity[filter]
+                    
+                    # Integrate within specified bounds using NumPy trapz; its not a trap, I swear. 
+                    scan_integrations[j] = np.trapz(interp_intensity_interval, x = mz_interval)
 
+                integrations.add(scan_integrations)
+                stage_timer.lap('integration')
                 i+=1
 
             except ValueError as ve:
                 update_output(f'ValueError encountered during integration of the spectra within {mzml_file}: {ve}\nTraceback: {traceback.format_exc()}\n')
-                QApplication.processEvents()  # Allow the GUI to update      
                 raise ValueError('Integration error')    
                     
             except Exception as e:
                 update_output(f'Error encountered during integration of the spectra within {mzml_file}: {e}\nTraceback: {traceback.format_exc()}\n')
-                QApplication.processEvents()  # Allow the GUI to update      
                 raise Exception('Integration error')
 
-    # Calculate the average integration value. Doing it this way because we need to get standard deviations
-    avg_integration = np.mean(integrations)
-    std_dev = np.std(integrations)
-    
-    return [avg_integration, std_dev] 
+    #the last (partial) block of the cumsum mode
+    if integration_mode == 'cumsum' and len(interpolated_scans) > 0:
+        stage_timer.last = time.perf_counter()
+        _add_cumsum_block(integrations, interpolated_scans, common_mz_grid, lower_indices, upper_indices, mzml_file, update_output)
+        stage_timer.lap('integration')
+
+    # Average integration value and standard deviation for each window
+    window_integrations = [[mean, std] for mean, std in zip(integrations.mean(), integrations.std())]
+    if return_scans:
+        return window_integrations, integrations.values()
+    return window_integrations
+
+def _add_cumsum_block(integrations, interpolated_scans, common_mz_grid, lower_indices, upper_indices, mzml_file, update_output):
+    '''Integrates a block of interpolated scans in the cumsum mode and adds the integrations to the running statistics.'''
+    try:
+        integrations.add_block(_integrate_cumsum(np.vstack(interpolated_scans), common_mz_grid, lower_indices, upper_indices))
+
+    except Exception as e:
+        update_output(f'Error encountered during integration of the spectra within {mzml_file}: {e}\nTraceback: {traceback.format_exc()}\n')
+        raise Exception('Integration error')
+
+def _integrate_cumsum(scan_matrix, common_mz_grid, lower_indices, upper_indices):
+    '''Integrates every window of every scan at once. Usage is:
+    2D array of interpolated intensities (scans x grid), the common mz grid, and the grid indices of the lower and upper bound of each window.
+    Returns a 2D array of integrations (scans x windows).
+    '''
+    #cumulative trapezoid along the grid - cumulative[:, k] is the area from the start of the grid up to grid point k
+    cumulative = np.zeros_like(scan_matrix)
+    np.cumsum(0.5 * (scan_matrix[:, 1:] + scan_matrix[:, :-1]) * np.diff(common_mz_grid), axis=1, out=cumulative[:, 1:])
+
+    #the area of a window is then the difference of two lookups
+    return cumulative[:, upper_indices] - cumulative[:, lower_indices]
+
+def _integrate_native(mz, intensity, lower_bounds, upper_bounds):
+    '''Integrates a single scan within every window using its own m/z points (trapezoid rule on the piecewise-linear spectrum). Usage is:
+    m/z array, intensity array, and arrays of the lower and upper bound of each window. Returns an array with one integration per window.
+    '''
+    #data is normally already sorted by m/z, so only pay for a sort when it isn't
+    if np.any(np.diff(mz) < 0):
+        sort_indices = np.argsort(mz)
+        mz = mz[sort_indices]
+        intensity = intensity[sort_indices]
+
+    #a spectrum with less than two points has no area
+    if len(mz) < 2:
+        return np.zeros(len(lower_bounds))
+
+    #cumulative trapezoid over the native points - cumulative[k] is the area from the first point up to point k
+    cumulative = np.zeros(len(mz))
+    np.cumsum(0.5 * (intensity[1:] + intensity[:-1]) * np.diff(mz), out=cumulative[1:])
+
+    def area_up_to(bound):
+        #everything outside of the measured m/z range has zero intensity
+        bound = np.clip(bound, mz[0], mz[-1])
+
+        #area up to the last point at or below the bound, plus the partial trapezoid from that point to the (interpolated) edge
+        k = np.clip(np.searchsorted(mz, bound, side='right') - 1, 0, len(mz) - 2)
+        edge_intensity = np.interp(bound, mz, intensity)
+        return cumulative[k] + 0.5 * (intensity[k] + edge_intensity) * (bound - mz[k])
 
-def extract_RawData(mzml_directory, parent_mz, output_csv_file, update_output=None):
+    #windows with the bounds the wrong way round are empty, like they are on the grid
+    return area_up_to(np.maximum(upper_bounds, lower_bounds)) - area_up_to(lower_bounds)
+
+def extract_RawData(mzml_directory, parent_mz, output_csv_file, update_output=None, cancel_event=None, use_cache=False, output_format='csv'):
     '''Extracts the mass spectra from mzml files and averages them across all scans. Interpolation on a common mz grid for all mzml files provided is used. Usage is:
-    directory containing mzml files, m/z of the parent ion (needed for interpolation), and the name of .csv file to output results to.
+    directory containing mzml files, m/z of the parent ion (needed for interpolation), the name of .csv file to output results to, whether to use the on-disk cache of decoded spectra,
+    and the output format (one of RAW_DATA_FORMATS - for 'npy' the output file should be a .npy file, see RAW_DATA_FORMATS for the sidecar files).
+    Returns True if the output file was written. cancel_event (a threading.Event) is checked between mzml files.
     '''
 
     # Redirect print outputs to the GUI output window
-    sys.stdout = TextRedirect(textWritten=update_output)
+    redirect_stdout(update_output)
    
     #Set up interpolation grid - different from before because we don't want to print the mass spectrum in 0.01 Da increments. 
     min_mz = 0.
@@ -151,15 +643,35 @@ def extract_RawData(mzml_directory, parent_mz, output_csv_file, update_output=No
     common_mz_grid = np.round(np.linspace(min_mz, max_mz, int((max_mz - min_mz) / 0.02 + 1)),2) #0.02 Da incremenets for mz grid
 
     #Get a list of mzML files in the given directory
-    mzml_files = [f for f in os.listdir(mzml_directory) if f.endswith('.mzML')]
+    mzml_files = list_mzml_files(mzml_directory)
 
     #initialize dictionary to write data to
     data_dict = {}
+
+    #for the npy format the averaged spectra go straight to disk, so memory use doesn't grow with the number of wavelengths
+    if output_format == 'npy':
+        try:
+            raw_data_matrix = np.lib.format.open_memmap(output_csv_file, mode='w+', dtype=np.float64, shape=(len(mzml_files), len(common_mz_grid)))
+            wavelengths = np.full(len(mzml_files), np.nan)
+        except Exception as e:
+            update_output(f'Could not create {output_csv_file}: {e}\nTraceback: {traceback.format_exc()}\n')
+            return False
+
+    elif output_format != 'csv':
+        update_output(f'Unknown raw data format "{output_format}". Please use one of: {", ".join(RAW_DATA_FORMATS)}\n')
+        raise ValueError('Unknown raw data format')
     
-    for mzml_file in mzml_files:
+    for row, mzml_file in enumerate(mzml_files):
+
+        if cancel_event is not None and cancel_event.is_set():
+            update_output('Raw data export cancelled. No raw data file was written.\n')
+            if output_format == 'npy':
+                del raw_data_matrix
+                os.remove(output_csv_file)
+            return False
         
-        #initialize list to store interpolated intensities - this needs to be re-initialized for each new wavelength (i.e., each mzml file)
-        interpolated_intensity_values = []
+        #initialize the running average of the interpolated intensities - this needs to be re-initialized for each new wavelength (i.e., each mzml file)
+        interpolated_intensity_values = RunningStats(len(common_mz_grid))
 
         #get wavelength from mzml file name
         try:
@@ -167,12 +679,11 @@ def extract_RawData(mzml_directory, parent_mz, output_csv_file, update_output=No
         except ValueError as ve:
             update_output(f'Could not extract the wavelength from the .mzml file name. This is what the code has found: {wavelength}.\nDoes the filename contain the text: "Laser"?\n')
             update_output(f'Error: {ve}\nTraceback: {traceback.format_exc()}\n')       
-            QApplication.processEvents()  # Allow the GUI to update 
             raise ValueError('ValueError')    
 
         #Open up the .mzml file, extract the mass spectrum, and perform the interpolation
         i = 0
-        with mzml.read(os.path.join(mzml_directory, mzml_file)) as spectra:
+        with closing(iter_spectra(os.path.join(mzml_directory, mzml_file), use_cache=use_cache, update_output=update_output)) as spectra:
             for spectrum in spectra:
                 #according to stack exchange, these are pre-defined lists from pyteomics
                 try:
@@ -181,7 +692,6 @@ def extract_RawData(mzml_directory, parent_mz, output_csv_file, update_output=No
                 
                 except Exception as e:
                     update_output(f'Error encounter when extract m/z and intensity arrays from spectrum number {i+1} in {mzml_file}: {e}.\nTraceback: {traceback.format_exc()}\n')
-                    QApplication.processEvents()  # Allow the GUI to update 
                     raise Exception('mzML data extraction error.')                            
                 
                 #get min and max values from the mzml mz list
@@ -191,11 +701,10 @@ def extract_RawData(mzml_directory, parent_mz, output_csv_file, update_output=No
                 #Check for inconsistent data
                 if len(mz) != len(intensity):
                     update_output(f'Inconsistent data in {mzml_file}.\n The m/z and intensity arrays extracted from the .mzML file must be the same length!\n')
-                    QApplication.processEvents()  # Allow the GUI to update 
                     raise ValueError(f'ValueError')
                 
                 #Create filter based on a common mz grid
-                mask = (common_mz_grid < min_mz_mzml) | (common_mz_grid > max_mz_mzml) # the "|" denotes "or"
+                mask = (common_mz_grid < min_mz_mzml - INTEGRATION_GRID_EDGE_TOLERANCE) | (common_mz_grid > max_mz_mzml + INTEGRATION_GRID_EDGE_TOLERANCE) # the "|" denotes "or"
 
                 # Filter common_mz_grid based on the mask
                 new_mz_values = common_mz_grid[mask]
@@ -212,24 +721,40 @@ def extract_RawData(mzml_directory, parent_mz, output_csv_file, update_output=No
                 #now interpolate
                 try:
                     interp_intensity = np.interp(common_mz_grid, mz, intensity)
-                    interpolated_intensity_values.append(interp_intensity)
+                    interpolated_intensity_values.add(interp_intensity)
                     i += 1            
 
                 except ValueError as ve:
                     update_output(f'ValueError encountered during interpolation of the spectra within {mzml_file}: {ve}\nTraceback: {traceback.format_exc()}\n')
-                    QApplication.processEvents()  # Allow the GUI to update      
                     raise ValueError('Interpolation error')
                     
                 except Exception as e:
                     update_output(f'Unexpected error encountered during interpolation of the spectra within {mzml_file}: {e}\nTraceback: {traceback.format_exc()}\n')
-                    QApplication.processEvents()  # Allow the GUI to update      
                     raise Exception('Interpolation error')
 
         # Step 16: Calculate the averaged spectrum across each scan for this mzML file
-        averaged_spectrum = np.mean(interpolated_intensity_values, axis=0)
-        data_dict[wavelength] = averaged_spectrum
+        averaged_spectrum = interpolated_intensity_values.mean()
+        if output_format == 'npy':
+            raw_data_matrix[row] = averaged_spectrum
+            wavelengths[row] = float(wavelength)
+        else:
+            data_dict[wavelength] = averaged_spectrum
+
+    if output_format == 'npy':
+        try:
+            raw_data_matrix.flush()
+            del raw_data_matrix #closes the memory map
+            np.save(f'{os.path.splitext(output_csv_file)[0]}_mz.npy', common_mz_grid)
+            np.save(f'{os.path.splitext(output_csv_file)[0]}_wavelengths.npy', wavelengths)
+            update_output(f'Data succesfully written to {output_csv_file} (m/z axis and wavelengths in the _mz.npy and _wavelengths.npy files next to it)\n\n')
+            return True
+
+        except Exception as e:
+            update_output(f'Could not write the raw data to {output_csv_file}: {e}\nTraceback: {traceback.format_exc()}\n')
+            return False
     
     # Step 17: Create a DataFrame with the common m/z grid as the first column
+    import pandas as pd #only imported when it is needed - it is the slowest import of the pipeline and only the .csv raw data export uses it
     df = pd.DataFrame(data_dict)
     df.insert(0, "m/z", common_mz_grid)
 
@@ -237,12 +762,11 @@ def extract_RawData(mzml_directory, parent_mz, output_csv_file, update_output=No
     try: 
         df.to_csv(output_csv_file, index=False)
         update_output(f'Data succesfully written to {output_csv_file}\n\n')
-        QApplication.processEvents()  # Allow the GUI to update  
-        return
+        return True
     
     except PermissionError:
         'Close the .csv file with the same name as the one where the raw data is being written and then rerun the code.\n'
-        return
+        return False
 
 def PE_calc(W, P, dP, Par, dPar, Frag, dFrag, update_output=None):
     '''Calculates photofragmentation efficiency with normlaization to laser power. Useage is:
@@ -252,7 +776,6 @@ def PE_calc(W, P, dP, Par, dPar, Frag, dFrag, update_output=None):
     # Check for division by zero
     if P == 0 or Par + Frag == 0:
         update_output(f'Division by zero error for wavelenth {W}nm. Power (P) is {P}, Parent integration is {Par} and Fragment integration is {Frag}.\n The sum of base peak integration (Par) and fragment peak integration (Frag) must be non-zero.\nTraceback: {traceback.format_exc()}\n')
-        QApplication.processEvents()  # Allow the GUI to update   
         raise ValueError('Value Error')
    
     dW = 2 #bandwidth of OPO - assuming that it is +/- 2 nm
@@ -273,7 +796,6 @@ def PE_calc(W, P, dP, Par, dPar, Frag, dFrag, update_output=None):
     
     except Exception as e:
         update_output(f'Error encountered during calculation of photogfragmentaion efficiency at wavelength {W}nm: {e}\nTraceback: {traceback.format_exc()}\n')
-        QApplication.processEvents()  # Allow the GUI to update      
         raise Exception('Photofragmentation efficiency calculation error')
 
 def PE_calc_noNorm(W, P, dP, Par, dPar, Frag, dFrag, update_output=None): 
@@ -285,7 +807,6 @@ def PE_calc_noNorm(W, P, dP, Par, dPar, Frag, dFrag, update_output=None):
     # Check for division by zero
     if Par + Frag == 0:
         update_output(f'Division by zero error for wavelenth {W}nm. Power (P) is {P}, Parent integration is {Par} and Fragment integration is {Frag}.\n The sum of base peak integration (Par) and fragment peak integration (Frag) must be non-zero.\nTraceback: {traceback.format_exc()}\n')
-        QApplication.processEvents()  # Allow the GUI to update     
         raise ValueError('Value Error')
 
     #calculate photofragmentation efficiency
@@ -302,5 +823,69 @@ def PE_calc_noNorm(W, P, dP, Par, dPar, Frag, dFrag, update_output=None):
 
     except Exception as e:
         update_output(f'Error encountered during calculation of photogfragmentaion efficiency at wavelength {W}nm: {e}\nTraceback: {traceback.format_exc()}\n')
-        QApplication.processEvents()  # Allow the GUI to update      
-        raise Exception('Photofragmentation efficiency calculation error')
\ No newline at end of file
+        raise Exception('Photofragmentation efficiency calculation error')
+
+def _report_division_by_zero(division_by_zero, W, P, Par, Frag, channel_names, update_output):
+    '''Prints one line for each cell of a PE matrix that can't be calculated because of a division by zero (P is None without power normalization).'''
+    for row, column in zip(*np.nonzero(division_by_zero)):
+        channel = channel_names[column] if channel_names is not None else f'channel {column + 1}'
+        power = f'Power (P) is {P[row, 0]}, ' if P is not None else ''
+        update_output(f'Division by zero error for wavelenth {W[row, 0]}nm ({channel}). {power}Parent integration is {Par[row, 0]} and Fragment integration is {Frag[row, column]}. '
+                      'The sum of base peak integration (Par) and fragment peak integration (Frag) must be non-zero. This value is set to nan.\n')
+
+def PE_calc_array(W, P, dP, Par, dPar, Frag, dFrag, update_output=None, channel_names=None):
+    '''Calculates photofragmentation efficiency with normlaization to laser power for every wavelength and fragment channel at once. Useage is:
+    Wavelength, Power, Power stdev, base peak integration and its stdev (one value per wavelength), fragment peak integration and its stdev (wavelengths x channels), and optionally a name for each channel (for error messages).
+    Returns [efficiency, stdev] matrices (wavelengths x channels). Cells that would divide by zero are reported and set to nan instead of stopping the calculation.
+    '''
+    W, P, dP, Par, dPar = (np.asarray(values, dtype=float).reshape(-1, 1) for values in (W, P, dP, Par, dPar))
+    Frag, dFrag = np.atleast_2d(np.asarray(Frag, dtype=float)), np.atleast_2d(np.asarray(dFrag, dtype=float))
+
+    # Check for division by zero
+    division_by_zero = (P == 0) | (Par + Frag == 0)
+    if np.any(division_by_zero):
+        _report_division_by_zero(division_by_zero, W, P, Par, Frag, channel_names, update_output)
+
+    dW = 2 #bandwidth of OPO - assuming that it is +/- 2 nm
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #calculate photofragmentation efficiency
+        efficiency = -(W / P) * np.log(Par / (Frag + Par))
+
+        #calculate standard deviatian in photofragmentation efficiency
+        term1 = np.square((np.log(Par / (Par + Frag)) / -P) * dW)
+        term2 = np.square(((W * np.log(Par / (Par + Frag))) / np.square(P)) * dP)
+        term3 = np.square(-1 * ((1 / (Par + Frag) / P / Par * W * Frag)) * dPar)
+        term4 = np.square((W * 1 / (Par + Frag) / P) * dFrag)
+
+        PE_stdev = np.sqrt(term1+term2+term3+term4)
+
+    efficiency[division_by_zero] = np.nan
+    PE_stdev[division_by_zero] = np.nan
+    return [efficiency, PE_stdev]
+
+def PE_calc_noNorm_array(W, P, dP, Par, dPar, Frag, dFrag, update_output=None, channel_names=None):
+    '''Calculates photofragmentation efficiency without normlaization to laser power for every wavelength and fragment channel at once. Useage is the same as PE_calc_array.
+    Note that P and dP are dummy variables (W is only used in error messages) - kept it like this for functionality within main().
+    '''
+    W, Par, dPar = (np.asarray(values, dtype=float).reshape(-1, 1) for values in (W, Par, dPar))
+    Frag, dFrag = np.atleast_2d(np.asarray(Frag, dtype=float)), np.atleast_2d(np.asarray(dFrag, dtype=float))
+
+    # Check for division by zero
+    division_by_zero = np.broadcast_to(Par + Frag == 0, Frag.shape)
+    if np.any(division_by_zero):
+        _report_division_by_zero(division_by_zero, W, None, Par, Frag, channel_names, update_output)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        #calculate photofragmentation efficiency
+        efficiency = -1 * np.log(Par / (Frag + Par))
+
+        #calculate standard deviatian in photofragmentation efficiency
+        term1 = np.square(-1 * (Frag / (Par + Frag) / Par) * dPar)
+        term2 = np.square((1 / (Par + Frag)) * dFrag)
+
+        PE_stdev = np.sqrt(term1+term2)
+
+    efficiency[division_by_zero] = np.nan
+    PE_stdev[division_by_zero] = np.nan
+    return [efficiency, PE_stdev]
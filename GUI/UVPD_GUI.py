@@ -1,28 +1,198 @@
-import sys, os, time, importlib, traceback
-import numpy as np
-from Python.workflows import convert_wiff_to_mzml, extract_RawData
-from Python.main import main
+import sys, os, time, importlib.util, traceback, threading
+from Python.options import INTEGRATION_MODES, MZML_COMPRESSIONS
+from Python.log import LogSink, redirect_stdout
 from datetime import datetime
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QCheckBox, QTextEdit, QFileDialog, QTextEdit, QMessageBox
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QLabel, QLineEdit, QPushButton, QCheckBox, QPlainTextEdit, QFileDialog, QMessageBox, QComboBox, QSpinBox, QProgressBar
 from PyQt5.QtGui import QTextCursor
+from PyQt5.QtCore import QObject, QThread, QTimer, Qt, pyqtSignal
 from PyQt5 import QtWidgets
-from io import StringIO
-
-# Define a class that overwrite the printing option from terminal to a window within the GUI
-class TextRedirect(StringIO):
-    # Constructor (__init__ method) for the custom stream class
-    def __init__(self, textWritten=None, *args, **kwargs):
-        # Call the constructor of the parent class (StringIO)
-        super().__init__(*args, **kwargs)
-        # Store a callback function for updating external components with the written text
-        self.update_output = textWritten
-
-    # Override the write method of the parent class (StringIO)
-    def write(self, text):
-        # Call the write method of the parent class to perform the default writing
-        super().write(text)
-        # Invoke the stored callback function to notify external components with the written text
-        self.update_output(text)
+
+# Output window - text printed to it is collected by a LogSink (see log.py) and added to the window every LOG_FLUSH_INTERVAL_MS milliseconds.
+# The window keeps the last LOG_MAX_LINES lines, and the full log of each session is written to LOG_DIRECTORY.
+LOG_FLUSH_INTERVAL_MS = 100
+LOG_MAX_LINES = 10000
+LOG_DIRECTORY = os.path.join(os.path.expanduser('~'), 'UVPD_logs')
+
+# Worker that runs the analysis pipeline (wiff conversion, main(), raw data export) away from the GUI thread.
+# Everything it wants to print is sent back through the log signal, and the cancel event is checked between files.
+class AnalysisWorker(QObject):
+    log = pyqtSignal(str)           # text for the output window
+    progress = pyqtSignal(int, int) # mzml files done, total mzml files
+    finished = pyqtSignal(object)   # dict with the output files written, and whether the run was cancelled
+
+    def __init__(self, directory, mzml_directory, base_peak_range, fragment_ion_ranges, power_data_file_name, extract_mzml_from_wiff_flag, print_raw_data_flag, integration_mode, workers, use_cache, raw_data_format, cache_results, watch_flag, run_profile, compression='none', intensity_32bit=False, resume=False, bootstrap_resamples=0):
+        super().__init__()
+        self.directory = directory
+        self.mzml_directory = mzml_directory
+        self.base_peak_range = base_peak_range
+        self.fragment_ion_ranges = fragment_ion_ranges
+        self.power_data_file_name = power_data_file_name
+        self.extract_mzml_from_wiff_flag = extract_mzml_from_wiff_flag
+        self.print_raw_data_flag = print_raw_data_flag
+        self.integration_mode = integration_mode
+        self.workers = workers
+        self.use_cache = use_cache
+        self.raw_data_format = raw_data_format
+        self.cache_results = cache_results
+        self.watch_flag = watch_flag
+        self.run_profile = run_profile
+        self.compression = compression
+        self.intensity_32bit = intensity_32bit
+        self.resume = resume
+        self.bootstrap_resamples = bootstrap_resamples
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        results = {'output_file': None, 'rawdata_file': None, 'cancelled': False}
+        try:
+            self.run_pipeline(results)
+        except Exception as e:
+            self.log.emit(f'Unexpected error during the analysis: {e}\nTraceback: {traceback.format_exc()}\n')
+
+        results['cancelled'] = self.cancel_event.is_set()
+        self.finished.emit(results)
+
+    def run_pipeline(self, results):
+        #the analysis code (and numpy with it) is imported by the first analysis rather than when the GUI starts, so the window shows up quickly
+        import numpy as np
+        from Python.workflows import convert_wiff_files_to_mzml, verify_mzml_compression, extract_RawData
+        from Python.main import main
+        from Python.watch import watch_directory
+
+        start_time = time.time()
+        directory = self.directory
+        mzml_directory = self.mzml_directory
+
+        # Redirect print output to the log signal (print is thread-safe this way - the GUI thread does the actual writing)
+        redirect_stdout(self.log.emit)
+
+        # Live acquisition mode - process each new file as it appears, until Cancel is clicked
+        if self.watch_flag:
+            if self.print_raw_data_flag:
+                print('Raw data is not exported while watching a directory. Run the analysis again on the finished directory to export it.\n')
+            if self.bootstrap_resamples > 0:
+                print('Bootstrap confidence intervals are not calculated while watching a directory. Run the analysis again on the finished directory to get them.\n')
+            results['output_file'] = watch_directory(directory, self.base_peak_range, self.fragment_ion_ranges, self.power_data_file_name, update_output=self.log.emit, integration_mode=self.integration_mode,
+                                                     extract_mzml_from_wiff=self.extract_mzml_from_wiff_flag, use_cache=self.use_cache, cache_results=self.cache_results, cancel_event=self.cancel_event, progress_callback=self.progress.emit,
+                                                     compression=self.compression, intensity_32bit=self.intensity_32bit)
+            sys.stdout = sys.__stdout__
+            return
+
+        # Resuming a run that extracted the .wiff files uses the .mzML files it already wrote - the integrations that were done are in its checkpoint
+        if self.extract_mzml_from_wiff_flag and self.resume and os.path.isdir(mzml_directory):
+            print(f'Resuming the last run: the .wiff files are not extracted again, the .mzML files already in {mzml_directory} are used.\n\n')
+
+        # Convert contents of each wiff file into an mzml (if requested)
+        elif self.extract_mzml_from_wiff_flag:
+            print('Starting extraction of .wiff files. You may see a command prompt interface show up.\n\n')
+            # List .wiff Files in the Directory and 
+            wiff_files = [f for f in os.listdir(directory) if f.endswith('.wiff')]
+
+            if len(wiff_files) == 0:
+                print(f'There are no .wiff files present in {directory} to extract! Please specify a directory that contains .wiff files if you wish to extract them.\n')
+                return
+
+            # Create a directory to write the extracted .mzml files to
+            try:
+                os.mkdir(mzml_directory) #make thte mzml directory
+
+            except FileExistsError:
+                print(f'The user has requested to extract .mzml files from .wiff files, but the directory already exists.\nTo prevent overwriting files / combining incorrect data, please either:\n1. Uncheck the Extract mzml from wiff option, or\n2. Delete the exisitng mzml directory, and re-run the code with the Extract mzml from wiff option checked.\n')
+                return
+            
+            except Exception as e:
+                print(f'A permission error has been encountered when trying to make {mzml_directory}.\nError: {e}\nTraceback: {traceback.format_exc()}\n')
+                return
+
+            #msconvert runs for up to one .wiff file per worker at the same time
+            try:
+                convert_wiff_files_to_mzml(wiff_files, directory, mzml_directory, max_concurrent=self.workers, update_output=self.log.emit, cancel_event=self.cancel_event, compression=self.compression, intensity_32bit=self.intensity_32bit)
+            
+            except Exception as e:
+                print(f'There was a problem extracting the .wiff files. Please see the error below:\n{e}\n') #I don't really know how this can break, so we're using a broad exception. Surprise me, users!
+                return
+
+            #lossy encodings are checked against the uncompressed conversion of one file before the results are trusted
+            if (self.compression != 'none' or self.intensity_32bit) and not self.cancel_event.is_set():
+                try:
+                    if not verify_mzml_compression(sorted(wiff_files)[0], directory, mzml_directory, self.compression, self.intensity_32bit, update_output=self.log.emit):
+                        print('The compressed .mzML files differ too much from the uncompressed data. Please delete the mzml directory and extract the .wiff files again with no or zlib compression.\n')
+                        return
+                except Exception as e:
+                    print(f'There was a problem checking the compressed .mzML files:\n{e}\n')
+                    return
+
+        if self.cancel_event.is_set():
+            print('The run was cancelled.\n')
+            return
+
+        # Execute the main function, which computes photofragmentation efficiency and writes the data to a file
+        results['output_file'] = main(mzml_directory, self.base_peak_range, self.fragment_ion_ranges, self.power_data_file_name, update_output=self.log.emit, integration_mode=self.integration_mode, workers=self.workers, cancel_event=self.cancel_event, progress_callback=self.progress.emit, use_cache=self.use_cache, cache_results=self.cache_results, run_profile=self.run_profile, resume=self.resume, bootstrap_resamples=self.bootstrap_resamples)
+
+        # Redirect print output to the log signal again because something in main.py is killing this functionality
+        redirect_stdout(self.log.emit)
+
+        # Prints mass spectra to a .csv if user requests raw data via the checkbox
+        if self.print_raw_data_flag and not self.cancel_event.is_set():
+            print('User has requested generation of raw data. Exporting mass spectra now...\n\n')
+
+            rawdata_file_name = os.path.join(directory,f'Raw_data.{self.raw_data_format}')
+            
+            #mechanism to prevent overwriting existing output files
+            index = 0
+
+            while os.path.exists(rawdata_file_name):
+                index += 1
+                rawdata_file_name = os.path.join(directory,f'Raw_data_{index}.{self.raw_data_format}')
+
+            parent_mz = (np.round(np.average(self.base_peak_range), 2))  # get parent mass - needed for the upper end of mz window for interpolation
+            if extract_RawData(mzml_directory, parent_mz, rawdata_file_name, update_output=self.log.emit, cancel_event=self.cancel_event, use_cache=self.use_cache, output_format=self.raw_data_format):
+                results['rawdata_file'] = rawdata_file_name
+            
+        run_time = np.round((time.time() - start_time)/60,1)
+
+        if self.cancel_event.is_set():
+            print(f'The run was cancelled after {run_time} minutes.\n\n')
+        else:
+            print(f'UVPD photofragmentation efficiency calculation has completed in {run_time} minutes.\n\n')
+
+        # Reset print output redirection
+        sys.stdout = sys.__stdout__
+
+# Worker that proposes fragment ion windows from the average spectrum of all the mzml files (see fragment_detection.py) away from the GUI thread.
+# It takes the place of the analysis worker while it runs, so the cancel button and closing the window work the same way.
+class FragmentDetectionWorker(QObject):
+    log = pyqtSignal(str)           # text for the output window
+    finished = pyqtSignal(object)   # list of detected peaks, or None if there was a problem or the detection was cancelled
+
+    def __init__(self, mzml_directory, base_peak_range, workers, use_cache):
+        super().__init__()
+        self.mzml_directory = mzml_directory
+        self.base_peak_range = base_peak_range
+        self.workers = workers
+        self.use_cache = use_cache
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def run(self):
+        peaks = None
+        try:
+            from Python.fragment_detection import detect_fragment_windows
+            if self.workers > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    peaks = detect_fragment_windows([self.mzml_directory], self.base_peak_range, update_output=self.log.emit, use_cache=self.use_cache, executor=executor, cancel_event=self.cancel_event)
+            else:
+                peaks = detect_fragment_windows([self.mzml_directory], self.base_peak_range, update_output=self.log.emit, use_cache=self.use_cache, cancel_event=self.cancel_event)
+        except Exception as e:
+            self.log.emit(f'Unexpected error during the fragment window detection: {e}\nTraceback: {traceback.format_exc()}\n')
+
+        self.finished.emit(peaks)
 
 # Define a GUI class that inherits properties from PyQT5 QWidget
 class GUI(QWidget):
@@ -30,9 +200,31 @@ class GUI(QWidget):
         # Call the constructor of the parent class (QWidget)
         super().__init__()
 
+        # Thread and worker of the analysis that is currently running (if any)
+        self.analysis_thread = None
+        self.analysis_worker = None
+
+        # Spectrum viewers that are open, and the last raw data file written (the viewer's file dialog starts there)
+        self.viewers = []
+        self.last_rawdata_file = None
+
+        # Everything for the output window goes through the log sink, which also writes it to the log file of this session
+        self.log_file = os.path.join(LOG_DIRECTORY, f'UVPD_GUI_{datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}.log')
+        self.log_sink = LogSink(self.log_file)
+
         # Call the initUI method to initialize the user interface
         self.initUI()
 
+        # The output window is updated from the log sink on a timer, so a burst of messages is drawn once instead of once per message
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self.flush_output)
+        self.log_timer.start(LOG_FLUSH_INTERVAL_MS)
+
+        if self.log_sink.file_error is not None:
+            self.update_output(f'The log of this session could not be written to {self.log_file}: {self.log_sink.file_error}\n')
+        else:
+            self.update_output(f'The log of this session is written to {self.log_file}\n')
+
     #Specifies the user interface (ie. what does the GUI look like)
     def initUI(self):
         
@@ -62,6 +254,49 @@ class GUI(QWidget):
         # PrintRawData Flag
         self.print_raw_data_checkbox = QCheckBox('Print Raw Data?')
 
+        # Raw data as a memory-mapped .npy file instead of a .csv
+        self.raw_data_npy_checkbox = QCheckBox('Write Raw Data as .npy? (memory-mapped wavelength x m/z matrix instead of Raw_data.csv)')
+
+        # Cache decoded spectra Flag
+        self.use_cache_checkbox = QCheckBox('Cache decoded spectra? (faster re-runs of the same mzML files)')
+
+        # Remember integration results Flag - re-runs only integrate windows that are new or changed
+        self.cache_results_checkbox = QCheckBox('Remember integration results? (re-runs only integrate new or changed windows)')
+        self.cache_results_checkbox.setChecked(True)
+
+        # Encoding of the .mzML files written when extracting .wiff files
+        self.compression_label = QLabel('mzML compression when extracting .wiff files (numpress is lossy - the first file is checked against an uncompressed conversion):')
+        self.compression_combobox = QComboBox()
+        self.compression_combobox.addItems(MZML_COMPRESSIONS)
+        self.inten32_checkbox = QCheckBox('Write 32-bit intensities when extracting .wiff files?')
+
+        # Integration Mode
+        self.integration_mode_label = QLabel('Integration mode:')
+        self.integration_mode_combobox = QComboBox()
+        self.integration_mode_combobox.addItems(INTEGRATION_MODES)
+
+        # Run profile Flag - where the time and memory of a run go
+        self.run_profile_checkbox = QCheckBox('Write run profile? (time spent in each stage of each file, and peak memory, next to the output .csv)')
+
+        # Resume Flag - skip the mzML files that the last run (which stopped part way) already integrated
+        self.resume_checkbox = QCheckBox('Resume the last run? (skip mzML files that a run with the same settings already integrated before it stopped)')
+
+        # Live acquisition (watch) Flag
+        self.watch_checkbox = QCheckBox('Watch directory? (process each new file as it is acquired, until Cancel is clicked)')
+
+        # Number of worker processes used to integrate mzML files in parallel
+        self.workers_label = QLabel('Worker processes for .wiff conversion and integration (1 = no parallel processing):')
+        self.workers_spinbox = QSpinBox()
+        self.workers_spinbox.setRange(1, os.cpu_count() or 1)
+        self.workers_spinbox.setValue(1)
+
+        # Number of bootstrap resamples for confidence intervals of the PE values (written as extra columns, see bootstrap.py)
+        self.bootstrap_label = QLabel('Bootstrap resamples for PE confidence intervals (0 = off, e.g. 2000):')
+        self.bootstrap_spinbox = QSpinBox()
+        self.bootstrap_spinbox.setRange(0, 100000)
+        self.bootstrap_spinbox.setSingleStep(1000)
+        self.bootstrap_spinbox.setValue(0)
+
         # Power Data File Name
         self.power_data_label = QLabel('Power Data .csv file (Directory and/or Filename):')
         self.power_data_line_edit = QLineEdit()
@@ -69,13 +304,34 @@ class GUI(QWidget):
 
         # Output Text
         self.output_label = QLabel('Output:')
-        self.output_text_edit = QTextEdit()
+        self.output_text_edit = QPlainTextEdit()
         self.output_text_edit.setReadOnly(True)
+        self.output_text_edit.setMaximumBlockCount(LOG_MAX_LINES) #the oldest lines are dropped, so long sessions don't keep growing the window
 
         # Run Button
         self.run_button = QPushButton('Analyze spectra')
         self.run_button.clicked.connect(self.run)
 
+        # Cancel Button - only enabled while an analysis is running
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel)
+
+        # Progress Bar (mzML files integrated)
+        self.progress_bar = QProgressBar()
+
+        # View Button - opens a Raw_data file in the spectrum viewer, where the integration windows can be checked and dragged into place
+        self.view_button = QPushButton('View spectra (Raw_data file)')
+        self.view_button.clicked.connect(self.view_spectra)
+
+        # Detect Button - proposes fragment ion windows from the average spectrum of all the mzml files, and puts them in the fragment ion field for review
+        self.detect_button = QPushButton('Detect fragment windows')
+        self.detect_button.clicked.connect(self.detect_fragment_windows)
+
+        # Windows typed into the fields are shown in the open viewers
+        self.base_peak_line_edit.textEdited.connect(self.update_viewer_windows)
+        self.fragment_ion_line_edit.textEdited.connect(self.update_viewer_windows)
+
         # Layout
         layout = QVBoxLayout()
         layout.addWidget(self.directory_label)
@@ -87,10 +343,29 @@ class GUI(QWidget):
 
         layout.addWidget(self.fragment_ion_label)
         layout.addWidget(self.fragment_ion_line_edit)
+        layout.addWidget(self.detect_button)
 
         layout.addWidget(self.extract_mzml_checkbox)
         layout.addWidget(self.power_norm_checkbox)
         layout.addWidget(self.print_raw_data_checkbox)
+        layout.addWidget(self.raw_data_npy_checkbox)
+
+        layout.addWidget(self.use_cache_checkbox)
+        layout.addWidget(self.cache_results_checkbox)
+        layout.addWidget(self.run_profile_checkbox)
+        layout.addWidget(self.resume_checkbox)
+        layout.addWidget(self.watch_checkbox)
+
+        layout.addWidget(self.compression_label)
+        layout.addWidget(self.compression_combobox)
+        layout.addWidget(self.inten32_checkbox)
+        layout.addWidget(self.integration_mode_label)
+        layout.addWidget(self.integration_mode_combobox)
+
+        layout.addWidget(self.workers_label)
+        layout.addWidget(self.workers_spinbox)
+        layout.addWidget(self.bootstrap_label)
+        layout.addWidget(self.bootstrap_spinbox)
 
         layout.addWidget(self.power_data_label)
         layout.addWidget(self.power_data_line_edit)
@@ -98,7 +373,10 @@ class GUI(QWidget):
         layout.addWidget(self.output_label)
         layout.addWidget(self.output_text_edit)
 
+        layout.addWidget(self.progress_bar)
         layout.addWidget(self.run_button)
+        layout.addWidget(self.cancel_button)
+        layout.addWidget(self.view_button)
 
         self.setLayout(layout)
 
@@ -111,21 +389,32 @@ class GUI(QWidget):
         directory = QFileDialog.getExistingDirectory(self, 'Select Directory')
         self.directory_line_edit.setText(directory)
 
-    #Function to update text being printed to the GUI's output window
+    #Function to send text to the GUI's output window (and the log file). Safe to call from any thread - the text shows up at the next flush_output
     def update_output(self, text):
-        cursor = self.output_text_edit.textCursor()
+        self.log_sink.write(text)
+
+    #Function that adds the text collected by the log sink to the output window, called by the log timer
+    def flush_output(self):
+        text = self.log_sink.drain()
+        if not text:
+            return
+
+        #only follow the output if the user hasn't scrolled up to read something
+        scrollbar = self.output_text_edit.verticalScrollBar()
+        at_bottom = scrollbar.value() == scrollbar.maximum()
+
+        cursor = QTextCursor(self.output_text_edit.document())
         cursor.movePosition(QTextCursor.End)
         cursor.insertText(text)
-        self.output_text_edit.setTextCursor(cursor)
-        self.output_text_edit.ensureCursorVisible()
+
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
 
     #Function that executes the code when the run button is clicked    
     def run(self):
-        
-        start_time = time.time()
 
-        # Redirect print output to QTextEdit
-        sys.stdout = TextRedirect(textWritten=self.update_output)
+        # Redirect print output to the output window
+        redirect_stdout(self.update_output)
 
         #print date and time to keep track of output from multiple runs. 
         now = datetime.now().replace(microsecond=0)
@@ -229,6 +518,17 @@ class GUI(QWidget):
         extract_mzml_from_wiff_flag = self.extract_mzml_checkbox.isChecked() #Checkbox for extracting .wiff files
         power_norm_flag = self.power_norm_checkbox.isChecked()               #Checkbox for normalizing photofragmentation efficiency to laser power
         print_raw_data_flag = self.print_raw_data_checkbox.isChecked()       #Checkbox for printing the mass spectra used to calculate photofragmentation efficiency 
+        integration_mode = self.integration_mode_combobox.currentText()      #Method used to integrate each window (see INTEGRATION_MODES in workflows.py)
+        workers = self.workers_spinbox.value()                               #Number of processes used to integrate the mzML files
+        use_cache = self.use_cache_checkbox.isChecked()                      #Checkbox for keeping decoded spectra in a cache next to the mzML files
+        raw_data_format = 'npy' if self.raw_data_npy_checkbox.isChecked() else 'csv' #Format of the raw data file
+        cache_results = self.cache_results_checkbox.isChecked()              #Checkbox for reusing the integrations of windows that haven't changed
+        watch_flag = self.watch_checkbox.isChecked()                         #Checkbox for processing files as they are acquired
+        run_profile = self.run_profile_checkbox.isChecked()                  #Checkbox for writing the run profile next to the output .csv
+        resume = self.resume_checkbox.isChecked()                            #Checkbox for resuming the last run from its checkpoint
+        compression = self.compression_combobox.currentText()                #Encoding of the binary arrays of extracted .mzML files (see MZML_COMPRESSIONS in workflows.py)
+        intensity_32bit = self.inten32_checkbox.isChecked()                  #Checkbox for writing 32-bit intensities when extracting .mzML files
+        bootstrap_resamples = self.bootstrap_spinbox.value()                 #Number of bootstrap resamples for the PE confidence intervals (0 = none)
         
         ############################################
         '''Fragment peak input and error handling'''
@@ -294,88 +594,163 @@ class GUI(QWidget):
         '''Preparing for code deployment'''
         ###################################           
 
-        start = time.time() #get the time to determine overall calculation time. 
         if self.extract_mzml_checkbox.isChecked() == False:
             mzml_directory = directory #If the user did not want to extra the mzml files from wiff
         else:
             mzml_directory = os.path.join(directory, 'mzml_directory')  #directory for mzml files to be written to / where they are stored
-        
-        # Convert contents of each wiff file into an mzml (if requested)
-        if extract_mzml_from_wiff_flag:
-            print('Starting extraction of .wiff files. You may see a command prompt interface show up.\n\n')
-            QApplication.processEvents()  # Allow the GUI to update  
-            # List .wiff Files in the Directory and 
-            wiff_files = [f for f in os.listdir(directory) if f.endswith('.wiff')]
-
-            if len(wiff_files) == 0:
-                print(f'There are no .wiff files present in {directory} to extract! Please specify a directory that contains .wiff files if you wish to extract them.\n')
-                QApplication.processEvents()  # Allow the GUI to update  
-                return
 
-            # Create a directory to write the extracted .mzml files to
-            try:
-                os.mkdir(mzml_directory) #make thte mzml directory
+        # The analysis itself runs in a worker thread so the window stays responsive and the run can be cancelled
+        self.analysis_thread = QThread()
+        self.analysis_worker = AnalysisWorker(directory, mzml_directory, base_peak_range, fragment_ion_ranges, power_data_file_name, extract_mzml_from_wiff_flag, print_raw_data_flag, integration_mode, workers, use_cache, raw_data_format, cache_results, watch_flag, run_profile, compression, intensity_32bit, resume, bootstrap_resamples)
+        self.analysis_worker.moveToThread(self.analysis_thread)
+
+        self.analysis_thread.started.connect(self.analysis_worker.run)
+        self.analysis_worker.log.connect(self.update_output, Qt.DirectConnection) #straight into the log sink from the worker thread, without a queued event per message
+        self.analysis_worker.progress.connect(self.update_progress)
+        self.analysis_worker.finished.connect(self.analysis_finished)
+        self.analysis_worker.finished.connect(self.analysis_thread.quit)
+        self.analysis_thread.finished.connect(self.analysis_thread_finished)
+
+        self.run_button.setEnabled(False)
+        self.detect_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.progress_bar.setValue(0)
+        self.analysis_thread.start()
+
+        # Reset print output redirection - the worker sends its output through the log signal
+        sys.stdout = sys.__stdout__
 
-            except FileExistsError:
-                print(f'The user has requested to extract .mzml files from .wiff files, but the directory already exists.\nTo prevent overwriting files / combining incorrect data, please either:\n1. Uncheck the Extract mzml from wiff option, or\n2. Delete the exisitng mzml directory, and re-run the code with the Extract mzml from wiff option checked.\n')
-                QApplication.processEvents()  # Allow the GUI to update
-                return
-            
-            except Exception as e:
-                print(f'A permission error has been encountered when trying to make {mzml_directory}.\nError: {e}\nTraceback: {traceback.format_exc()}\n')
+        return
 
-            for wiff_file in wiff_files:
-                wiff_stime = time.time() #define a time when the .wiff extraction starts
-                try:
-                    convert_wiff_to_mzml(wiff_file, directory, mzml_directory, update_output=self.update_output)
-                    elapsed_time = np.round((time.time() - wiff_stime),1)
-                    print(f'The wiff file:\n{wiff_file}\nhas been successfully extracted in {elapsed_time}s.')
-                    QApplication.processEvents()  # Allow the GUI to update
-                
-                except Exception as e:
-                    print(f'There was a problem extracting {wiff_file}. Please see the error below:\n{e}\n') #I don't really know how this can break, so we're using a broad exception. Surprise me, users!
-                    print(f'{e}\n')
-                    QApplication.processEvents()  # Allow the GUI to update
-                    return
+    #Function that updates the progress bar when the worker has finished an mzml file
+    def update_progress(self, files_done, total_files):
+        self.progress_bar.setMaximum(total_files)
+        self.progress_bar.setValue(files_done)
+
+    #Function that asks the worker to stop after the files it is currently working on
+    def cancel(self):
+        if self.analysis_worker is not None:
+            self.update_output('Cancelling - the run will stop after the files currently being processed...\n')
+            self.cancel_button.setEnabled(False)
+            self.analysis_worker.cancel()
+
+    #Function that runs on the GUI thread when the worker is done (finished, failed or cancelled)
+    def analysis_finished(self, results):
+        self.run_button.setEnabled(True)
+        self.detect_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        if results.get('rawdata_file') is not None:
+            self.last_rawdata_file = results['rawdata_file']
+
+    #Function that starts the detection of fragment ion windows when the detect button is clicked (the mzml files and base peak range are taken from the fields above)
+    def detect_fragment_windows(self):
+        directory = self.directory_line_edit.text()
+        if not os.path.isdir(directory):
+            self.update_output('The directory specified does not exist. Please provide a valid file path.\n')
+            return
 
-        # Execute the main function, which computes photofragmentation efficiency and writes the data to a file
-        main(mzml_directory, base_peak_range, fragment_ion_ranges, power_data_file_name, update_output=self.update_output)
+        #fragment peaks are looked for below the base peak range
+        try:
+            base_peak_range = list(map(float, self.base_peak_line_edit.text().replace(' ','').strip().split(',')))
+        except ValueError:
+            base_peak_range = []
+        if len(base_peak_range) != 2:
+            self.update_output('Please enter the base peak range (two comma separated numbers) first - the fragment windows are detected below it.\n')
+            return
 
-        # Redirect print output to QTextEdit again because something in main.py is killing this functionality
-        sys.stdout = TextRedirect(textWritten=self.update_output)
+        mzml_directory = directory
+        if self.extract_mzml_checkbox.isChecked():
+            mzml_directory = os.path.join(directory, 'mzml_directory')
+            if not os.path.isdir(mzml_directory):
+                self.update_output(f'{mzml_directory} does not exist yet. The fragment windows are detected from the .mzML files, so please convert the .wiff files first (e.g. by running the analysis once).\n')
+                return
 
-        # Prints mass spectra to a .csv if user requests raw data via the checkbox
-        if print_raw_data_flag:
-            print('User has requested generation of raw data. Exporting mass spectra now...\n\n')
-            QApplication.processEvents()  # Allow the GUI to update
+        self.analysis_thread = QThread()
+        self.analysis_worker = FragmentDetectionWorker(mzml_directory, base_peak_range, self.workers_spinbox.value(), self.use_cache_checkbox.isChecked())
+        self.analysis_worker.moveToThread(self.analysis_thread)
+
+        self.analysis_thread.started.connect(self.analysis_worker.run)
+        self.analysis_worker.log.connect(self.update_output, Qt.DirectConnection)
+        self.analysis_worker.finished.connect(self.detection_finished)
+        self.analysis_worker.finished.connect(self.analysis_thread.quit)
+        self.analysis_thread.finished.connect(self.analysis_thread_finished)
+
+        self.run_button.setEnabled(False)
+        self.detect_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.analysis_thread.start()
+
+    #Function that puts the detected windows in the fragment ion field (and the open viewers) when the detection worker is done
+    def detection_finished(self, peaks):
+        self.run_button.setEnabled(True)
+        self.detect_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        if not peaks:
+            return
 
-            rawdata_file_name = os.path.join(directory,'Raw_data.csv')
-            
-            #mechanism to prevent overwriting existing output files
-            index = 0
+        from Python.fragment_detection import format_fragment_ion_ranges
+        self.fragment_ion_line_edit.setText(format_fragment_ion_ranges(peaks))
+        self.update_viewer_windows()
+        self.update_output('The detected windows have been put in the fragment ion field. Please review them (e.g. in the spectrum viewer) before analyzing.\n')
 
-            while os.path.exists(rawdata_file_name):
-                index += 1
-                rawdata_file_name = os.path.join(directory,f'Raw_data_{index}.csv')
+    #Function that opens a Raw_data file (.csv or .npy, see "Print Raw Data") in a spectrum viewer window
+    def view_spectra(self):
+        start_path = self.last_rawdata_file or self.directory_line_edit.text().strip()
+        raw_data_file, _ = QFileDialog.getOpenFileName(self, 'Open raw data', start_path, 'Raw data (*.npy *.csv)')
+        if not raw_data_file:
+            return
 
-            parent_mz = (np.round(np.average(base_peak_range), 2))  # get parent mass - needed for the upper end of mz window for interpolation
-            extract_RawData(mzml_directory, parent_mz, rawdata_file_name, update_output=self.update_output)
-            
-        run_time = np.round((time.time() - start_time)/60,1)
+        #the viewer needs numpy, so it is imported when it is first opened rather than when the GUI starts
+        try:
+            from Python.viewer import SpectrumViewer, parse_windows
+            viewer = SpectrumViewer(raw_data_file, windows=parse_windows(self.base_peak_line_edit.text(), self.fragment_ion_line_edit.text()))
+        except Exception as e:
+            self.update_output(f'Could not open {raw_data_file} in the spectrum viewer: {e}\nTraceback: {traceback.format_exc()}\n')
+            return
 
-        print(f'UVPD photofragmentation efficiency calculation has completed in {run_time} minutes.\n\n')
-        QApplication.processEvents()  # Allow the GUI to update
+        viewer.windowsChanged.connect(self.set_windows_from_viewer)
+        viewer.destroyed.connect(lambda: self.viewers.remove(viewer) if viewer in self.viewers else None)
+        viewer.setAttribute(Qt.WA_DeleteOnClose)
+        self.viewers.append(viewer)
+        viewer.show()
+
+    #Function that writes windows dragged in a viewer into the base peak and fragment ion fields (and shows them in the other viewers)
+    def set_windows_from_viewer(self, windows):
+        from Python.viewer import format_windows
+        base_peak_text, fragment_ion_text = format_windows(windows)
+        self.base_peak_line_edit.setText(base_peak_text)
+        self.fragment_ion_line_edit.setText(fragment_ion_text)
+        self.update_viewer_windows()
+
+    #Function that shows the windows in the base peak and fragment ion fields in the open viewers
+    def update_viewer_windows(self):
+        if len(self.viewers) == 0:
+            return
+        from Python.viewer import parse_windows
+        windows = parse_windows(self.base_peak_line_edit.text(), self.fragment_ion_line_edit.text())
+        for viewer in self.viewers:
+            viewer.set_windows(windows)
 
-        # Reset print output redirection
-        sys.stdout = sys.__stdout__
+    #The thread and worker can only be let go once the thread has actually stopped
+    def analysis_thread_finished(self):
+        self.analysis_worker = None
+        self.analysis_thread = None
 
-        return
-   
     def close_application(self): # Exit alert for the user
         choice_title = 'Exit Confirmation'
         choice_prompt = 'Are you sure you wish to exit?'
         choice = QtWidgets.QMessageBox.question(self, choice_title, choice_prompt, QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No)
         if choice == QtWidgets.QMessageBox.Yes:
+
+            #let a running analysis (or fragment window detection) stop between files before closing
+            if self.analysis_worker is not None:
+                self.analysis_worker.cancel()
+                self.analysis_thread.quit()
+                self.analysis_thread.wait()
+
+            self.log_timer.stop()
+            self.log_sink.drain()
+            self.log_sink.close()
            
             #close application
             sys.exit()
@@ -387,19 +762,17 @@ class GUI(QWidget):
 #The bit that actually starts the GUI
 if __name__ == '__main__': #always and forever. 
     
-    #Check for required python libraries before the GUI initializes
+    #Check for required python libraries before the GUI initializes. The packages are only looked up, not imported - importing them is left to the first analysis
     def check_and_install_packages(package_list):
         missing_packages = [] #empty list to append missing packages to (if found)
 
-        for package in package_list:
-            try:
-                globals()[package] = importlib.import_module(package)
-            except (ModuleNotFoundError, ImportError):
+        for module_name, package in package_list.items():
+            if importlib.util.find_spec(module_name) is None:
                 missing_packages.append(package)
 
         return missing_packages
 
-    required_packages = ['pyqt5', 'pyteomics', 'numpy', 'pandas'] #modules required for the UVPD script
+    required_packages = {'PyQt5': 'pyqt5', 'pyteomics': 'pyteomics', 'numpy': 'numpy', 'pandas': 'pandas'} #modules required for the UVPD script, and the name pip installs them by
     missing_packages = check_and_install_packages(required_packages) 
 
     if missing_packages:
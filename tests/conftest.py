@@ -0,0 +1,18 @@
+import os, sys
+import pytest
+
+# The analysis code is imported as Python.<module> from the GUI directory (like UVPD_GUI.py and the command line tools do)
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, 'GUI'))
+
+EXAMPLE_MZML_DIRECTORY = os.path.join(REPOSITORY_DIRECTORY, 'ExampleData_afterAnalysis', 'mzml_directory')
+
+@pytest.fixture(autouse=True)
+def restore_stdout(monkeypatch):
+    '''The pipeline sends print() to update_output by replacing sys.stdout (see log.redirect_stdout) - put it back after every test.'''
+    monkeypatch.setattr(sys, 'stdout', sys.stdout)
+
+@pytest.fixture
+def example_mzml_file():
+    '''Name of one of the bundled example mzml files.'''
+    return sorted(f for f in os.listdir(EXAMPLE_MZML_DIRECTORY) if f.endswith('.mzML'))[10]
@@ -0,0 +1,78 @@
+import numpy as np
+from conftest import EXAMPLE_MZML_DIRECTORY
+from Python.workflows import integrate_spectra_multi, _integrate_cumsum, _integrate_native
+
+# The grid mode (np.trapz of the filtered grid points of each window) is the reference the cumsum and native integration modes are checked against.
+
+GRID_STEP = 0.01
+
+def make_grid(max_mz):
+    '''Common m/z grid as integrate_spectra_multi builds it.'''
+    return np.round(np.linspace(0., max_mz, int(max_mz / GRID_STEP + 1)), 2)
+
+def grid_trapz(scan, common_mz_grid, lower_bound, upper_bound):
+    '''Grid mode integration of one window of one interpolated scan.'''
+    window_filter = (common_mz_grid >= np.round(lower_bound, 2)) & (common_mz_grid <= np.round(upper_bound, 2))
+    return np.trapz(scan[window_filter], x=common_mz_grid[window_filter])
+
+def grid_indices(common_mz_grid, bounds):
+    '''Grid indices of the lower and upper bound of each window, as integrate_spectra_multi works them out for the cumsum mode.'''
+    lower_bounds = np.round([lower for lower, _ in bounds], 2)
+    upper_bounds = np.round([upper for _, upper in bounds], 2)
+    lower_indices = np.minimum(np.searchsorted(common_mz_grid, lower_bounds, side='left'), len(common_mz_grid) - 1)
+    upper_indices = np.maximum(np.searchsorted(common_mz_grid, upper_bounds, side='right') - 1, lower_indices)
+    return lower_indices, upper_indices
+
+#windows inside the grid, starting at the first grid point, ending at the last one, reaching past either end, a single grid point, and the wrong way round (empty)
+EDGE_WINDOWS = [[12.34, 56.78], [0., 10.], [90., 100.], [-5., 3.], [95.5, 120.], [40., 40.], [60., 50.]]
+
+def test_cumsum_matches_grid_trapz():
+    rng = np.random.default_rng(1)
+    common_mz_grid = make_grid(100.)
+    scan_matrix = rng.random((7, len(common_mz_grid))) * 1000
+
+    lower_indices, upper_indices = grid_indices(common_mz_grid, EDGE_WINDOWS)
+    integrations = _integrate_cumsum(scan_matrix, common_mz_grid, lower_indices, upper_indices)
+
+    expected = [[grid_trapz(scan, common_mz_grid, lower, upper) for lower, upper in EDGE_WINDOWS] for scan in scan_matrix]
+    np.testing.assert_allclose(integrations, expected, rtol=1e-9, atol=1e-6)
+
+def test_cumsum_mode_matches_grid_mode_on_example_data(example_mzml_file):
+    bounds = [[239.0, 242.0], [54.5, 57.0], [114.5, 116.0], [0., 5.], [285., 300.]]
+    messages = []
+    grid = integrate_spectra_multi(EXAMPLE_MZML_DIRECTORY, example_mzml_file, bounds, 240.5, update_output=messages.append, integration_mode='grid')
+    cumsum = integrate_spectra_multi(EXAMPLE_MZML_DIRECTORY, example_mzml_file, bounds, 240.5, update_output=messages.append, integration_mode='cumsum')
+    np.testing.assert_allclose(cumsum, grid, rtol=1e-9, atol=1e-6)
+
+def test_native_matches_grid_trapz_on_grid_aligned_spectrum():
+    #with every m/z point on the grid (and zero intensity at both ends of the scan), the interpolated grid spectrum is the same piecewise-linear spectrum, so the integrals are equal
+    rng = np.random.default_rng(2)
+    common_mz_grid = make_grid(100.)
+    mz = np.sort(rng.choice(common_mz_grid[200:9500], size=400, replace=False))
+    intensity = rng.random(len(mz)) * 1000
+    intensity[[0, -1]] = 0.
+    interpolated = np.interp(common_mz_grid, mz, intensity, left=0., right=0.)
+
+    windows = EDGE_WINDOWS + [[1., 2.5], [mz[0], mz[-1]], [mz[5], mz[6]]]
+    lower_bounds = np.array([lower for lower, _ in windows])
+    upper_bounds = np.array([upper for _, upper in windows])
+    integrations = _integrate_native(mz, intensity, lower_bounds, upper_bounds)
+
+    expected = [grid_trapz(interpolated, common_mz_grid, lower, upper) for lower, upper in windows]
+    np.testing.assert_allclose(integrations, expected, rtol=1e-9, atol=1e-6)
+
+    #the order of the points doesn't matter
+    shuffle = rng.permutation(len(mz))
+    np.testing.assert_allclose(_integrate_native(mz[shuffle], intensity[shuffle], lower_bounds, upper_bounds), integrations)
+
+def test_native_short_scans_have_no_area():
+    np.testing.assert_array_equal(_integrate_native(np.array([50.]), np.array([10.]), np.array([0.]), np.array([100.])), [0.])
+    np.testing.assert_array_equal(_integrate_native(np.zeros(0), np.zeros(0), np.array([0.]), np.array([100.])), [0.])
+
+def test_native_mode_is_close_to_grid_mode_on_example_data(example_mzml_file):
+    #the real scans aren't on the grid, so the interpolation makes a small difference
+    bounds = [[239.0, 242.0], [54.5, 57.0], [114.5, 116.0]]
+    messages = []
+    grid = np.array(integrate_spectra_multi(EXAMPLE_MZML_DIRECTORY, example_mzml_file, bounds, 240.5, update_output=messages.append, integration_mode='grid'))
+    native = np.array(integrate_spectra_multi(EXAMPLE_MZML_DIRECTORY, example_mzml_file, bounds, 240.5, update_output=messages.append, integration_mode='native'))
+    np.testing.assert_allclose(native[:, 0], grid[:, 0], rtol=1e-2)
@@ -0,0 +1,44 @@
+import os, re
+import numpy as np
+import pytest
+from contextlib import closing
+from conftest import EXAMPLE_MZML_DIRECTORY
+from Python.workflows import read_spectra_fast, UnsupportedMzmlError
+
+# The streaming reader has to give the same arrays as pyteomics, and has to raise UnsupportedMzmlError (so iter_spectra falls back to pyteomics) for anything it can't decode.
+
+def test_matches_pyteomics(example_mzml_file):
+    mzml = pytest.importorskip('pyteomics.mzml')
+    mzml_path = os.path.join(EXAMPLE_MZML_DIRECTORY, example_mzml_file)
+
+    with closing(read_spectra_fast(mzml_path)) as spectra:
+        fast_spectra = list(spectra)
+    with mzml.read(mzml_path) as spectra:
+        reference_spectra = list(spectra)
+
+    assert len(fast_spectra) == len(reference_spectra) > 0
+    for fast_spectrum, reference_spectrum in zip(fast_spectra, reference_spectra):
+        for name in ('m/z array', 'intensity array'):
+            assert fast_spectrum[name].dtype == reference_spectrum[name].dtype
+            np.testing.assert_array_equal(fast_spectrum[name], reference_spectrum[name])
+
+def copy_with_first_binary(example_mzml_file, tmp_path, replacement):
+    '''Copy of an example mzml file with the first <binary> element (the m/z array of the first spectrum) replaced.'''
+    with open(os.path.join(EXAMPLE_MZML_DIRECTORY, example_mzml_file)) as file:
+        text = file.read()
+    mzml_path = tmp_path / example_mzml_file
+    mzml_path.write_text(re.sub(r'<binary>[^<]*</binary>', replacement, text, count=1))
+    return str(mzml_path)
+
+def test_missing_binary_is_unsupported(example_mzml_file, tmp_path):
+    mzml_path = copy_with_first_binary(example_mzml_file, tmp_path, '')
+    with pytest.raises(UnsupportedMzmlError):
+        with closing(read_spectra_fast(mzml_path)) as spectra:
+            next(spectra)
+
+def test_empty_binary_is_an_empty_array(example_mzml_file, tmp_path):
+    mzml_path = copy_with_first_binary(example_mzml_file, tmp_path, '<binary/>')
+    with closing(read_spectra_fast(mzml_path)) as spectra:
+        spectrum = next(spectra)
+    assert len(spectrum['m/z array']) == 0
+    assert len(spectrum['intensity array']) > 0
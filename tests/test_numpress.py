@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from Python.workflows import decode_numpress
+
+# Encoded vectors from the MSNumpress reference implementation (through pynumpress), and the values they decode to.
+KNOWN_VECTORS = {
+    'linear': ('414b2bba0000000050293a150a5555153dd59d0ff9517f10ac4b69f7', [100., 100.5, 101.25, 250.12500014, 1000.06249993]),
+    'pic': ('8716116ff400013042e1', [0., 1., 17., 255., 4096., 123456.]),
+    'slof': ('40be0e000000000000008a1b815b8dabfdff', [0., 1.50001921, 20.0012129, 300.254147, 5000.11501]),
+}
+
+@pytest.mark.parametrize('encoding', sorted(KNOWN_VECTORS))
+def test_known_vectors(encoding):
+    data, expected = KNOWN_VECTORS[encoding]
+    values = decode_numpress(bytes.fromhex(data), encoding)
+    assert values.dtype == np.float64
+    np.testing.assert_allclose(values, expected, rtol=1e-8)
+
+def test_short_linear_arrays():
+    #just the fixed point, and the fixed point with a single value
+    fixed_point = np.array([1000.], dtype='>f8').tobytes()
+    assert len(decode_numpress(fixed_point, 'linear')) == 0
+    np.testing.assert_allclose(decode_numpress(fixed_point + np.array([123456], dtype='<u4').tobytes(), 'linear'), [123.456])
+
+def test_corrupt_and_unknown():
+    with pytest.raises(ValueError):
+        decode_numpress(b'\x00' * 4, 'linear')
+    with pytest.raises(ValueError):
+        decode_numpress(b'\x00' * 8, 'numpress')
+
+@pytest.mark.parametrize('encoding', ['linear', 'pic', 'slof'])
+def test_matches_pynumpress(encoding):
+    pynumpress = pytest.importorskip('pynumpress')
+    rng = np.random.default_rng(7)
+    if encoding == 'linear':
+        values = np.sort(rng.uniform(50., 2000., 5000))
+        data = pynumpress.encode_linear(values, pynumpress.optimal_linear_fixed_point(values))
+        reference = pynumpress.decode_linear(data)
+    elif encoding == 'pic':
+        values = np.round(rng.exponential(1e4, 5001)) #odd length, so the last byte is padded
+        data = pynumpress.encode_pic(values)
+        reference = pynumpress.decode_pic(data)
+    else:
+        values = rng.exponential(1e4, 5000)
+        data = pynumpress.encode_slof(values, pynumpress.optimal_slof_fixed_point(values))
+        reference = pynumpress.decode_slof(data)
+
+    decoded = decode_numpress(bytes(data), encoding)
+    assert len(decoded) == len(values)
+    np.testing.assert_allclose(decoded, reference, rtol=1e-12)
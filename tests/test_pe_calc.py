@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from Python.workflows import PE_calc, PE_calc_noNorm, PE_calc_array, PE_calc_noNorm_array
+
+# The matrix versions of the PE calculation have to give the scalar result in every cell, and nan (with a message) where the scalar version raises on a division by zero.
+
+def random_inputs(rng, num_wavelengths=6, num_channels=4):
+    W = np.arange(400., 400. + 2 * num_wavelengths, 2.)
+    P, dP = rng.uniform(1., 5., num_wavelengths), rng.uniform(0., 0.5, num_wavelengths)
+    Par, dPar = rng.uniform(1e4, 1e5, num_wavelengths), rng.uniform(0., 1e3, num_wavelengths)
+    Frag, dFrag = rng.uniform(0., 1e4, (num_wavelengths, num_channels)), rng.uniform(0., 1e3, (num_wavelengths, num_channels))
+    return W, P, dP, Par, dPar, Frag, dFrag
+
+@pytest.mark.parametrize('array_function, scalar_function', [(PE_calc_array, PE_calc), (PE_calc_noNorm_array, PE_calc_noNorm)])
+def test_array_matches_scalar(array_function, scalar_function):
+    W, P, dP, Par, dPar, Frag, dFrag = random_inputs(np.random.default_rng(5))
+    efficiency, PE_stdev = array_function(W, P, dP, Par, dPar, Frag, dFrag, update_output=print)
+
+    for i in range(len(W)):
+        for j in range(Frag.shape[1]):
+            expected = scalar_function(W[i], P[i], dP[i], Par[i], dPar[i], Frag[i, j], dFrag[i, j], update_output=print)
+            np.testing.assert_allclose([efficiency[i, j], PE_stdev[i, j]], expected, rtol=1e-12)
+
+@pytest.mark.parametrize('array_function, scalar_function', [(PE_calc_array, PE_calc), (PE_calc_noNorm_array, PE_calc_noNorm)])
+def test_division_by_zero_cells_are_nan(array_function, scalar_function):
+    W, P, dP, Par, dPar, Frag, dFrag = random_inputs(np.random.default_rng(6))
+    Par[1], Frag[1, 2] = 0., 0. #one cell of a row without base peak intensity
+    P[3] = 0.                    #a whole row without laser power (only matters with power normalization)
+
+    messages = []
+    efficiency, PE_stdev = array_function(W, P, dP, Par, dPar, Frag, dFrag, update_output=messages.append, channel_names=['Total', 'a', 'b', 'c'])
+
+    for i in range(len(W)):
+        for j in range(Frag.shape[1]):
+            #the other cells of the row without base peak intensity are infinite, in both versions
+            try:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    expected = scalar_function(W[i], P[i], dP[i], Par[i], dPar[i], Frag[i, j], dFrag[i, j], update_output=lambda text: None)
+            except ValueError:
+                assert np.isnan(efficiency[i, j]) and np.isnan(PE_stdev[i, j]), (i, j)
+                continue
+            np.testing.assert_allclose([efficiency[i, j], PE_stdev[i, j]], expected, rtol=1e-12, err_msg=str((i, j)))
+
+    #one message per cell that was set to nan
+    num_nan_cells = 1 + (Frag.shape[1] if array_function is PE_calc_array else 0)
+    assert np.count_nonzero(np.isnan(efficiency)) == num_nan_cells
+    assert len(messages) == num_nan_cells
+    assert '402.0nm (b)' in messages[0]
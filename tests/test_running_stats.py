@@ -0,0 +1,43 @@
+import numpy as np
+from Python.workflows import RunningStats
+
+# RunningStats has to give np.mean and np.std (population standard deviation) of everything added, however the values were split up between add() and add_block().
+
+def test_add_matches_numpy():
+    values = np.random.default_rng(3).normal(1e6, 25., size=(500, 4)) #large mean, small spread - where a naive sum of squares loses precision
+    stats = RunningStats(4)
+    for value in values:
+        stats.add(value)
+    np.testing.assert_allclose(stats.mean(), np.mean(values, axis=0), rtol=1e-12)
+    np.testing.assert_allclose(stats.std(), np.std(values, axis=0), rtol=1e-9)
+
+def test_merged_blocks_match_numpy():
+    values = np.random.default_rng(4).random((1000, 3)) * 100
+    stats = RunningStats(3)
+
+    #uneven blocks, an empty block, and single values in between
+    splits = [0, 1, 257, 257, 600, 601, 999, 1000]
+    for start, stop in zip(splits[:-1], splits[1:]):
+        if stop - start == 1:
+            stats.add(values[start])
+        else:
+            stats.add_block(values[start:stop])
+
+    assert stats.count == len(values)
+    np.testing.assert_allclose(stats.mean(), np.mean(values, axis=0), rtol=1e-12)
+    np.testing.assert_allclose(stats.std(), np.std(values, axis=0), rtol=1e-9)
+
+def test_scalar_values_and_kept_values():
+    values = [3., 1., 4., 1., 5., 9., 2., 6.]
+    stats = RunningStats(keep_values=True)
+    stats.add_block(np.array(values[:5]))
+    for value in values[5:]:
+        stats.add(value)
+    np.testing.assert_allclose(stats.mean(), np.mean(values))
+    np.testing.assert_allclose(stats.std(), np.std(values))
+    np.testing.assert_array_equal(stats.values(), values)
+
+def test_empty_is_nan():
+    stats = RunningStats(2, keep_values=True)
+    assert np.all(np.isnan(stats.mean())) and np.all(np.isnan(stats.std()))
+    assert stats.values().shape == (0, 2)